@@ -0,0 +1,197 @@
+"""Instance-wide statistics about the projects, for the operators.
+
+The projects are split into chunks, and the aggregates of each chunk are
+computed with a few grouped queries. Chunks can be processed in parallel, see
+ihatemoney.parallel.
+"""
+from collections import defaultdict
+from datetime import date
+
+import sqlalchemy as sa
+
+from ihatemoney.models import get_table
+from ihatemoney.parallel import PROJECTS_CHUNK_SIZE, map_project_chunks
+
+# Projects without any new bill for this number of days are dormant
+DORMANT_DAYS = 365
+
+REPORT_COLUMNS = (
+    "project_id",
+    "members",
+    "active_members",
+    "bills",
+    "total_spent",
+    "largest_balance",
+    "first_bill",
+    "last_bill",
+    "last_activity",
+    "dormant",
+    "history_rows",
+)
+
+# Columns the report can be sorted by, in decreasing order
+SORT_COLUMNS = ("bills", "members", "total_spent", "largest_balance", "history_rows")
+
+
+def members_query(project_ids):
+    person = get_table("person")
+    return (
+        sa.select(
+            [
+                person.c.project_id,
+                sa.func.count(person.c.id),
+                sa.func.sum(sa.case([(person.c.activated, 1)], else_=0)),
+            ]
+        )
+        .where(person.c.project_id.in_(project_ids))
+        .group_by(person.c.project_id)
+    )
+
+
+def bills_query(project_ids):
+    person, bill = get_table("person"), get_table("bill")
+    return (
+        sa.select(
+            [
+                person.c.project_id,
+                sa.func.count(bill.c.id),
+                sa.func.sum(bill.c.converted_amount),
+                sa.func.min(bill.c.date),
+                sa.func.max(bill.c.date),
+                sa.func.max(bill.c.creation_date),
+            ]
+        )
+        .select_from(bill.join(person, bill.c.payer_id == person.c.id))
+        .where(person.c.project_id.in_(project_ids))
+        .group_by(person.c.project_id)
+    )
+
+
+def debts_query(project_ids):
+    """What each ower of the projects owes to each payer, summed over all the
+    bills, as computed by Project.balance
+    """
+    person, bill, billowers = (
+        get_table("person"),
+        get_table("bill"),
+        get_table("billowers"),
+    )
+    payer, ower = person.alias("payer"), person.alias("ower")
+    # Correlated to each bill, and looked up with the billowers primary key,
+    # so that only the bills of the projects are ever read
+    all_owers, weighted = billowers.alias("all_owers"), person.alias("weighted")
+    weight = (
+        sa.select([sa.func.sum(weighted.c.weight)])
+        .select_from(all_owers.join(weighted, all_owers.c.person_id == weighted.c.id))
+        .where(all_owers.c.bill_id == bill.c.id)
+        .as_scalar()
+    )
+    share = bill.c.converted_amount * ower.c.weight / sa.func.nullif(weight, 0)
+    return (
+        sa.select([payer.c.project_id, payer.c.id, ower.c.id, sa.func.sum(share)])
+        .select_from(
+            payer.join(bill, bill.c.payer_id == payer.c.id)
+            .join(billowers, billowers.c.bill_id == bill.c.id)
+            .join(ower, billowers.c.person_id == ower.c.id)
+        )
+        .where(payer.c.project_id.in_(project_ids))
+        .where(ower.c.id != payer.c.id)
+        .group_by(payer.c.project_id, payer.c.id, ower.c.id)
+    )
+
+
+def history_queries(project_ids):
+    """Number of version rows of each project, table by table"""
+    project_version, person_version, bill_version, billowers_version = (
+        get_table(f"{name}_version")
+        for name in ("project", "person", "bill", "billowers")
+    )
+    # Members which have been deleted only remain in the versions
+    members = (
+        sa.select([person_version.c.id, person_version.c.project_id])
+        .where(person_version.c.project_id.in_(project_ids))
+        .distinct()
+        .alias("members")
+    )
+    yield (
+        sa.select([project_version.c.id, sa.func.count()])
+        .where(project_version.c.id.in_(project_ids))
+        .group_by(project_version.c.id)
+    )
+    yield (
+        sa.select([person_version.c.project_id, sa.func.count()])
+        .where(person_version.c.project_id.in_(project_ids))
+        .group_by(person_version.c.project_id)
+    )
+    for table, column in (
+        (bill_version, bill_version.c.payer_id),
+        (billowers_version, billowers_version.c.person_id),
+    ):
+        yield (
+            sa.select([members.c.project_id, sa.func.count()])
+            .select_from(table.join(members, column == members.c.id))
+            .group_by(members.c.project_id)
+        )
+
+
+def format_date(value):
+    return value and value.isoformat()
+
+
+def project_stats(connection, project_ids, today=None, dormant_days=DORMANT_DAYS):
+    """Compute the statistics of the given projects, with a fixed number of
+    queries. Return one dict per project.
+    """
+    today = today or date.today()
+    stats = {project_id: dict.fromkeys(REPORT_COLUMNS, 0) for project_id in project_ids}
+    for project_id, row in stats.items():
+        row.update(
+            project_id=project_id,
+            first_bill=None,
+            last_bill=None,
+            last_activity=None,
+            dormant=True,
+        )
+
+    for project_id, members, active in connection.execute(members_query(project_ids)):
+        stats[project_id].update(members=members, active_members=active)
+
+    for project_id, *values in connection.execute(bills_query(project_ids)):
+        count, total, first, last, activity = values
+        stats[project_id].update(
+            bills=count,
+            total_spent=round(total or 0, 2),
+            first_bill=format_date(first),
+            last_bill=format_date(last),
+            last_activity=format_date(activity),
+        )
+        if activity is not None and (today - activity).days <= dormant_days:
+            stats[project_id]["dormant"] = False
+
+    balances = defaultdict(lambda: defaultdict(float))
+    for project_id, payer_id, ower_id, debt in connection.execute(
+        debts_query(project_ids)
+    ):
+        balances[project_id][payer_id] += debt or 0
+        balances[project_id][ower_id] -= debt or 0
+    for project_id, members in balances.items():
+        largest = max(abs(balance) for balance in members.values())
+        stats[project_id]["largest_balance"] = round(largest, 2)
+
+    for query in history_queries(project_ids):
+        for project_id, count in connection.execute(query):
+            stats[project_id]["history_rows"] += count
+
+    return list(stats.values())
+
+
+def iter_project_stats(
+    engine, project_ids, processes=1, chunk_size=PROJECTS_CHUNK_SIZE, **kwargs
+):
+    """Yield the statistics of the given projects, computed by the given
+    number of processes
+    """
+    for rows in map_project_chunks(
+        project_stats, engine, project_ids, processes, chunk_size, **kwargs
+    ):
+        yield from rows
@@ -1,12 +1,50 @@
+from datetime import datetime, timedelta
 from functools import wraps
+import hashlib
+import hmac
+import json
 
 from flask import current_app, request
 from flask_restful import Resource, abort
+from flask_restful.utils import unpack
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
 from werkzeug.security import check_password_hash
 from wtforms.fields.core import BooleanField
 
 from ihatemoney.forms import EditProjectForm, MemberForm, ProjectForm, get_billform_for
-from ihatemoney.models import Bill, Person, Project, db
+from ihatemoney.models import Bill, IdempotencyKey, Person, Project, db
+from ihatemoney.transactions import run_transaction
+from ihatemoney.utils import IhmJSONEncoder, slugify
+
+# Methods whose responses are replayed for the requests with the same
+# Idempotency-Key header
+IDEMPOTENT_METHODS = ("POST", "PUT", "DELETE")
+# Keys of the requests still running after this delay are released, as their
+# worker probably died
+IDEMPOTENCY_KEY_LEASE = timedelta(minutes=5)
+
+
+def check_project_password(project, password):
+    """Check the password of the project. Hashing passwords is slow on purpose,
+    so the right ones are remembered for a while, in the "auth" cache.
+
+    Only an HMAC of the password is kept, along with the hash it matches, so
+    that changing the password of the project forgets the previous one.
+    """
+    message = "\0".join((project.id, project.password, password))
+    key = hmac.new(
+        current_app.config["SECRET_KEY"].encode("utf-8"),
+        message.encode("utf-8"),
+        hashlib.sha256,
+    ).hexdigest()
+    cache = current_app.caches["auth"]
+    if cache.get(key):
+        return True
+    if check_password_hash(project.password, password):
+        cache.set(key, True)
+        return True
+    return False
 
 
 def need_auth(f):
@@ -22,8 +60,8 @@ def need_auth(f):
 
         # Use Basic Auth
         if auth and project_id and auth.username == project_id:
-            project = Project.query.get(auth.username)
-            if project and check_password_hash(project.password, auth.password):
+            project = current_app.project_cache.get(auth.username)
+            if project and check_project_password(project, auth.password):
                 # The whole project object will be passed instead of project_id
                 kwargs.pop("project_id")
                 return f(*args, project=project, **kwargs)
@@ -37,7 +75,7 @@ def need_auth(f):
                 abort(401)
             project_id = Project.verify_token(auth_token, token_type="non_timed_token")
             if auth_token and project_id:
-                project = Project.query.get(project_id)
+                project = current_app.project_cache.get(project_id)
                 if project:
                     kwargs.pop("project_id")
                     return f(*args, project=project, **kwargs)
@@ -46,7 +84,106 @@ def need_auth(f):
     return wrapper
 
 
+def request_fingerprint():
+    digest = hashlib.sha1()
+    for part in (request.method, request.path):
+        digest.update(part.encode("utf-8") + b"\0")
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+def reserve_idempotency_key(project_id, key, fingerprint):
+    """Store the key, and return None, or return the key already stored by a
+    previous request. Expired keys, and the ones of the requests which ran
+    longer than their lease, are removed first.
+    """
+    now = datetime.utcnow()
+    ttl = timedelta(seconds=current_app.config["IDEMPOTENCY_KEY_TTL"])
+    IdempotencyKey.query.filter(
+        or_(
+            IdempotencyKey.created_at < now - ttl,
+            and_(
+                IdempotencyKey.status.is_(None),
+                IdempotencyKey.created_at < now - IDEMPOTENCY_KEY_LEASE,
+            ),
+        )
+    ).delete(synchronize_session=False)
+    stored = IdempotencyKey.query.get((project_id, key))
+    if stored is None:
+        db.session.add(
+            IdempotencyKey(project_id=project_id, key=key, fingerprint=fingerprint)
+        )
+    db.session.commit()
+    return stored
+
+
+def idempotent(f):
+    """Replay the response of a request sent again with the same
+    Idempotency-Key header, such as a retry of a request which timed out.
+
+    Keys are scoped to the project, so it must be applied before need_auth.
+    The keys of the project creations are scoped to the requested identifier.
+    Server errors are not stored, the request can be retried.
+    """
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get("Idempotency-Key")
+        if not key or request.method not in IDEMPOTENT_METHODS:
+            return f(*args, **kwargs)
+        if len(key) > IdempotencyKey.key.type.length:
+            return "Idempotency-Key is too long", 400
+
+        project = kwargs.get("project")
+        if project is not None:
+            project_id = project.id
+        else:
+            project_id = slugify(request.form.get("id", ""))
+            if not project_id:
+                return f(*args, **kwargs)
+        fingerprint = request_fingerprint()
+        try:
+            stored = run_transaction(
+                lambda: reserve_idempotency_key(project_id, key, fingerprint)
+            )
+        except IntegrityError:
+            # Stored by a concurrent request
+            db.session.rollback()
+            stored = IdempotencyKey.query.get((project_id, key))
+        if stored is not None:
+            if stored.fingerprint != fingerprint:
+                return "Idempotency-Key already used by another request", 422
+            if stored.status is None:
+                return "A request with this Idempotency-Key is in progress", 409
+            return json.loads(stored.response), stored.status
+
+        stored = IdempotencyKey.query.filter_by(project_id=project_id, key=key)
+
+        def store_response(status, data):
+            if status >= 500:
+                stored.delete()
+            else:
+                stored.update(
+                    {"status": status, "response": json.dumps(data, cls=IhmJSONEncoder)}
+                )
+            db.session.commit()
+
+        try:
+            response = f(*args, **kwargs)
+        except Exception:
+            db.session.rollback()
+            run_transaction(lambda: store_response(500, None))
+            raise
+        data, status, _ = unpack(response)
+        run_transaction(lambda: store_response(status, data))
+        return response
+
+    return wrapper
+
+
 class ProjectsHandler(Resource):
+    method_decorators = [idempotent]
+
     def post(self):
         form = ProjectForm(meta={"csrf": False})
         if form.validate() and current_app.config.get("ALLOW_PUBLIC_PROJECT_CREATION"):
@@ -58,14 +195,16 @@ class ProjectsHandler(Resource):
 
 
 class ProjectHandler(Resource):
-    method_decorators = [need_auth]
+    method_decorators = [idempotent, need_auth]
 
     def get(self, project):
         return project
 
     def delete(self, project):
-        db.session.delete(project)
-        db.session.commit()
+        if project.should_remove_in_background():
+            project.remove_project_in_background()
+        else:
+            project.remove_project()
         return "DELETED"
 
     def put(self, project):
@@ -98,7 +237,7 @@ class APIMemberForm(MemberForm):
 
 
 class MembersHandler(Resource):
-    method_decorators = [need_auth]
+    method_decorators = [idempotent, need_auth]
 
     def get(self, project):
         return project.members
@@ -106,15 +245,19 @@ class MembersHandler(Resource):
     def post(self, project):
         form = MemberForm(project, meta={"csrf": False})
         if form.validate():
-            member = Person()
-            form.save(project, member)
-            db.session.commit()
-            return member.id, 201
+
+            def save_member():
+                member = Person()
+                form.save(project, member)
+                db.session.commit()
+                return member.id
+
+            return run_transaction(save_member), 201
         return form.errors, 400
 
 
 class MemberHandler(Resource):
-    method_decorators = [need_auth]
+    method_decorators = [idempotent, need_auth]
 
     def get(self, project, member_id):
         member = Person.query.get(member_id, project)
@@ -126,19 +269,23 @@ class MemberHandler(Resource):
         form = APIMemberForm(project, meta={"csrf": False}, edit=True)
         if form.validate():
             member = Person.query.get(member_id, project)
-            form.save(project, member)
-            db.session.commit()
+
+            def save_member():
+                form.save(project, member)
+                db.session.commit()
+
+            run_transaction(save_member)
             return member
         return form.errors, 400
 
     def delete(self, project, member_id):
-        if project.remove_member(member_id):
+        if run_transaction(lambda: project.remove_member(member_id)):
             return "OK"
         return "Not Found", 404
 
 
 class BillsHandler(Resource):
-    method_decorators = [need_auth]
+    method_decorators = [idempotent, need_auth]
 
     def get(self, project):
         return project.get_bills().all()
@@ -146,16 +293,20 @@ class BillsHandler(Resource):
     def post(self, project):
         form = get_billform_for(project, True, meta={"csrf": False})
         if form.validate():
-            bill = Bill()
-            form.save(bill, project)
-            db.session.add(bill)
-            db.session.commit()
-            return bill.id, 201
+
+            def save_bill():
+                bill = Bill()
+                form.save(bill, project)
+                db.session.add(bill)
+                db.session.commit()
+                return bill.id
+
+            return run_transaction(save_bill), 201
         return form.errors, 400
 
 
 class BillHandler(Resource):
-    method_decorators = [need_auth]
+    method_decorators = [idempotent, need_auth]
 
     def get(self, project, bill_id):
         bill = Bill.query.get(project, bill_id)
@@ -167,15 +318,22 @@ class BillHandler(Resource):
         form = get_billform_for(project, True, meta={"csrf": False})
         if form.validate():
             bill = Bill.query.get(project, bill_id)
-            form.save(bill, project)
-            db.session.commit()
+
+            def save_bill():
+                form.save(bill, project)
+                db.session.commit()
+
+            run_transaction(save_bill)
             return bill.id, 200
         return form.errors, 400
 
     def delete(self, project, bill_id):
-        bill = Bill.query.delete(project, bill_id)
-        db.session.commit()
-        if not bill:
+        def delete():
+            bill = Bill.query.delete(project, bill_id)
+            db.session.commit()
+            return bill
+
+        if not run_transaction(delete):
             return "Not Found", 404
         return "OK", 200
 
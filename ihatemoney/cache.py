@@ -0,0 +1,435 @@
+"""Caches of hot values, such as the projects and the exchange rates.
+
+Each cache is a namespace of the CACHE_NAMESPACES setting, with its own size
+and time to live, stored by a backend:
+
+- "memory" keeps the values in the memory of each process, and drops the
+  least recently used ones first;
+- "sqlite" keeps them in an SQLite file, shared by the processes of the host,
+  which only its owner can read and write;
+- "redis" keeps them on a Redis server, or any server speaking its protocol,
+  shared by all the hosts. It needs the redis package.
+
+Values are pickled, so each request gets its own copy. They are signed with
+the SECRET_KEY, so that values written by someone else are never unpickled.
+The errors of the backends are logged, and handled as cache misses.
+
+Most requests start by loading their project, then its members. Both rarely
+change, so ProjectCache keeps copies of the recently used projects, with
+their members. The project row is still loaded, by primary key, and the
+members of the copy are only used if the revision of the project has not
+changed since the copy was made. The revision changes whenever the project
+or one of its members is changed, see ihatemoney.models.bump_revisions().
+
+The templates cache their slowest fragments, such as the balance table, in
+the "fragments" namespace:
+
+    {% cache "balance", g.project.data_revision %}...{% endcache %}
+
+The fragments are cached by name and by the given values, such as the
+revisions of the project, along with the locale of the request.
+"""
+from collections import OrderedDict
+import hashlib
+import hmac
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from flask import current_app, request
+from flask_babel import get_locale
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+from sqlalchemy.orm.attributes import set_committed_value
+
+from ihatemoney import default_settings
+from ihatemoney.models import Project, db
+
+
+class LRUCache:
+    """A thread-safe mapping holding up to size items, which drops the least
+    recently used items first
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                self.items.move_to_end(key)
+            except KeyError:
+                return default
+            return self.items[key]
+
+    def set(self, key, value):
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
+
+
+class MemoryBackend:
+    """Values kept in the memory of the process"""
+
+    def __init__(self, namespace, size, url=None):
+        self.items = LRUCache(size)
+
+    def get(self, key):
+        item = self.items.get(key)
+        if item is None:
+            return None
+        expires, value = item
+        if expires is not None and expires < time.time():
+            self.items.delete(key)
+            return None
+        return value
+
+    def set(self, key, value, ttl):
+        self.items.set(key, (time.time() + ttl if ttl else None, value))
+
+    def delete(self, key):
+        self.items.delete(key)
+
+    def clear(self):
+        self.items.clear()
+
+
+class SQLiteBackend:
+    """Values kept in an SQLite file, shared by the processes of the host.
+
+    The namespaces grow over their size between two prunes, which drop the
+    values stored first.
+    """
+
+    # Number of values stored by a process between two prunes
+    prune_interval = 100
+
+    def __init__(self, namespace, size, url=None):
+        if not url:
+            raise ValueError("The sqlite cache backend needs a CACHE_URL path")
+        self.namespace = namespace
+        self.size = size
+        self.path = url
+        self.local = threading.local()
+        self.stored = 0
+        # SQLite gives the same permissions to the journal files
+        os.close(os.open(self.path, os.O_CREAT | os.O_RDWR, 0o600))
+
+    def connection(self):
+        """The connection of the thread, opened again in forked processes"""
+        if getattr(self.local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache (namespace TEXT, key TEXT, "
+                "value BLOB, expires REAL, stored REAL, "
+                "PRIMARY KEY (namespace, key))"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS ix_cache_stored ON cache (namespace, stored)"
+            )
+            self.local.connection, self.local.pid = connection, os.getpid()
+        return self.local.connection
+
+    def get(self, key):
+        row = (
+            self.connection()
+            .execute(
+                "SELECT value FROM cache WHERE namespace = ? AND key = ? "
+                "AND (expires IS NULL OR expires >= ?)",
+                (self.namespace, key, time.time()),
+            )
+            .fetchone()
+        )
+        return row[0] if row else None
+
+    def set(self, key, value, ttl):
+        if self.size <= 0:
+            return
+        now = time.time()
+        connection = self.connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)",
+            (self.namespace, key, value, now + ttl if ttl else None, now),
+        )
+        self.stored += 1
+        if self.stored % self.prune_interval == 0:
+            self.prune()
+
+    def prune(self):
+        """Drop the expired values, then the oldest ones over the size"""
+        connection = self.connection()
+        connection.execute(
+            "DELETE FROM cache WHERE namespace = ? AND expires < ?",
+            (self.namespace, time.time()),
+        )
+        connection.execute(
+            "DELETE FROM cache WHERE namespace = ? AND stored <= ("
+            "SELECT stored FROM cache WHERE namespace = ? "
+            "ORDER BY stored DESC LIMIT 1 OFFSET ?)",
+            (self.namespace, self.namespace, self.size),
+        )
+
+    def delete(self, key):
+        self.connection().execute(
+            "DELETE FROM cache WHERE namespace = ? AND key = ?", (self.namespace, key)
+        )
+
+    def clear(self):
+        self.connection().execute(
+            "DELETE FROM cache WHERE namespace = ?", (self.namespace,)
+        )
+
+
+class RedisBackend:
+    """Values kept on a Redis server, which enforces its own memory limit
+    rather than the size of the namespaces
+    """
+
+    def __init__(self, namespace, size, url=None):
+        # Imported on first use, it is an optional dependency
+        import redis
+
+        self.client = redis.Redis.from_url(url or "redis://localhost:6379/0")
+        self.prefix = f"ihatemoney:{namespace}:"
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, value, px=int(ttl * 1000) if ttl else None)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+
+BACKENDS = {"memory": MemoryBackend, "sqlite": SQLiteBackend, "redis": RedisBackend}
+
+
+class Cache:
+    """A namespace of cached values, with its own backend and time to live.
+
+    Keys are strings, values are anything which can be pickled except None.
+    With a secret, the values are signed along with their namespace and key,
+    and the values whose signature is wrong are misses.
+    """
+
+    def __init__(self, name, backend, ttl=None, logger=None, secret=None):
+        self.name = name
+        self.backend = backend
+        self.ttl = ttl
+        self.logger = logger
+        self.secret = secret
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def log_error(self, error):
+        if self.logger is not None:
+            self.logger.warning("Error of the %s cache: %r", self.name, error)
+
+    def sign(self, key, data):
+        message = b"\0".join((self.name.encode("utf-8"), key.encode("utf-8"), data))
+        return hmac.new(self.secret, message, hashlib.sha256).digest()
+
+    def dumps(self, key, value):
+        data = pickle.dumps(value)
+        return data if self.secret is None else self.sign(key, data) + data
+
+    def loads(self, key, value):
+        if self.secret is None:
+            return pickle.loads(value)
+        signature, data = value[:32], value[32:]
+        if not hmac.compare_digest(signature, self.sign(key, data)):
+            raise ValueError(f"invalid signature of {key!r}")
+        return pickle.loads(data)
+
+    def get(self, key, default=None):
+        try:
+            value = self.backend.get(key)
+            if value is not None:
+                value = self.loads(key, value)
+        except Exception as error:
+            self.log_error(error)
+            value = None
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return default if value is None else value
+
+    def set(self, key, value, ttl=None):
+        try:
+            self.backend.set(key, self.dumps(key, value), ttl or self.ttl)
+        except Exception as error:
+            self.log_error(error)
+
+    def get_or_set(self, key, compute, ttl=None):
+        """Return the cached value, or compute it and cache it"""
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.set(key, value, ttl)
+        return value
+
+    def delete(self, key):
+        try:
+            self.backend.delete(key)
+        except Exception as error:
+            self.log_error(error)
+
+    def clear(self):
+        try:
+            self.backend.clear()
+        except Exception as error:
+            self.log_error(error)
+        with self.lock:
+            self.hits = self.misses = 0
+
+    def stats(self):
+        """Hits and misses of the process, for the metrics"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            }
+
+
+def get_namespaces(config):
+    """Options of each namespace: the ones of CACHE_NAMESPACES, completed by
+    the default ones
+    """
+    namespaces = {
+        name: dict(options)
+        for name, options in default_settings.CACHE_NAMESPACES.items()
+    }
+    for name, options in config["CACHE_NAMESPACES"].items():
+        namespaces.setdefault(name, {}).update(options)
+    return namespaces
+
+
+def create_caches(app):
+    """Create the caches of the application, by namespace"""
+    caches = {}
+    for name, options in get_namespaces(app.config).items():
+        backend = BACKENDS[options.get("backend", app.config["CACHE_BACKEND"])]
+        caches[name] = Cache(
+            name,
+            backend(name, options.get("size", 0), app.config["CACHE_URL"]),
+            options.get("ttl"),
+            app.logger,
+            app.config["SECRET_KEY"].encode("utf-8"),
+        )
+    return caches
+
+
+class ProjectCache:
+    """Copies of the projects, with their members, by project id"""
+
+    # Outcomes of the lookups: a copy was used, there was no copy, or the copy
+    # was older than the project
+    outcomes = ("hits", "misses", "stale")
+
+    def __init__(self, cache):
+        # Copies of the projects, along with their revision
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.counters = dict.fromkeys(self.outcomes, 0)
+
+    def count(self, outcome):
+        with self.lock:
+            self.counters[outcome] += 1
+
+    def get(self, project_id):
+        """Return the project with the given id, with its members loaded, or
+        None if there is no such project.
+
+        The project is attached to db.session, as if it had been queried. It
+        must be called before changing anything in the session.
+        """
+        project = Project.query.get(project_id)
+        if project is None:
+            self.cache.delete(project_id)
+            return None
+
+        cached = self.cache.get(project_id)
+        if cached is not None and cached[0] == project.revision:
+            self.count("hits")
+            # Fills the project loaded above with the members of the copy,
+            # but not with its revision of the bills, which may be older
+            bills_revision = project.bills_revision
+            project = db.session.merge(cached[1], load=False)
+            set_committed_value(project, "bills_revision", bills_revision)
+            return project
+        self.count("misses" if cached is None else "stale")
+
+        # Load the members, to be copied along
+        project.members
+        self.cache.set(project_id, (project.revision, project))
+        return project
+
+    def clear(self):
+        self.cache.clear()
+        with self.lock:
+            self.counters = dict.fromkeys(self.outcomes, 0)
+
+    def stats(self):
+        """Outcomes of the lookups, for the metrics"""
+        with self.lock:
+            stats = dict(self.counters)
+        lookups = sum(stats.values())
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else None
+        return stats
+
+
+class FragmentCacheExtension(Extension):
+    """The {% cache name, value... %} tag of the templates"""
+
+    tags = {"cache"}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        parts = [parser.parse_expression()]
+        while parser.stream.skip_if("comma"):
+            parts.append(parser.parse_expression())
+        body = parser.parse_statements(["name:endcache"], drop_needle=True)
+        return nodes.CallBlock(
+            self.call_method("render_fragment", [nodes.List(parts)]), [], [], body
+        ).set_lineno(lineno)
+
+    def render_fragment(self, parts, caller):
+        # The URLs depend on where the application is mounted
+        parts += [str(get_locale()), request.script_root]
+        key = "\0".join(str(part) for part in parts)
+        cache = current_app.caches["fragments"]
+        return Markup(
+            cache.get_or_set(hashlib.sha1(key.encode("utf-8")).hexdigest(), caller)
+        )
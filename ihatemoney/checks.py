@@ -0,0 +1,225 @@
+"""Integrity checks of the database, and their repairs.
+
+Balances are computed on the fly from the bills and their owers, so rows which
+do not belong together go unnoticed, and silently change the balances. Each
+check returns the problems it finds, as dicts with the name of the check, the
+project they belong to (if any) and the ids of the faulty rows.
+
+Project checks run on chunks of projects, possibly in parallel, see
+ihatemoney.parallel. Instance checks look for rows which do not belong to any
+project anymore. Repairs run in the main process, in a single transaction.
+"""
+from collections import defaultdict
+
+import sqlalchemy as sa
+
+from ihatemoney.models import bump_revisions, db, get_table, versioning_manager
+from ihatemoney.parallel import PROJECTS_CHUNK_SIZE, map_project_chunks
+
+# Number of rows repaired by each statement
+REPAIR_BATCH_SIZE = 500
+
+
+def to_problems(check, rows, *columns):
+    """Make problem dicts out of the rows returned by a check"""
+    return [dict(zip(("check",) + columns, (check,) + tuple(row))) for row in rows]
+
+
+def find_foreign_owers(connection, project_ids):
+    """Owers which are not members of the project of the bill"""
+    person, bill, billowers = (
+        get_table("person"),
+        get_table("bill"),
+        get_table("billowers"),
+    )
+    payer, ower = person.alias("payer"), person.alias("ower")
+    query = (
+        sa.select([payer.c.project_id, billowers.c.bill_id, billowers.c.person_id])
+        .select_from(
+            payer.join(bill, bill.c.payer_id == payer.c.id)
+            .join(billowers, billowers.c.bill_id == bill.c.id)
+            .outerjoin(ower, billowers.c.person_id == ower.c.id)
+        )
+        .where(payer.c.project_id.in_(project_ids))
+        .where(sa.or_(ower.c.id.is_(None), ower.c.project_id != payer.c.project_id))
+    )
+    return to_problems(
+        "foreign_owers",
+        connection.execute(query),
+        "project_id",
+        "bill_id",
+        "person_id",
+    )
+
+
+def find_invalid_weights(connection, project_ids):
+    """Members with a null or negative weight"""
+    person = get_table("person")
+    query = sa.select([person.c.project_id, person.c.id, person.c.weight]).where(
+        sa.and_(
+            person.c.project_id.in_(project_ids),
+            sa.or_(person.c.weight.is_(None), person.c.weight <= 0),
+        )
+    )
+    return to_problems(
+        "invalid_weights",
+        connection.execute(query),
+        "project_id",
+        "person_id",
+        "weight",
+    )
+
+
+def find_bills_without_owers(connection, project_ids):
+    """Bills which nobody owes, they are not taken into account in balances"""
+    person, bill, billowers = (
+        get_table("person"),
+        get_table("bill"),
+        get_table("billowers"),
+    )
+    query = (
+        sa.select([person.c.project_id, bill.c.id])
+        .select_from(person.join(bill, bill.c.payer_id == person.c.id))
+        .where(person.c.project_id.in_(project_ids))
+        .where(~sa.exists().where(billowers.c.bill_id == bill.c.id))
+    )
+    return to_problems(
+        "bills_without_owers", connection.execute(query), "project_id", "bill_id"
+    )
+
+
+def find_orphan_owers(connection):
+    """Owers of bills which do not exist"""
+    bill, billowers = get_table("bill"), get_table("billowers")
+    query = sa.select([billowers.c.bill_id, billowers.c.person_id]).where(
+        ~sa.exists().where(bill.c.id == billowers.c.bill_id)
+    )
+    return to_problems(
+        "orphan_owers", connection.execute(query), "bill_id", "person_id"
+    )
+
+
+def find_orphan_bills(connection):
+    """Bills whose payer does not exist"""
+    person, bill = get_table("person"), get_table("bill")
+    query = sa.select([bill.c.id]).where(
+        ~sa.exists().where(person.c.id == bill.c.payer_id)
+    )
+    return to_problems("orphan_bills", connection.execute(query), "bill_id")
+
+
+def find_orphan_members(connection):
+    """Members of projects which do not exist"""
+    project, person = get_table("project"), get_table("person")
+    query = sa.select([person.c.id]).where(
+        ~sa.exists().where(project.c.id == person.c.project_id)
+    )
+    return to_problems("orphan_members", connection.execute(query), "person_id")
+
+
+PROJECT_CHECKS = {
+    "foreign_owers": find_foreign_owers,
+    "invalid_weights": find_invalid_weights,
+    "bills_without_owers": find_bills_without_owers,
+}
+
+INSTANCE_CHECKS = {
+    "orphan_owers": find_orphan_owers,
+    "orphan_bills": find_orphan_bills,
+    "orphan_members": find_orphan_members,
+}
+
+
+def check_projects(connection, project_ids):
+    """Run all the project checks on the given projects"""
+    return [
+        problem
+        for check in PROJECT_CHECKS.values()
+        for problem in check(connection, project_ids)
+    ]
+
+
+def iter_problems(engine, project_ids, processes=1, chunk_size=PROJECTS_CHUNK_SIZE):
+    """Yield the problems of the instance, then the ones of the given
+    projects, computed by the given number of processes
+    """
+    with engine.connect() as connection:
+        for check in INSTANCE_CHECKS.values():
+            yield from check(connection)
+    for chunk_problems in map_project_chunks(
+        check_projects, engine, project_ids, processes, chunk_size
+    ):
+        yield from chunk_problems
+
+
+def delete_owers(session, problems):
+    billowers = get_table("billowers")
+    session.execute(
+        billowers.delete().where(
+            sa.and_(
+                billowers.c.bill_id == sa.bindparam("b_bill_id"),
+                billowers.c.person_id == sa.bindparam("b_person_id"),
+            )
+        ),
+        [
+            {"b_bill_id": problem["bill_id"], "b_person_id": problem["person_id"]}
+            for problem in problems
+        ],
+    )
+    # Orphan owers belong to no project
+    bump_revisions(
+        session,
+        {problem["project_id"] for problem in problems if "project_id" in problem},
+        ("bills_revision",),
+    )
+
+
+def reset_weights(session, problems):
+    """Reset weights to 1, as the a67119aa3ee5 migration did"""
+    person = get_table("person")
+    session.execute(
+        person.update()
+        .where(person.c.id.in_([problem["person_id"] for problem in problems]))
+        .values(weight=1)
+    )
+    bump_revisions(session, {problem["project_id"] for problem in problems})
+
+
+def delete_bills(session, problems):
+    bill, billowers = get_table("bill"), get_table("billowers")
+    bill_ids = [problem["bill_id"] for problem in problems]
+    session.execute(billowers.delete().where(billowers.c.bill_id.in_(bill_ids)))
+    session.execute(bill.delete().where(bill.c.id.in_(bill_ids)))
+
+
+# Problems which can be repaired. The others need a human decision.
+REPAIRS = {
+    "orphan_owers": delete_owers,
+    "orphan_bills": delete_bills,
+    "foreign_owers": delete_owers,
+    "invalid_weights": reset_weights,
+}
+
+
+def repair_problems(problems, batch_size=REPAIR_BATCH_SIZE):
+    """Repair the given problems, then commit. Return the number of repaired
+    problems, by check.
+
+    Repairs are not recorded in the history of the projects.
+    """
+    by_check = defaultdict(list)
+    for problem in problems:
+        if problem["check"] in REPAIRS:
+            by_check[problem["check"]].append(problem)
+
+    try:
+        with versioning_manager.versioning_disabled(db.session):
+            for check, repair_batch in REPAIRS.items():
+                check_problems = by_check.get(check, [])
+                for start in range(0, len(check_problems), batch_size):
+                    repair_batch(db.session, check_problems[start : start + batch_size])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return {check: len(check_problems) for check, check_problems in by_check.items()}
@@ -1,5 +1,7 @@
-from cachetools import TTLCache, cached
-import requests
+from flask import current_app, has_app_context
+
+from ihatemoney import default_settings
+from ihatemoney.cache import Cache, MemoryBackend
 
 
 class Singleton(type):
@@ -17,14 +19,29 @@ class CurrencyConverter(object, metaclass=Singleton):
     api_url = "https://api.exchangeratesapi.io/latest?base=USD"
 
     def __init__(self):
-        pass
+        # Used outside of an application context, such as in the migrations
+        options = default_settings.CACHE_NAMESPACES["exchange_rates"]
+        self.fallback_cache = Cache(
+            "exchange_rates",
+            MemoryBackend("exchange_rates", options["size"]),
+            options["ttl"],
+        )
+
+    def fetch_rates(self):
+        # Imported on first use, most processes never fetch the rates
+        import requests
 
-    @cached(cache=TTLCache(maxsize=1, ttl=86400))
-    def get_rates(self):
         rates = requests.get(self.api_url).json()["rates"]
         rates[self.no_currency] = 1.0
         return rates
 
+    def get_rates(self):
+        if has_app_context():
+            cache = current_app.caches["exchange_rates"]
+        else:
+            cache = self.fallback_cache
+        return cache.get_or_set("rates", self.fetch_rates)
+
     def get_currencies(self, with_no_currency=True):
         rates = [
             rate
@@ -2,12 +2,33 @@
 DEBUG = SQLACHEMY_ECHO = False
 SQLALCHEMY_DATABASE_URI = "sqlite:////tmp/ihatemoney.db"
 SQLALCHEMY_TRACK_MODIFICATIONS = False
+DATABASE_POOL_SIZE = None
+DATABASE_POOL_RECYCLE = None
+SQLITE_JOURNAL_MODE = "WAL"
+SQLITE_SYNCHRONOUS = "NORMAL"
+SQLITE_BUSY_TIMEOUT = 5000
+SQLITE_CACHE_SIZE = None
+SQLITE_MMAP_SIZE = None
+TRANSACTION_RETRIES = 3
+TRANSACTION_RETRY_DELAY = 0.05
+IDEMPOTENCY_KEY_TTL = 86400
+CACHE_BACKEND = "memory"
+CACHE_URL = None
+CACHE_NAMESPACES = {
+    "projects": {"size": 256},
+    "exchange_rates": {"size": 1, "ttl": 86400},
+    "auth": {"size": 1024, "ttl": 300},
+    "login_attempts": {"size": 10000, "ttl": 60},
+    "fragments": {"size": 1024, "ttl": 86400},
+}
 SECRET_KEY = "tralala"
 MAIL_DEFAULT_SENDER = ("Budget manager", "budget@notmyidea.org")
 ACTIVATE_DEMO_PROJECT = True
 ADMIN_PASSWORD = ""
 ALLOW_PUBLIC_PROJECT_CREATION = True
 ACTIVATE_ADMIN_DASHBOARD = False
+EXPORT_COMPRESSION_LEVEL = 6
+BACKGROUND_DELETION_THRESHOLD = 50000
 SUPPORTED_LANGUAGES = [
     "de",
     "en",
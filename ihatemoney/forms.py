@@ -1,7 +1,6 @@
 from datetime import datetime
 from re import match
 
-import email_validator
 from flask import request
 from flask_babel import lazy_gettext as _
 from flask_wtf.file import FileAllowed, FileField, FileRequired
@@ -51,7 +50,7 @@ def get_billform_for(project, set_default=True, **kwargs):
 
     form.original_currency.choices = [
         (currency_name, render_localized_currency(currency_name, detailed=False))
-        for currency_name in form.currency_helper.get_currencies(
+        for currency_name in CurrencyConverter().get_currencies(
             with_no_currency=show_no_currency
         )
     ]
@@ -106,14 +105,13 @@ class EditProjectForm(FlaskForm):
     contact_email = StringField(_("Email"), validators=[DataRequired(), Email()])
     project_history = BooleanField(_("Enable project history"))
     ip_recording = BooleanField(_("Use IP tracking for project history"))
-    currency_helper = CurrencyConverter()
     default_currency = SelectField(_("Default Currency"), validators=[DataRequired()],)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.default_currency.choices = [
             (currency_name, render_localized_currency(currency_name, detailed=True))
-            for currency_name in self.currency_helper.get_currencies()
+            for currency_name in CurrencyConverter().get_currencies()
         ]
 
     @property
@@ -159,9 +157,12 @@ class EditProjectForm(FlaskForm):
 
 class UploadForm(FlaskForm):
     file = FileField(
-        "JSON",
-        validators=[FileRequired(), FileAllowed(["json", "JSON"], "JSON only!")],
-        description=_("Import previously exported JSON file"),
+        "JSON or CSV",
+        validators=[
+            FileRequired(),
+            FileAllowed(["json", "JSON", "csv", "CSV"], "JSON or CSV only!"),
+        ],
+        description=_("Import previously exported JSON or CSV file"),
     )
     submit = SubmitField(_("Import"))
 
@@ -227,7 +228,6 @@ class BillForm(FlaskForm):
     what = StringField(_("What?"), validators=[DataRequired()])
     payer = SelectField(_("Payer"), validators=[DataRequired()], coerce=int)
     amount = CalculatorStringField(_("Amount paid"), validators=[DataRequired()])
-    currency_helper = CurrencyConverter()
     original_currency = SelectField(_("Currency"), validators=[DataRequired()],)
     external_link = URLField(
         _("External link"),
@@ -246,9 +246,9 @@ class BillForm(FlaskForm):
         bill.what = self.what.data
         bill.external_link = self.external_link.data
         bill.date = self.date.data
-        bill.owers = [Person.query.get(ower, project) for ower in self.payed_for.data]
+        bill.owers = Person.query.get_by_ids(self.payed_for.data, project)
         bill.original_currency = self.original_currency.data
-        bill.converted_amount = self.currency_helper.exchange_currency(
+        bill.converted_amount = CurrencyConverter().exchange_currency(
             bill.amount, bill.original_currency, project.default_currency
         )
         return bill
@@ -259,9 +259,9 @@ class BillForm(FlaskForm):
         bill.what = self.what
         bill.external_link = ""
         bill.date = self.date
-        bill.owers = [Person.query.get(ower, project) for ower in self.payed_for]
+        bill.owers = Person.query.get_by_ids(self.payed_for, project)
         bill.original_currency = CurrencyConverter.no_currency
-        bill.converted_amount = self.currency_helper.exchange_currency(
+        bill.converted_amount = CurrencyConverter().exchange_currency(
             bill.amount, bill.original_currency, project.default_currency
         )
 
@@ -335,6 +335,9 @@ class InviteForm(FlaskForm):
     submit = SubmitField(_("Send invites"))
 
     def validate_emails(form, field):
+        # Imported on first use, it pulls in a whole DNS resolver
+        import email_validator
+
         for email in [email.strip() for email in form.emails.data.split(",")]:
             try:
                 email_validator.validate_email(email)
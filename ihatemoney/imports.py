@@ -0,0 +1,300 @@
+"""Import bills into a project, from json or csv files previously exported.
+
+The bills are read one by one, validated without going through the forms,
+and written with bulk inserts, batch by batch, in a single transaction.
+"""
+import codecs
+from collections import namedtuple
+import csv
+from datetime import datetime
+import io
+from numbers import Real
+import uuid
+
+from dateutil.parser import parse
+import sqlalchemy as sa
+
+from ihatemoney.currency_convertor import CurrencyConverter
+from ihatemoney.models import (
+    Bill,
+    Person,
+    billowers,
+    bump_revisions,
+    db,
+    versioning_manager,
+)
+from ihatemoney.utils import bill_key, iter_json_array
+
+# Number of bills written with each bulk insert
+IMPORT_BATCH_SIZE = 1000
+
+# Stop reading the file after this number of invalid bills
+IMPORT_MAX_ERRORS = 100
+
+BILL_ATTRIBUTES = {"what", "payer_name", "payer_weight", "amount", "date", "owers"}
+
+# An invalid bill: its position in the file (starting at 1) and the reason
+RowError = namedtuple("RowError", ["row", "message"])
+
+
+class InvalidImport(ValueError):
+    """Some bills of the file are invalid, nothing has been imported"""
+
+    def __init__(self, errors):
+        super().__init__(", ".join(f"row {e.row}: {e.message}" for e in errors))
+        self.errors = errors
+
+
+class ImportReport:
+    """Progress, then outcome, of an import"""
+
+    def __init__(self):
+        # Number of bills read from the file
+        self.rows = 0
+        self.added = 0
+        self.duplicates = 0
+        self.members_added = 0
+        self.errors = []
+
+
+def split_names(joined, names):
+    """Split names joined with commas, as the owers of the csv exports.
+
+    Names may contain commas themselves: the longest known names are found
+    first, the other names are split on each comma.
+    """
+    parts = joined.split(",")
+    result = []
+    start = 0
+    while start < len(parts):
+        for end in range(len(parts), start, -1):
+            name = ",".join(parts[start:end]).strip()
+            if end == start + 1 or name in names:
+                result.append(name)
+                start = end
+                break
+    return result
+
+
+def iter_csv_bills(file, member_names=()):
+    """Parse a csv file, as exported, and yield its bills one by one.
+
+    The file can be opened in text or binary mode, bytes are decoded as
+    utf-8. Values which cannot be converted are kept as strings, so that
+    clean_bill() reports them.
+
+    :member_names: names of the members of the project, which may contain
+    commas, as the payers found in the file.
+    """
+    if not isinstance(file, io.TextIOBase):
+        file = codecs.getreader("utf-8-sig")(file)
+    reader = csv.DictReader(file)
+    if set(reader.fieldnames or ()) != BILL_ATTRIBUTES:
+        raise ValueError("Invalid csv header")
+
+    names = set(member_names)
+    for row in reader:
+        for attr in ("amount", "payer_weight"):
+            try:
+                row[attr] = float(row[attr])
+            except (TypeError, ValueError):
+                pass
+        if isinstance(row["payer_name"], str):
+            names.add(row["payer_name"])
+        if isinstance(row["owers"], str):
+            # Owers are joined with ", " in exports
+            row["owers"] = split_names(row["owers"], names)
+        yield row
+
+
+# Parser of each import format
+IMPORT_FORMATS = {"json": iter_json_array, "csv": iter_csv_bills}
+
+
+def clean_bill(bill):
+    """Check a bill read from an imported file and return its date.
+
+    Raise ValueError with an explanation if the bill is invalid.
+    """
+    if not isinstance(bill, dict):
+        raise ValueError("a bill must be an object")
+    if None in bill:
+        # Values of a csv row which has more fields than the header
+        raise ValueError("too many fields")
+    missing = BILL_ATTRIBUTES - bill.keys()
+    if missing:
+        raise ValueError(f"missing {', '.join(sorted(missing))}")
+    unknown = bill.keys() - BILL_ATTRIBUTES
+    if unknown:
+        raise ValueError(f"unknown {', '.join(sorted(unknown))}")
+
+    for attr in ("what", "payer_name"):
+        if not isinstance(bill[attr], str) or not bill[attr]:
+            raise ValueError(f"{attr} must be a non empty string")
+    for attr in ("amount", "payer_weight"):
+        if not isinstance(bill[attr], Real) or isinstance(bill[attr], bool):
+            raise ValueError(f"{attr} must be a number")
+    if bill["payer_weight"] <= 0:
+        raise ValueError("payer_weight must be positive")
+    owers = bill["owers"]
+    if (
+        not isinstance(owers, list)
+        or not owers
+        or not all(isinstance(ower, str) and ower for ower in owers)
+    ):
+        raise ValueError("owers must be a non empty list of names")
+
+    try:
+        # Exported dates are in ISO format, dateutil is much slower
+        return datetime.strptime(bill["date"], "%Y-%m-%d").date()
+    except (TypeError, ValueError):
+        pass
+    try:
+        return parse(bill["date"]).date()
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError(f"invalid date {bill['date']!r}")
+
+
+class BillImporter:
+    """Import bills, as exported by Project.iter_pretty_bills(), into a
+    project.
+
+    The bills already in the project are skipped. The members which are not
+    in the project yet are created, with the weight they have as payers.
+
+    :progress: called with the ImportReport after each batch of bills.
+    """
+
+    def __init__(
+        self,
+        project,
+        batch_size=IMPORT_BATCH_SIZE,
+        max_errors=IMPORT_MAX_ERRORS,
+        progress=None,
+    ):
+        self.project = project
+        self.batch_size = batch_size
+        self.max_errors = max_errors
+        self.progress = progress
+        self.existing_bills = {bill_key(bill) for bill in project.iter_pretty_bills()}
+        self.members = {member.name: member for member in project.members}
+        # Members created by this import which have not been seen as payers,
+        # their weight is not known yet
+        self.weightless_members = set()
+
+    def run(self, bills):
+        """Import the given bills, then commit.
+
+        If some bills are invalid, roll back and raise InvalidImport.
+        """
+        report = ImportReport()
+        batch = []
+        try:
+            for row, bill in enumerate(bills, 1):
+                report.rows = row
+                try:
+                    date = clean_bill(bill)
+                except ValueError as e:
+                    report.errors.append(RowError(row, str(e)))
+                    if len(report.errors) >= self.max_errors:
+                        break
+                    continue
+                if report.errors:
+                    # Nothing will be imported, only look for other errors
+                    continue
+
+                if bill_key(bill) in self.existing_bills:
+                    report.duplicates += 1
+                    continue
+                batch.append((bill, date))
+                if len(batch) >= self.batch_size:
+                    self.write(batch, report)
+                    batch = []
+
+            if report.errors:
+                raise InvalidImport(report.errors)
+            if batch:
+                self.write(batch, report)
+            if report.added:
+                # Bills are inserted without the ORM, which does not notice
+                bump_revisions(db.session, [self.project.id], ("bills_revision",))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return report
+
+    def add_member(self, name, weight, report):
+        member = self.members.get(name)
+        if member is None:
+            member = Person(name=name, weight=weight or 1, project=self.project)
+            db.session.add(member)
+            self.members[name] = member
+            report.members_added += 1
+            if weight is None:
+                self.weightless_members.add(name)
+        elif weight is not None and name in self.weightless_members:
+            member.weight = weight
+            self.weightless_members.discard(name)
+
+    def insert_bills(self, bills):
+        """Insert bills with a single executemany statement, and set their ids.
+
+        Databases do not return the ids of the rows inserted by executemany:
+        they are read back, in insertion order, with a unique value stored in
+        external_link meanwhile.
+        """
+        table = Bill.__table__
+        marker = f"import:{uuid.uuid4().hex}"
+        db.session.execute(
+            table.insert(), [dict(bill, external_link=marker) for bill in bills]
+        )
+        inserted = sa.and_(
+            # Uses the index of the payers
+            table.c.payer_id.in_({bill["payer_id"] for bill in bills}),
+            table.c.external_link == marker,
+        )
+        ids = db.session.execute(
+            sa.select([table.c.id]).where(inserted).order_by(table.c.id)
+        )
+        for bill, (bill_id,) in zip(bills, ids):
+            bill["id"] = bill_id
+        db.session.execute(table.update().where(inserted).values(external_link=""))
+
+    def write(self, batch, report):
+        """Insert a batch of bills, creating their missing members first"""
+        for bill, _ in batch:
+            self.add_member(bill["payer_name"], bill["payer_weight"], report)
+        for bill, _ in batch:
+            for ower in bill["owers"]:
+                self.add_member(ower, None, report)
+        # Get the ids of the new members
+        db.session.flush()
+
+        now = datetime.now()
+        bills = [
+            {
+                "payer_id": self.members[bill["payer_name"]].id,
+                "amount": bill["amount"],
+                "date": date,
+                "creation_date": now,
+                "what": bill["what"],
+                "external_link": "",
+                # Exports have no currency, there is nothing to convert
+                "original_currency": CurrencyConverter.no_currency,
+                "converted_amount": bill["amount"],
+            }
+            for bill, date in batch
+        ]
+        self.insert_bills(bills)
+        versioning_manager.bulk_insert_versions(db.session, Bill, bills)
+        owers = [
+            {"bill_id": row["id"], "person_id": self.members[ower].id}
+            for row, (bill, _) in zip(bills, batch)
+            for ower in dict.fromkeys(bill["owers"])
+        ]
+        versioning_manager.bulk_insert_associations(db.session, billowers, owers)
+
+        report.added += len(batch)
+        if self.progress:
+            self.progress(report)
@@ -1,17 +1,41 @@
 #!/usr/bin/env python
 
 import getpass
+import gzip
+import json
+import multiprocessing
 import os
 import random
 import sys
+import time
 
-from flask_migrate import Migrate, MigrateCommand
 from flask_script import Command, Manager, Option
 from werkzeug.security import generate_password_hash
 
+from ihatemoney.analytics import DORMANT_DAYS, SORT_COLUMNS, iter_project_stats
+from ihatemoney.checks import iter_problems, repair_problems
 from ihatemoney.models import Project, db
+from ihatemoney.parallel import PROJECTS_CHUNK_SIZE
 from ihatemoney.run import create_app
-from ihatemoney.utils import create_jinja_env
+from ihatemoney.snapshots import SnapshotRestorer, iter_snapshot
+from ihatemoney.utils import create_jinja_env, iter_dicts2csv, iter_dicts2json
+
+
+class MigrateDatabase(Command):
+    """Perform database migrations"""
+
+    # Alembic is slow to import: only load it when the command runs, and hand
+    # it all the arguments, --help included
+    capture_all_args = True
+    help_args = ()
+
+    def __call__(self, app, args):
+        from flask_migrate import Migrate, MigrateCommand
+
+        Migrate(app, db)
+        manager = Manager(app, with_default_commands=False)
+        manager.add_command("db", MigrateCommand)
+        return manager.handle(sys.argv[0], ["db"] + args)
 
 
 class GeneratePasswordHash(Command):
@@ -67,10 +91,177 @@ class GenerateConfig(Command):
 
 
 class DeleteProject(Command):
-    def run(self, project_name):
-        demo_project = Project.query.get(project_name)
-        db.session.delete(demo_project)
-        db.session.commit()
+
+    """Delete a project, its members and bills, and optionally its history."""
+
+    def get_options(self):
+        return [
+            Option("project_name"),
+            Option(
+                "--purge-history",
+                action="store_true",
+                help="Also delete the history of the project",
+            ),
+        ]
+
+    def run(self, project_name, purge_history=False):
+        project = Project.query.get(project_name)
+        if project is None:
+            print(f"No such project: {project_name}", file=sys.stderr)
+            return 1
+        project.remove_project(purge_history)
+
+
+def all_project_ids():
+    """Return the ids of every project, in order"""
+    return [
+        project_id for project_id, in db.session.query(Project.id).order_by(Project.id)
+    ]
+
+
+def open_snapshot(path, mode):
+    """Open a snapshot file in text mode, gzipped if its name ends with .gz"""
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+class DumpProjects(Command):
+
+    """Write a snapshot of projects, with their history, to a file."""
+
+    def get_options(self):
+        return [
+            Option("output", help="Snapshot file, gzipped if it ends with .gz"),
+            Option("project_ids", nargs="*", help="Projects to dump, default all"),
+        ]
+
+    def run(self, output, project_ids):
+        if not project_ids:
+            project_ids = all_project_ids()
+        with open_snapshot(output, "w") as snapshot:
+            snapshot.writelines(iter_snapshot(project_ids))
+
+
+class RestoreProjects(Command):
+
+    """Restore the projects of a snapshot, with their history."""
+
+    def get_options(self):
+        return [
+            Option("input", help="Snapshot file, gzipped if it ends with .gz"),
+            Option(
+                "--rename",
+                action="append",
+                default=[],
+                metavar="OLD:NEW",
+                help="Restore project OLD as NEW",
+            ),
+        ]
+
+    def run(self, input, rename):
+        rename = dict(names.split(":", 1) for names in rename)
+        with open_snapshot(input, "r") as snapshot:
+            restored = SnapshotRestorer(rename).run(snapshot)
+        print(f"Restored {', '.join(restored)}", file=sys.stderr)
+
+
+class Analytics(Command):
+
+    """Write a report with statistics about every project, as csv or json."""
+
+    def get_options(self):
+        return [
+            Option("output", help="Report file, its extension gives the format"),
+            Option(
+                "--processes",
+                type=int,
+                default=multiprocessing.cpu_count(),
+                help="Number of worker processes",
+            ),
+            Option("--chunk-size", type=int, default=PROJECTS_CHUNK_SIZE),
+            Option("--sort", choices=SORT_COLUMNS, default="bills"),
+            Option("--dormant-days", type=int, default=DORMANT_DAYS),
+        ]
+
+    def run(self, output, processes, chunk_size, sort, dormant_days):
+        encode = iter_dicts2csv if output.endswith(".csv") else iter_dicts2json
+        project_ids = all_project_ids()
+        db.session.remove()
+
+        start = time.perf_counter()
+        rows = iter_project_stats(
+            db.engine, project_ids, processes, chunk_size, dormant_days=dormant_days
+        )
+        rows = sorted(rows, key=lambda row: (-row[sort], row["project_id"]))
+        elapsed = time.perf_counter() - start
+
+        with open(output, "wb") as report:
+            report.writelines(encode(rows))
+        print(
+            f"{len(rows)} projects in {elapsed:.1f}s "
+            f"({len(rows) / max(elapsed, 1e-6):.0f} projects/s)",
+            file=sys.stderr,
+        )
+
+
+class Check(Command):
+
+    """Check the integrity of the database, and optionally repair it.
+
+    Exit with status 1 if problems remain.
+    """
+
+    def get_options(self):
+        return [
+            Option("--repair", action="store_true", help="Repair what can be"),
+            Option("--output", help="Write the problems found as json to this file"),
+            Option(
+                "--processes",
+                type=int,
+                default=multiprocessing.cpu_count(),
+                help="Number of worker processes",
+            ),
+            Option("--chunk-size", type=int, default=PROJECTS_CHUNK_SIZE),
+        ]
+
+    def run(self, repair, output, processes, chunk_size):
+        project_ids = all_project_ids()
+        db.session.remove()
+
+        start = time.perf_counter()
+        problems = list(iter_problems(db.engine, project_ids, processes, chunk_size))
+        elapsed = time.perf_counter() - start
+        counts = {}
+        for problem in problems:
+            counts[problem["check"]] = counts.get(problem["check"], 0) + 1
+        print(
+            f"Checked {len(project_ids)} projects in {elapsed:.1f}s "
+            f"({len(project_ids) / max(elapsed, 1e-6):.0f} projects/s)",
+            file=sys.stderr,
+        )
+        for check, count in sorted(counts.items()):
+            print(f"{check}: {count}", file=sys.stderr)
+
+        repaired = {}
+        if repair and problems:
+            repaired = repair_problems(problems)
+            for check, count in sorted(repaired.items()):
+                print(f"{check}: {count} repaired", file=sys.stderr)
+
+        if output:
+            with open(output, "w") as report:
+                json.dump(
+                    {
+                        "projects": len(project_ids),
+                        "elapsed": round(elapsed, 3),
+                        "problems": problems,
+                        "repaired": repaired,
+                    },
+                    report,
+                    indent=2,
+                )
+        return int(sum(counts.values()) > sum(repaired.values()))
 
 
 def main():
@@ -85,7 +276,6 @@ def main():
 
     try:
         app = create_app()
-        Migrate(app, db)
     except Exception as e:
         exception = e
 
@@ -96,10 +286,14 @@ def main():
         raise exception
 
     manager = Manager(app)
-    manager.add_command("db", MigrateCommand)
+    manager.add_command("db", MigrateDatabase)
     manager.add_command("generate_password_hash", GeneratePasswordHash)
     manager.add_command("generate-config", GenerateConfig)
     manager.add_command("delete-project", DeleteProject)
+    manager.add_command("dump-projects", DumpProjects)
+    manager.add_command("restore-projects", RestoreProjects)
+    manager.add_command("analytics", Analytics)
+    manager.add_command("check", Check)
     manager.run()
 
 
@@ -0,0 +1,37 @@
+"""Add indexes on foreign keys and bill dates
+
+Revision ID: 00cb77188696
+Revises: 927ed575acbd
+Create Date: 2026-10-18 21:45:12.530415
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "00cb77188696"
+down_revision = "927ed575acbd"
+
+from alembic import op
+import sqlalchemy as sa
+
+# (table, column) couples to index. Version tables already have indexes on
+# transaction_id, end_transaction_id and operation_type.
+INDEXES = [
+    ("bill", "payer_id"),
+    ("bill", "date"),
+    ("billowers", "person_id"),
+    ("person", "project_id"),
+    ("bill_version", "payer_id"),
+    ("bill_version", "date"),
+    ("billowers_version", "person_id"),
+    ("person_version", "project_id"),
+]
+
+
+def upgrade():
+    for table, column in INDEXES:
+        op.create_index(op.f(f"ix_{table}_{column}"), table, [column], unique=False)
+
+
+def downgrade():
+    for table, column in reversed(INDEXES):
+        op.drop_index(op.f(f"ix_{table}_{column}"), table_name=table)
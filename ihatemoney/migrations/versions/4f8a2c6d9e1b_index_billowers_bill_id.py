@@ -0,0 +1,26 @@
+"""Add an index on billowers.bill_id
+
+Revision ID: 4f8a2c6d9e1b
+Revises: 00cb77188696
+Create Date: 2026-10-18 21:46:03.418207
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "4f8a2c6d9e1b"
+down_revision = "00cb77188696"
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # The billowers table created by the migrations has no primary key, so
+    # the owers of a bill could only be found by scanning the whole table.
+    op.create_index(
+        op.f("ix_billowers_bill_id"), "billowers", ["bill_id"], unique=False
+    )
+
+
+def downgrade():
+    op.drop_index(op.f("ix_billowers_bill_id"), table_name="billowers")
@@ -0,0 +1,53 @@
+"""Add project.revision
+
+Revision ID: 5d8e2a4c6f1b
+Revises: 9c3e1f7a2b5d
+Create Date: 2026-10-18 23:52:40.107365
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "5d8e2a4c6f1b"
+down_revision = "9c3e1f7a2b5d"
+
+import random
+
+from alembic import op
+import sqlalchemy as sa
+
+project_helper = sa.Table(
+    "project",
+    sa.MetaData(),
+    sa.Column("id", sa.String(length=64), nullable=False),
+    sa.Column("revision", sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint("id"),
+)
+
+
+def upgrade():
+    # Not versioned: it changes with the project and its members, to tell
+    # when the cached copies are stale
+    op.add_column(
+        "project",
+        sa.Column("revision", sa.BigInteger(), nullable=False, server_default="0"),
+    )
+
+    # Random values, as the new projects get, so that the copies cached
+    # before another upgrade or a restore are not taken for the current ones
+    connection = op.get_bind()
+    revisions = [
+        {"project_id": project_id, "new_revision": random.getrandbits(62)}
+        for project_id, in connection.execute(sa.select([project_helper.c.id]))
+    ]
+    if revisions:
+        connection.execute(
+            project_helper.update()
+            .where(project_helper.c.id == sa.bindparam("project_id"))
+            .values(revision=sa.bindparam("new_revision")),
+            revisions,
+        )
+
+
+def downgrade():
+    with op.batch_alter_table("project") as batch_op:
+        batch_op.drop_column("revision")
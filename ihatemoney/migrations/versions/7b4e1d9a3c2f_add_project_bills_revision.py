@@ -0,0 +1,55 @@
+"""Add project.bills_revision
+
+Revision ID: 7b4e1d9a3c2f
+Revises: 5d8e2a4c6f1b
+Create Date: 2026-10-19 00:21:13.582904
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "7b4e1d9a3c2f"
+down_revision = "5d8e2a4c6f1b"
+
+import random
+
+from alembic import op
+import sqlalchemy as sa
+
+project_helper = sa.Table(
+    "project",
+    sa.MetaData(),
+    sa.Column("id", sa.String(length=64), nullable=False),
+    sa.Column("bills_revision", sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint("id"),
+)
+
+
+def upgrade():
+    # Not versioned: it changes with the bills of the project, to tell when
+    # the cached fragments of the pages are stale
+    op.add_column(
+        "project",
+        sa.Column(
+            "bills_revision", sa.BigInteger(), nullable=False, server_default="0"
+        ),
+    )
+
+    # Random values, as the new projects get, so that the copies cached
+    # before another upgrade or a restore are not taken for the current ones
+    connection = op.get_bind()
+    revisions = [
+        {"project_id": project_id, "new_revision": random.getrandbits(62)}
+        for project_id, in connection.execute(sa.select([project_helper.c.id]))
+    ]
+    if revisions:
+        connection.execute(
+            project_helper.update()
+            .where(project_helper.c.id == sa.bindparam("project_id"))
+            .values(bills_revision=sa.bindparam("new_revision")),
+            revisions,
+        )
+
+
+def downgrade():
+    with op.batch_alter_table("project") as batch_op:
+        batch_op.drop_column("bills_revision")
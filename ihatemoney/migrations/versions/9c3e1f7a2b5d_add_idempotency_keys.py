@@ -0,0 +1,38 @@
+"""Add the idempotency_key table
+
+Revision ID: 9c3e1f7a2b5d
+Revises: 4f8a2c6d9e1b
+Create Date: 2026-10-18 23:35:12.582044
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "9c3e1f7a2b5d"
+down_revision = "4f8a2c6d9e1b"
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        "idempotency_key",
+        sa.Column("project_id", sa.String(length=64), nullable=False),
+        sa.Column("key", sa.String(length=255), nullable=False),
+        sa.Column("fingerprint", sa.String(length=40), nullable=False),
+        sa.Column("status", sa.SmallInteger(), nullable=True),
+        sa.Column("response", sa.UnicodeText(), nullable=True),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("project_id", "key"),
+    )
+    op.create_index(
+        op.f("ix_idempotency_key_created_at"),
+        "idempotency_key",
+        ["created_at"],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.drop_index(op.f("ix_idempotency_key_created_at"), table_name="idempotency_key")
+    op.drop_table("idempotency_key")
@@ -1,9 +1,12 @@
 from collections import defaultdict
 from datetime import datetime
+import itertools
+import random
+import threading
 
 from debts import settle
 from flask import current_app, g
-from flask_sqlalchemy import BaseQuery, SQLAlchemy
+from flask_sqlalchemy import BaseQuery, SignallingSession, SQLAlchemy
 from itsdangerous import (
     BadSignature,
     SignatureExpired,
@@ -12,7 +15,6 @@ from itsdangerous import (
 )
 import sqlalchemy
 from sqlalchemy import orm
-from sqlalchemy.sql import func
 from sqlalchemy_continuum import make_versioned, version_class
 from sqlalchemy_continuum.plugins import FlaskPlugin
 
@@ -24,16 +26,18 @@ from ihatemoney.versioning import (
     version_privacy_predicate,
 )
 
+versioning_manager = ConditionalVersioningManager(
+    # Conditionally Disable the versioning based on each
+    # project's privacy preferences
+    tracking_predicate=version_privacy_predicate,
+    # Patch in a fix to a SQLAchemy-Continuum Bug.
+    # See patch_sqlalchemy_continuum.py
+    builder=PatchedBuilder(),
+)
+
 make_versioned(
     user_cls=None,
-    manager=ConditionalVersioningManager(
-        # Conditionally Disable the versioning based on each
-        # project's privacy preferences
-        tracking_predicate=version_privacy_predicate,
-        # Patch in a fix to a SQLAchemy-Continuum Bug.
-        # See patch_sqlalchemy_continuum.py
-        builder=PatchedBuilder(),
-    ),
+    manager=versioning_manager,
     plugins=[
         FlaskPlugin(
             # Redirect to our own function, which respects user preferences
@@ -46,7 +50,151 @@ make_versioned(
     ],
 )
 
-db = SQLAlchemy()
+# Pragmas set on each new SQLite connection, and the settings holding them
+SQLITE_PRAGMAS = {
+    "journal_mode": "SQLITE_JOURNAL_MODE",
+    "synchronous": "SQLITE_SYNCHRONOUS",
+    "busy_timeout": "SQLITE_BUSY_TIMEOUT",
+    "cache_size": "SQLITE_CACHE_SIZE",
+    "mmap_size": "SQLITE_MMAP_SIZE",
+}
+
+# Engine options holding the pragmas, until the engine is created
+SQLITE_PRAGMAS_OPTION = "ihatemoney_sqlite_pragmas"
+
+# Key of the session.info entry holding the ids of the projects and payers
+# changed by the current transaction, see bump_changed_projects()
+CHANGED_PROJECTS = "ihatemoney_changed_projects"
+
+
+class RevisionsSession(SignallingSession):
+    """Session which bumps the revisions of the projects it changes, see
+    bump_changed_projects()
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Like the signals of Flask-SQLAlchemy, the listeners are registered on
+        # each session: with SQLAlchemy 1.3, listening to the class hides the
+        # listeners of orm.Session for the same events
+        sqlalchemy.event.listen(self, "after_flush", collect_changed_projects)
+        sqlalchemy.event.listen(self, "before_commit", bump_changed_projects)
+        sqlalchemy.event.listen(self, "after_transaction_end", forget_changed_projects)
+
+
+class ConfiguredSQLAlchemy(SQLAlchemy):
+    """Apply the DATABASE_POOL_* and SQLITE_* settings to the engine, and use
+    RevisionsSession
+    """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RevisionsSession, db=self, **options)
+
+    def apply_pool_defaults(self, app, options):
+        super().apply_pool_defaults(app, options)
+        for option, setting in (
+            ("pool_size", "DATABASE_POOL_SIZE"),
+            ("pool_recycle", "DATABASE_POOL_RECYCLE"),
+        ):
+            if app.config.get(setting) is not None:
+                options[option] = app.config[setting]
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        super().apply_driver_hacks(app, sa_url, options)
+        if sa_url.drivername != "sqlite":
+            return
+        if options.get("poolclass") is sqlalchemy.pool.StaticPool:
+            # In memory databases live in a single connection
+            options.pop("pool_size", None)
+            options.pop("pool_recycle", None)
+        elif "pool_size" in options:
+            # SQLite files are not pooled by default. Pooled connections are
+            # used by a thread at a time, but not always by the one which
+            # opened them.
+            options["poolclass"] = sqlalchemy.pool.QueuePool
+            options.setdefault("connect_args", {})["check_same_thread"] = False
+        options[SQLITE_PRAGMAS_OPTION] = {
+            pragma: app.config[setting]
+            for pragma, setting in SQLITE_PRAGMAS.items()
+            if app.config.get(setting) is not None
+        }
+
+    def create_engine(self, sa_url, engine_opts):
+        pragmas = engine_opts.pop(SQLITE_PRAGMAS_OPTION, None)
+        engine = super().create_engine(sa_url, engine_opts)
+        if pragmas:
+
+            @sqlalchemy.event.listens_for(engine, "connect")
+            def set_pragmas(dbapi_connection, connection_record):
+                cursor = dbapi_connection.cursor()
+                for pragma, value in pragmas.items():
+                    cursor.execute(f"PRAGMA {pragma} = {value}")
+                cursor.close()
+
+        return engine
+
+
+db = ConfiguredSQLAlchemy()
+
+
+def new_revision():
+    return random.getrandbits(62)
+
+
+def get_table(name):
+    """Return a table, for the statements written without the ORM"""
+    return db.metadata.tables[name]
+
+
+def bump_revisions(connection, project_ids, columns=("revision",)):
+    """Give a new revision to the given projects, so that the cached copies of
+    the projects and their members are not used anymore (see ihatemoney.cache).
+    The "bills_revision" column does the same for the cached fragments of the
+    pages, which also depend on the bills.
+
+    Only changes made through the ORM are noticed: call this after changing
+    projects, members or bills with other statements.
+    """
+    if project_ids:
+        table = Project.__table__
+        connection.execute(
+            table.update()
+            .where(table.c.id.in_(sorted(project_ids)))
+            .values({column: new_revision() for column in columns})
+        )
+
+
+def history_criteria(project_id):
+    """Return the criteria selecting the history of a project, by table: the
+    rows of the version tables, and the transactions they belong to.
+    """
+    project_version, person_version, bill_version, billowers_version = (
+        get_table(f"{name}_version")
+        for name in ("project", "person", "bill", "billowers")
+    )
+    # Members and bills which have been deleted only remain here
+    members = sqlalchemy.select([person_version.c.id]).where(
+        person_version.c.project_id == project_id
+    )
+    bills = sqlalchemy.select([bill_version.c.id]).where(
+        bill_version.c.payer_id.in_(members)
+    )
+    criteria = {
+        "billowers_version": billowers_version.c.bill_id.in_(bills),
+        "bill_version": bill_version.c.payer_id.in_(members),
+        "person_version": person_version.c.project_id == project_id,
+        "project_version": project_version.c.id == project_id,
+    }
+    # Transactions are made within a single project
+    transactions = sqlalchemy.union(
+        *(
+            sqlalchemy.select([get_table(name).c[column]]).where(criterion)
+            for name, criterion in criteria.items()
+            for column in ("transaction_id", "end_transaction_id")
+        )
+    )
+    criteria["transaction"] = get_table("transaction").c.id.in_(transactions)
+    return criteria
 
 
 class Project(db.Model):
@@ -54,10 +202,54 @@ class Project(db.Model):
         def get_by_name(self, name):
             return Project.query.filter(Project.name == name).one()
 
+        def with_stats(self):
+            """Select the id and name of the projects, along with their number
+            of members and bills, and the dates of their oldest and newest
+            bills, all with a single query.
+            """
+            members = (
+                db.session.query(
+                    Person.project_id, sqlalchemy.func.count(Person.id).label("count")
+                )
+                .group_by(Person.project_id)
+                .subquery()
+            )
+            bills = (
+                db.session.query(
+                    Person.project_id,
+                    sqlalchemy.func.count(Bill.id).label("count"),
+                    sqlalchemy.func.min(Bill.date).label("oldest"),
+                    sqlalchemy.func.max(Bill.date).label("newest"),
+                )
+                .join(Bill, Bill.payer_id == Person.id)
+                .group_by(Person.project_id)
+                .subquery()
+            )
+            return (
+                self.with_entities(Project.id, Project.name)
+                .outerjoin(members, members.c.project_id == Project.id)
+                .outerjoin(bills, bills.c.project_id == Project.id)
+                .add_columns(
+                    sqlalchemy.func.coalesce(members.c.count, 0).label("members_count"),
+                    sqlalchemy.func.coalesce(bills.c.count, 0).label("bills_count"),
+                    bills.c.newest.label("newest_bill"),
+                    bills.c.oldest.label("oldest_bill"),
+                )
+            )
+
     # Direct SQLAlchemy-Continuum to track changes to this model
-    __versioned__ = {}
+    __versioned__ = {"exclude": ["revision", "bills_revision"]}
 
     id = db.Column(db.String(64), primary_key=True)
+    # Changes with the attributes of the project and of its members, see
+    # bump_revisions()
+    revision = db.Column(
+        db.BigInteger, default=new_revision, nullable=False, server_default="0"
+    )
+    # Changes with the bills of the project and their owers
+    bills_revision = db.Column(
+        db.BigInteger, default=new_revision, nullable=False, server_default="0"
+    )
 
     name = db.Column(db.UnicodeText)
     password = db.Column(db.String(128))
@@ -92,6 +284,13 @@ class Project(db.Model):
 
         return obj
 
+    @property
+    def data_revision(self):
+        """Identifies the state of the project, its members and its bills, for
+        the cached fragments of the pages
+        """
+        return f"{self.id}:{self.revision}:{self.bills_revision}"
+
     @property
     def active_members(self):
         return [m for m in self.members if m.activated]
@@ -101,20 +300,18 @@ class Project(db.Model):
 
         balances, should_pay, should_receive = (defaultdict(int) for time in (1, 2, 3))
 
-        # for each person
-        for person in self.members:
-            # get the list of bills he has to pay
-            bills = Bill.query.options(orm.subqueryload(Bill.owers)).filter(
-                Bill.owers.contains(person)
-            )
-            for bill in bills.all():
-                if person != bill.payer:
+        # Load all the bills with their owers at once, shares are then
+        # computed in memory
+        bills = self.get_bills().options(orm.subqueryload(Bill.owers))
+        for bill in bills:
+            for person in bill.owers:
+                if person.id != bill.payer_id:
                     share = bill.pay_each() * person.weight
-                    should_pay[person] += share
-                    should_receive[bill.payer] += share
+                    should_pay[person.id] += share
+                    should_receive[bill.payer_id] += share
 
         for person in self.members:
-            balance = should_receive[person] - should_pay[person]
+            balance = should_receive[person.id] - should_pay[person.id]
             balances[person.id] = balance
 
         return balances
@@ -220,10 +417,7 @@ class Project(db.Model):
     def get_bills(self):
         """Return the list of bills related to this project"""
         return (
-            Bill.query.join(Person, Project)
-            .filter(Bill.payer_id == Person.id)
-            .filter(Person.project_id == Project.id)
-            .filter(Project.id == self.id)
+            Bill.query.for_project(self)
             .order_by(Bill.date.desc())
             .order_by(Bill.creation_date.desc())
             .order_by(Bill.id.desc())
@@ -232,36 +426,74 @@ class Project(db.Model):
     def get_member_bills(self, member_id):
         """Return the list of bills related to a specific member"""
         return (
-            Bill.query.join(Person, Project)
-            .filter(Bill.payer_id == Person.id)
-            .filter(Person.project_id == Project.id)
+            Bill.query.for_project(self)
             .filter(Person.id == member_id)
-            .filter(Project.id == self.id)
             .order_by(Bill.date.desc())
             .order_by(Bill.id.desc())
         )
 
     def get_pretty_bills(self, export_format="json"):
         """Return a list of project's bills with pretty formatting"""
-        bills = self.get_bills()
-        pretty_bills = []
-        for bill in bills:
+        return list(self.iter_pretty_bills(export_format))
+
+    def iter_pretty_bills(self, export_format="json", batch_size=1000):
+        """Yield the project's bills with pretty formatting, one by one.
+
+        The ids of the bills are read first, then the bills are fetched by
+        batches of `batch_size` ids, with their payer, and the owers of each
+        batch with a single query. No query stays open between two batches.
+        """
+        names = {member.id: member.name for member in self.members}
+        bill_ids = [bill_id for bill_id, in self.get_bills().with_entities(Bill.id)]
+        for start in range(0, len(bill_ids), batch_size):
+            ids = bill_ids[start : start + batch_size]
+            bills = {
+                bill.id: bill
+                for bill in self.get_bills()
+                .with_entities(
+                    Bill.id,
+                    Bill.what,
+                    Bill.amount,
+                    Bill.date,
+                    Person.name,
+                    Person.weight,
+                )
+                .filter(Bill.id.in_(ids))
+            }
+            # Bills deleted in the meantime are skipped
+            batch = [bills[bill_id] for bill_id in ids if bill_id in bills]
+            yield from self._prettify_bills(batch, names, export_format)
+
+    @staticmethod
+    def _prettify_bills(bills, names, export_format):
+        if not bills:
+            return
+        owers = defaultdict(list)
+        query = (
+            db.session.query(billowers.c.bill_id, billowers.c.person_id)
+            .filter(billowers.c.bill_id.in_([bill.id for bill in bills]))
+            .order_by(billowers.c.bill_id, billowers.c.person_id)
+        )
+        for bill_id, person_id in query:
+            # Owers from other projects, which "ihatemoney check" reports,
+            # are left out
+            if person_id in names:
+                owers[bill_id].append(names[person_id])
+
+        for bill_id, what, amount, date, payer_name, payer_weight in bills:
             if export_format == "json":
-                owers = [ower.name for ower in bill.owers]
+                bill_owers = owers[bill_id]
             else:
-                owers = ", ".join([ower.name for ower in bill.owers])
-
-            pretty_bills.append(
-                {
-                    "what": bill.what,
-                    "amount": round(bill.amount, 2),
-                    "date": str(bill.date),
-                    "payer_name": Person.query.get(bill.payer_id).name,
-                    "payer_weight": Person.query.get(bill.payer_id).weight,
-                    "owers": owers,
-                }
-            )
-        return pretty_bills
+                bill_owers = ", ".join(owers[bill_id])
+
+            yield {
+                "what": what,
+                "amount": round(amount, 2),
+                "date": str(date),
+                "payer_name": payer_name,
+                "payer_weight": payer_weight,
+                "owers": bill_owers,
+            }
 
     def remove_member(self, member_id):
         """Remove a member from the project.
@@ -284,9 +516,85 @@ class Project(db.Model):
             db.session.commit()
         return person
 
-    def remove_project(self):
-        db.session.delete(self)
-        db.session.commit()
+    def remove_project(self, purge_history=False):
+        """Delete the project, its members, bills and archives with a few bulk
+        DELETE statements, in a single transaction.
+
+        Unlike db.session.delete(), the rows are neither loaded nor recorded
+        in the history. The existing history of the project is kept, unless
+        purge_history is set: its versions and transactions are then deleted
+        as well.
+        """
+        project, person, bill, billowers, archive = (
+            get_table(name)
+            for name in ("project", "person", "bill", "billowers", "archive")
+        )
+        members = sqlalchemy.select([person.c.id]).where(person.c.project_id == self.id)
+        bills = sqlalchemy.select([bill.c.id]).where(bill.c.payer_id.in_(members))
+        statements = [
+            billowers.delete().where(billowers.c.bill_id.in_(bills)),
+            bill.delete().where(bill.c.payer_id.in_(members)),
+            person.delete().where(person.c.project_id == self.id),
+            archive.delete().where(archive.c.project_id == self.id),
+        ]
+        if purge_history:
+            criteria = history_criteria(self.id)
+            # Transactions hold the IP addresses: remove them first, while
+            # their versions still exist
+            statements.append(
+                get_table("transaction").delete().where(criteria.pop("transaction"))
+            )
+            statements += [
+                get_table(name).delete().where(criterion)
+                for name, criterion in criteria.items()
+            ]
+        statements.append(project.delete().where(project.c.id == self.id))
+
+        try:
+            with versioning_manager.versioning_disabled(db.session):
+                for statement in statements:
+                    db.session.execute(statement)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+    def remove_project_in_background(self, purge_history=False):
+        """Delete the project in a separate thread, with its own session, and
+        return the started thread. Meant for projects too large to be deleted
+        within a request.
+
+        The thread does not hold up the shutdown of the process: a deletion
+        which is interrupted is rolled back, the project is left untouched.
+        Failures are logged.
+        """
+        # ihatemoney.transactions imports the models
+        from ihatemoney.transactions import run_transaction
+
+        app = current_app._get_current_object()
+        project_id = self.id
+
+        def remove():
+            with app.app_context():
+                try:
+                    project = Project.query.get(project_id)
+                    if project is not None:
+                        run_transaction(lambda: project.remove_project(purge_history))
+                except Exception:
+                    app.logger.exception("Could not remove project %s", project_id)
+
+        thread = threading.Thread(
+            target=remove, name=f"remove-{project_id}", daemon=True
+        )
+        thread.start()
+        return thread
+
+    def should_remove_in_background(self):
+        """Whether the project should be deleted in the background, according
+        to the BACKGROUND_DELETION_THRESHOLD setting
+        """
+        threshold = current_app.config.get("BACKGROUND_DELETION_THRESHOLD")
+        return bool(threshold) and Bill.query.for_project(self).count() >= threshold
 
     def generate_token(self, expiration=0):
         """Generate a timed and serialized JsonWebToken
@@ -333,21 +641,39 @@ class Project(db.Model):
 
 class Person(db.Model):
     class PersonQuery(BaseQuery):
+        def for_project(self, project):
+            """Restrict the query to the members of the given project"""
+            return self.filter(Person.project_id == project.id)
+
         def get_by_name(self, name, project):
-            return (
-                Person.query.filter(Person.name == name)
-                .filter(Project.id == project.id)
-                .one()
-            )
+            return self.for_project(project).filter(Person.name == name).one()
 
         def get(self, id, project=None):
             if not project:
                 project = g.project
-            return (
-                Person.query.filter(Person.id == id)
-                .filter(Project.id == project.id)
-                .one()
-            )
+            return self.for_project(project).filter(Person.id == id).one()
+
+        def get_by_ids(self, ids, project=None):
+            """Return the members with the given ids, in the same order.
+
+            All the members are fetched with a single query. Raise
+            NoResultFound if one of them is not a member of the project.
+            """
+            if not project:
+                project = g.project
+            ids = list(dict.fromkeys(ids))
+            if not ids:
+                return []
+            members = {
+                member.id: member
+                for member in self.for_project(project).filter(Person.id.in_(ids))
+            }
+            missing = [id for id in ids if id not in members]
+            if missing:
+                raise orm.exc.NoResultFound(
+                    f"No member {missing} in project {project.id}"
+                )
+            return [members[id] for id in ids]
 
     query_class = PersonQuery
 
@@ -357,7 +683,7 @@ class Person(db.Model):
     __table_args__ = {"sqlite_autoincrement": True}
 
     id = db.Column(db.Integer, primary_key=True)
-    project_id = db.Column(db.String(64), db.ForeignKey("project.id"))
+    project_id = db.Column(db.String(64), db.ForeignKey("project.id"), index=True)
     bills = db.relationship("Bill", backref="payer")
 
     name = db.Column(db.UnicodeText)
@@ -392,24 +718,34 @@ class Person(db.Model):
 # We need to manually define a join table for m2m relations
 billowers = db.Table(
     "billowers",
-    db.Column("bill_id", db.Integer, db.ForeignKey("bill.id"), primary_key=True),
-    db.Column("person_id", db.Integer, db.ForeignKey("person.id"), primary_key=True),
+    db.Column(
+        "bill_id", db.Integer, db.ForeignKey("bill.id"), primary_key=True, index=True
+    ),
+    db.Column(
+        "person_id",
+        db.Integer,
+        db.ForeignKey("person.id"),
+        primary_key=True,
+        index=True,
+    ),
     sqlite_autoincrement=True,
 )
 
 
 class Bill(db.Model):
     class BillQuery(BaseQuery):
+        def for_project(self, project):
+            """Restrict the query to the bills of the given project.
+
+            Bills are bound to a project through their payer.
+            """
+            return self.join(Person, Bill.payer_id == Person.id).filter(
+                Person.project_id == project.id
+            )
+
         def get(self, project, id):
             try:
-                return (
-                    self.join(Person, Project)
-                    .filter(Bill.payer_id == Person.id)
-                    .filter(Person.project_id == Project.id)
-                    .filter(Project.id == project.id)
-                    .filter(Bill.id == id)
-                    .one()
-                )
+                return self.for_project(project).filter(Bill.id == id).one()
             except orm.exc.NoResultFound:
                 return None
 
@@ -428,11 +764,11 @@ class Bill(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
 
-    payer_id = db.Column(db.Integer, db.ForeignKey("person.id"))
+    payer_id = db.Column(db.Integer, db.ForeignKey("person.id"), index=True)
     owers = db.relationship(Person, secondary=billowers)
 
     amount = db.Column(db.Float)
-    date = db.Column(db.Date, default=datetime.now)
+    date = db.Column(db.Date, default=datetime.now, index=True)
     creation_date = db.Column(db.Date, default=datetime.now)
     what = db.Column(db.UnicodeText)
     external_link = db.Column(db.UnicodeText)
@@ -458,13 +794,13 @@ class Bill(db.Model):
         }
 
     def pay_each_default(self, amount):
-        """Compute what each share has to pay"""
+        """Compute what each share has to pay
+
+        The weights are summed from the owers relationship, so no query is
+        needed when the owers are already loaded.
+        """
         if self.owers:
-            weights = (
-                db.session.query(func.sum(Person.weight))
-                .join(billowers, Bill)
-                .filter(Bill.id == self.id)
-            ).scalar()
+            weights = sum(ower.weight for ower in self.owers)
             return amount / weights
         else:
             return 0
@@ -482,6 +818,30 @@ class Bill(db.Model):
         )
 
 
+class IdempotencyKey(db.Model):
+    """The response to an API request sent with an Idempotency-Key header,
+    replayed when the request is sent again with the same key.
+
+    The status is null while the first request is running. Keys expire after
+    IDEMPOTENCY_KEY_TTL seconds, or after a short lease while their status is
+    null.
+    """
+
+    __tablename__ = "idempotency_key"
+
+    # The requested identifier for the project creations
+    project_id = db.Column(db.String(64), primary_key=True)
+    key = db.Column(db.String(255), primary_key=True)
+    # Digest of the request, a key cannot be reused for another request
+    fingerprint = db.Column(db.String(40), nullable=False)
+    status = db.Column(db.SmallInteger)
+    response = db.Column(db.UnicodeText)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return f"<IdempotencyKey {self.key} of {self.project_id}>"
+
+
 class Archive(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     project_id = db.Column(db.String(64), db.ForeignKey("project.id"))
@@ -499,6 +859,67 @@ class Archive(db.Model):
         return "<Archive>"
 
 
+def collect_changed_projects(session, flush_context):
+    """Collect the projects whose attributes or members were changed by the
+    flush, and the payers of the changed bills
+    """
+    project_ids, payer_ids = session.info.setdefault(CHANGED_PROJECTS, (set(), set()))
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, Bill):
+            if obj not in session.dirty or session.is_modified(obj):
+                payer_ids.add(obj.payer_id)
+            continue
+        if not isinstance(obj, (Project, Person)):
+            continue
+        if obj in session.dirty and not session.is_modified(
+            obj, include_collections=False
+        ):
+            continue
+        project_ids.add(obj.id if isinstance(obj, Project) else obj.project_id)
+    project_ids.discard(None)
+    payer_ids.discard(None)
+
+
+def bump_changed_projects(session):
+    """Bump the revisions of the projects changed by the transaction, with a
+    single UPDATE statement
+    """
+    if session.transaction.nested:
+        return
+    # The final flush happens after the before_commit event, do it now so
+    # that no change is missed
+    session.flush()
+    project_ids, payer_ids = session.info.pop(CHANGED_PROJECTS, (set(), set()))
+
+    project, person = Project.__table__, Person.__table__
+    criteria = {}
+    if project_ids:
+        criteria["revision"] = project.c.id.in_(sorted(project_ids))
+    if payer_ids:
+        criteria["bills_revision"] = project.c.id.in_(
+            sqlalchemy.select([person.c.project_id]).where(
+                person.c.id.in_(sorted(payer_ids))
+            )
+        )
+    if not criteria:
+        return
+    revision = new_revision()
+    values = {
+        column: revision
+        if len(criteria) == 1
+        else sqlalchemy.case([(criterion, revision)], else_=project.c[column])
+        for column, criterion in criteria.items()
+    }
+    session.connection().execute(
+        project.update().where(sqlalchemy.or_(*criteria.values())).values(values)
+    )
+
+
+def forget_changed_projects(session, transaction):
+    if transaction.parent is None:
+        session.info.pop(CHANGED_PROJECTS, None)
+
+
 sqlalchemy.orm.configure_mappers()
 
 PersonVersion = version_class(Person)
@@ -0,0 +1,52 @@
+"""Run read-only queries over all the projects, chunk by chunk.
+
+Chunks can be processed by a pool of processes. Each worker creates its own
+engine: connections cannot be shared between processes.
+"""
+import multiprocessing
+
+import sqlalchemy as sa
+
+from ihatemoney.utils import chunked
+
+# Number of projects processed by each call, stays under the SQLite bound
+# parameters limit
+PROJECTS_CHUNK_SIZE = 500
+
+# Engine of each process of the pool
+worker_engine = None
+
+
+def init_worker(database_url):
+    global worker_engine
+    worker_engine = sa.create_engine(database_url)
+
+
+def run_chunk(task):
+    func, project_ids, kwargs = task
+    with worker_engine.connect() as connection:
+        return func(connection, project_ids, **kwargs)
+
+
+def map_project_chunks(
+    func, engine, project_ids, processes=1, chunk_size=PROJECTS_CHUNK_SIZE, **kwargs
+):
+    """Call func(connection, chunk, **kwargs) for each chunk of the given
+    projects, and yield the results.
+
+    With several processes, the results are yielded as soon as they are ready,
+    in no particular order. func must be defined at the top level of a module.
+    """
+    tasks = ((func, chunk, kwargs) for chunk in chunked(project_ids, chunk_size))
+    if processes <= 1:
+        with engine.connect() as connection:
+            for _, chunk, kwargs in tasks:
+                yield func(connection, chunk, **kwargs)
+        return
+
+    # The pool is forked: connections must not be shared with the workers
+    engine.dispose()
+    with multiprocessing.Pool(
+        processes, initializer=init_worker, initargs=(engine.url,)
+    ) as pool:
+        yield from pool.imap_unordered(run_chunk, tasks)
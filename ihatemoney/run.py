@@ -1,19 +1,25 @@
+from contextlib import contextmanager
+import gc
+import hashlib
 import os
 import os.path
+import re
+import tempfile
 import warnings
 
 from flask import Flask, g, render_template, request, session
 from flask_babel import Babel, format_currency
-from flask_mail import Mail
-from flask_migrate import Migrate, stamp, upgrade
+import sqlalchemy
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 from ihatemoney import default_settings
 from ihatemoney.api.v1 import api as apiv1
+from ihatemoney.cache import FragmentCacheExtension, ProjectCache, create_caches
 from ihatemoney.currency_convertor import CurrencyConverter
 from ihatemoney.models import db
 from ihatemoney.utils import (
     IhmJSONEncoder,
+    LazyMail,
     PrefixedWSGI,
     locale_from_iso,
     minimal_round,
@@ -21,6 +27,71 @@ from ihatemoney.utils import (
 )
 from ihatemoney.web import main as web_interface
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Identifiers of a migration script, see get_head_revisions()
+REVISION_RE = re.compile(r'^(revision|down_revision) = (?:"(\w+)"|None)$', re.M)
+
+
+def get_head_revisions(migrations_path):
+    """Return the head revisions of the migration scripts, read from their
+    identifiers: loading them all through Alembic is much slower.
+
+    Return None if a script cannot be understood, such as a merge.
+    """
+    revisions, down_revisions = set(), set()
+    versions_path = os.path.join(migrations_path, "versions")
+    for name in os.listdir(versions_path):
+        if not name.endswith(".py"):
+            continue
+        with open(os.path.join(versions_path, name), encoding="utf-8") as script:
+            identifiers = dict(REVISION_RE.findall(script.read()))
+        if set(identifiers) != {"revision", "down_revision"}:
+            return None
+        revisions.add(identifiers["revision"])
+        down_revisions.add(identifiers["down_revision"])
+    return revisions - down_revisions
+
+
+def is_database_current(migrations_path):
+    """Whether the database has been migrated to the head revisions, checked
+    with a single query
+    """
+    heads = get_head_revisions(migrations_path)
+    try:
+        with db.engine.connect() as connection:
+            current = {
+                revision
+                for revision, in connection.execute(
+                    "SELECT version_num FROM alembic_version"
+                )
+            }
+    except sqlalchemy.exc.DBAPIError:
+        # The database is new, or older than alembic
+        return False
+    return bool(heads) and current == heads
+
+
+@contextmanager
+def migrations_lock():
+    """Only let one process, such as a gunicorn worker, migrate the database
+    at a time. The lock is a file named after the database.
+    """
+    if fcntl is None:
+        yield
+        return
+    digest = hashlib.sha1(str(db.engine.url).encode("utf-8")).hexdigest()[:16]
+    path = os.path.join(tempfile.gettempdir(), f"ihatemoney-migrations-{digest}.lock")
+    with open(path, "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
 
 def setup_database(app):
     """Prepare the database. Create tables, run migrations etc."""
@@ -43,17 +114,28 @@ def setup_database(app):
     db.init_app(app)
     db.app = app
 
-    Migrate(app, db)
     migrations_path = os.path.join(app.root_path, "migrations")
 
-    if _pre_alembic_db():
-        with app.app_context():
-            # fake the first migration
-            stamp(migrations_path, revision="b9a10d5d63ce")
-
-    # auto-execute migrations on runtime
     with app.app_context():
-        upgrade(migrations_path)
+        # Most of the time, there is nothing to migrate: do not load Alembic
+        if is_database_current(migrations_path):
+            return
+
+        from flask_migrate import Migrate, stamp, upgrade
+
+        Migrate(app, db)
+
+        with migrations_lock():
+            # Another process may have migrated the database in the meantime
+            if is_database_current(migrations_path):
+                return
+
+            if _pre_alembic_db():
+                # fake the first migration
+                stamp(migrations_path, revision="b9a10d5d63ce")
+
+            # auto-execute migrations on runtime
+            upgrade(migrations_path)
 
 
 def load_configuration(app, configuration=None):
@@ -138,12 +220,12 @@ def create_app(
     # Configure the a, root="main"pplication
     setup_database(app)
 
-    # Setup Currency Cache
-    CurrencyConverter()
+    app.mail = LazyMail(app)
+
+    app.caches = create_caches(app)
+    app.project_cache = ProjectCache(app.caches["projects"])
 
-    mail = Mail()
-    mail.init_app(app)
-    app.mail = mail
+    app.jinja_env.add_extension(FragmentCacheExtension)
 
     # Jinja filters
     app.jinja_env.globals["static_include"] = static_include
@@ -183,6 +265,30 @@ def create_app(
     return app
 
 
+def prepare_fork(app):
+    """Get an application loaded before forking the workers, such as with
+    gunicorn --preload, ready to share its memory with them.
+
+    The connections opened so far are closed, the templates are compiled, and
+    the objects loaded so far are frozen: the garbage collector would
+    otherwise write to all of them, and copy their pages in every worker.
+    """
+    with app.app_context():
+        db.engine.dispose()
+    for template in app.jinja_env.list_templates(extensions=("html",)):
+        app.jinja_env.get_template(template)
+    gc.collect()
+    # Python >= 3.7
+    if hasattr(gc, "freeze"):
+        gc.freeze()
+
+
+def after_fork(app):
+    """Make sure a forked worker never uses the connections of its parent"""
+    with app.app_context():
+        db.engine.dispose()
+
+
 def main():
     app = create_app()
     app.run(host="0.0.0.0", debug=True)
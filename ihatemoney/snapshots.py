@@ -0,0 +1,329 @@
+"""Snapshots of whole projects, to move them between instances or restore them.
+
+A snapshot is a stream of json lines. Each project starts with a header line,
+followed by one line per database row: the project, its members, bills,
+owers and archives, as well as their history (the version tables and the
+transactions they belong to).
+
+Database ids are global to an instance, so they are not kept: new ids are
+allocated when restoring and every reference is updated accordingly.
+"""
+from datetime import date, datetime
+from enum import Enum
+from json import dumps, loads
+import uuid
+
+from dateutil.parser import parse
+import sqlalchemy as sa
+
+from ihatemoney.models import (
+    Project,
+    bump_revisions,
+    db,
+    get_table,
+    history_criteria,
+    versioning_manager,
+)
+
+SNAPSHOT_FORMAT = "ihatemoney-snapshot"
+SNAPSHOT_VERSION = 1
+
+# Number of rows written with each bulk insert
+RESTORE_BATCH_SIZE = 1000
+
+# Tables of a snapshot, in the order they are written and restored: a row
+# can only reference the rows of the previous tables. For each table, the
+# columns holding references to ids, and the table owning these ids.
+SNAPSHOT_TABLES = {
+    "transaction": {"id": "transaction"},
+    "project": {"id": "project"},
+    "project_version": {
+        "id": "project",
+        "transaction_id": "transaction",
+        "end_transaction_id": "transaction",
+    },
+    "archive": {"id": "archive", "project_id": "project"},
+    "person": {"id": "person", "project_id": "project"},
+    "person_version": {
+        "id": "person",
+        "project_id": "project",
+        "transaction_id": "transaction",
+        "end_transaction_id": "transaction",
+    },
+    "bill": {"id": "bill", "payer_id": "person", "archive": "archive"},
+    "bill_version": {
+        "id": "bill",
+        "payer_id": "person",
+        "archive": "archive",
+        "transaction_id": "transaction",
+        "end_transaction_id": "transaction",
+    },
+    "billowers": {"bill_id": "bill", "person_id": "person"},
+    "billowers_version": {
+        "bill_id": "bill",
+        "person_id": "person",
+        "transaction_id": "transaction",
+        "end_transaction_id": "transaction",
+    },
+}
+
+# Tables which allocate new ids when restoring
+ID_TABLES = ("transaction", "archive", "person", "bill")
+
+# Column of each of these tables holding a unique value while its rows are
+# inserted, to read their new ids back
+MARKER_COLUMNS = {
+    "transaction": "remote_addr",
+    "archive": "name",
+    "person": "name",
+    "bill": "external_link",
+}
+
+
+def project_queries(project_id):
+    """Return the query selecting the rows of each table of a project"""
+    tables = {name: get_table(name) for name in SNAPSHOT_TABLES}
+    person_ids = sa.select([tables["person"].c.id]).where(
+        tables["person"].c.project_id == project_id
+    )
+    bill_ids = sa.select([tables["bill"].c.id]).where(
+        tables["bill"].c.payer_id.in_(person_ids)
+    )
+    criteria = {
+        "project": tables["project"].c.id == project_id,
+        "archive": tables["archive"].c.project_id == project_id,
+        "person": tables["person"].c.project_id == project_id,
+        "bill": tables["bill"].c.id.in_(bill_ids),
+        "billowers": tables["billowers"].c.bill_id.in_(bill_ids),
+    }
+    criteria.update(history_criteria(project_id))
+
+    return {
+        name: sa.select([tables[name]])
+        .where(criteria[name])
+        .order_by(*tables[name].primary_key.columns)
+        for name in SNAPSHOT_TABLES
+    }
+
+
+def encode_value(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, Enum):
+        return value.name
+    return value
+
+
+def decode_value(column, value):
+    if value is None:
+        return None
+    if isinstance(column.type, sa.DateTime):
+        return parse(value)
+    if isinstance(column.type, sa.Date):
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    enum_class = getattr(column.type, "enum_class", None)
+    if enum_class is not None:
+        return enum_class[value]
+    return value
+
+
+def iter_snapshot(project_ids, batch_size=RESTORE_BATCH_SIZE):
+    """Yield the json lines of the snapshot of the given projects"""
+    for project_id in project_ids:
+        if Project.query.get(project_id) is None:
+            raise ValueError(f"Project {project_id} does not exist")
+        header = {
+            "format": SNAPSHOT_FORMAT,
+            "version": SNAPSHOT_VERSION,
+            "project": project_id,
+        }
+        yield dumps(header) + "\n"
+
+        queries = project_queries(project_id)
+        for name in SNAPSHOT_TABLES:
+            result = db.session.execute(
+                queries[name].execution_options(stream_results=True)
+            )
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    values = {key: encode_value(value) for key, value in row.items()}
+                    yield dumps({"table": name, "row": values}) + "\n"
+
+
+class SnapshotRestorer:
+    """Restore projects from a snapshot, in a single transaction.
+
+    The rows are inserted without going through the ORM, and versioning is
+    disabled: the history comes from the snapshot itself.
+
+    :rename: new ids of the restored projects, by original id.
+    """
+
+    def __init__(self, rename=None, batch_size=RESTORE_BATCH_SIZE):
+        self.rename = rename or {}
+        self.batch_size = batch_size
+        self.restored = []
+
+    def run(self, lines):
+        """Restore the projects of a snapshot, then commit.
+
+        Raise ValueError if the snapshot is invalid or if a project already
+        exists, in which case nothing is restored.
+        """
+        try:
+            with versioning_manager.versioning_disabled(db.session):
+                self.restore(lines)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return self.restored
+
+    def restore(self, lines):
+        self.start_project(None)
+        for line in lines:
+            if not line.strip():
+                continue
+            record = loads(line)
+            if "format" in record:
+                self.finish_project()
+                self.start_project(record)
+            elif self.project_id is None:
+                raise ValueError("Invalid snapshot: missing header")
+            else:
+                self.add_row(record["table"], record["row"])
+        self.finish_project()
+
+    def start_project(self, header):
+        # New ids of each table, by original id
+        self.ids = {name: {} for name in ID_TABLES}
+        self.ids["project"] = {}
+        # Rows waiting to be inserted, by table
+        self.pending = {}
+        # Rows inserted to reserve the ids of deleted objects
+        self.placeholders = {"person": [], "bill": []}
+        self.project_id = None
+        if header is None:
+            return
+
+        if header["format"] != SNAPSHOT_FORMAT:
+            raise ValueError("Invalid snapshot format")
+        if header["version"] > SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot version {header['version']}")
+        project_id = self.rename.get(header["project"], header["project"])
+        if Project.query.get(project_id) is not None:
+            raise ValueError(f"Project {project_id} already exists")
+        self.ids["project"][header["project"]] = project_id
+        self.project_id = project_id
+
+    def add_row(self, name, row):
+        if name not in SNAPSHOT_TABLES:
+            raise ValueError(f"Invalid snapshot: unknown table {name}")
+        table = get_table(name)
+        unknown = row.keys() - table.columns.keys()
+        if unknown:
+            raise ValueError(
+                f"Invalid snapshot: unknown columns {', '.join(sorted(unknown))}"
+            )
+        row = {
+            key: decode_value(table.columns[key], value) for key, value in row.items()
+        }
+        pending = self.pending.setdefault(name, [])
+        pending.append(row)
+        if len(pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Insert the pending rows, with one bulk insert per table"""
+        for name in SNAPSHOT_TABLES:
+            rows = self.pending.pop(name, None)
+            if not rows:
+                continue
+            if name in ID_TABLES:
+                old_ids = [row.pop("id") for row in rows]
+                self.remap(name, rows)
+                self.ids[name].update(zip(old_ids, self.insert_rows(name, rows)))
+            else:
+                self.remap(name, rows)
+                db.session.execute(get_table(name).insert(), rows)
+
+    def insert_rows(self, name, rows):
+        """Insert rows with a single executemany statement, and return their
+        new ids.
+
+        As in BillImporter.insert_bills, the ids are read back in insertion
+        order, with a unique value stored in one of the columns meanwhile.
+        """
+        table = get_table(name)
+        column = MARKER_COLUMNS[name]
+        marker = f"restore:{uuid.uuid4().hex}"
+        # Restricts the lookup of the marker to the new rows
+        last_id = db.session.execute(sa.select([sa.func.max(table.c.id)])).scalar()
+        db.session.execute(
+            table.insert(), [dict(row, **{column: marker}) for row in rows]
+        )
+        ids = [
+            row_id
+            for (row_id,) in db.session.execute(
+                sa.select([table.c.id])
+                .where(table.c.id > (last_id or 0))
+                .where(table.c[column] == marker)
+                .order_by(table.c.id)
+            )
+        ]
+        db.session.execute(
+            table.update()
+            .where(table.c.id == sa.bindparam("row_id"))
+            .values({column: sa.bindparam("marked_value")}),
+            [
+                {"row_id": row_id, "marked_value": row.get(column)}
+                for row_id, row in zip(ids, rows)
+            ],
+        )
+        return ids
+
+    def remap(self, name, rows):
+        references = SNAPSHOT_TABLES[name].items()
+        for column, id_table in references:
+            if id_table not in self.placeholders:
+                continue
+            missing = {
+                row[column] for row in rows if row.get(column) is not None
+            } - self.ids[id_table].keys()
+            if missing:
+                self.add_placeholders(id_table, sorted(missing))
+        for row in rows:
+            for column, id_table in references:
+                old_id = row.get(column)
+                if old_id is not None:
+                    row[column] = self.ids[id_table].get(old_id)
+
+    def add_placeholders(self, name, old_ids):
+        """Reserve new ids for objects which only remain in the history"""
+        values = {"project_id": self.project_id} if name == "person" else {}
+        new_ids = self.insert_rows(name, [dict(values) for _ in old_ids])
+        self.ids[name].update(zip(old_ids, new_ids))
+        self.placeholders[name].extend(new_ids)
+
+    def finish_project(self):
+        if self.project_id is None:
+            return
+        self.flush()
+        for name in ("bill", "person"):
+            table = get_table(name)
+            ids = self.placeholders[name]
+            for index in range(0, len(ids), self.batch_size):
+                db.session.execute(
+                    table.delete().where(
+                        table.c.id.in_(ids[index : index + self.batch_size])
+                    )
+                )
+        if Project.query.get(self.project_id) is None:
+            raise ValueError("Invalid snapshot: missing project")
+        # The snapshot holds the revision of the original project, whose
+        # members had other ids
+        bump_revisions(db.session, [self.project_id], ("revision", "bills_revision"))
+        self.restored.append(self.project_id)
@@ -0,0 +1,255 @@
+"""Benchmarks on a synthetic project, to be run by hand.
+
+    python -m ihatemoney.tests.benchmarks export --bills 100000
+
+They are not part of the test suite: they only print timings.
+"""
+import argparse
+import datetime
+import io
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+from flask_migrate import upgrade
+from werkzeug.security import generate_password_hash
+
+from ihatemoney import models
+from ihatemoney.analytics import iter_project_stats
+from ihatemoney.imports import IMPORT_FORMATS, BillImporter
+from ihatemoney.run import create_app, db
+from ihatemoney.utils import iter_dicts2csv, iter_dicts2json
+
+
+class BenchmarkConfig:
+    TESTING = True
+    SECRET_KEY = "BENCHMARK"
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    def __init__(self, database_uri, **settings):
+        self.SQLALCHEMY_DATABASE_URI = database_uri
+        for name, value in settings.items():
+            setattr(self, name, value)
+
+
+# Database settings compared by the writes benchmark
+WRITE_CONFIGURATIONS = {
+    "delete, full": {"SQLITE_JOURNAL_MODE": "DELETE", "SQLITE_SYNCHRONOUS": "FULL"},
+    "wal, full": {"SQLITE_JOURNAL_MODE": "WAL", "SQLITE_SYNCHRONOUS": "FULL"},
+    "wal, normal": {"SQLITE_JOURNAL_MODE": "WAL", "SQLITE_SYNCHRONOUS": "NORMAL"},
+    "wal, normal, pool": {
+        "SQLITE_JOURNAL_MODE": "WAL",
+        "SQLITE_SYNCHRONOUS": "NORMAL",
+        "DATABASE_POOL_SIZE": 5,
+    },
+}
+
+
+def populate(project_id="bench", members=10, bills=100000):
+    """Create a project with the given number of members and bills, the fast way"""
+    project = models.Project(
+        id=project_id,
+        name=project_id,
+        password=generate_password_hash(project_id),
+        contact_email=f"{project_id}@notmyidea.org",
+        default_currency="EUR",
+    )
+    db.session.add(project)
+    people = [
+        models.Person(name=f"member {i}", project=project) for i in range(members)
+    ]
+    db.session.add_all(people)
+    db.session.commit()
+    ids = [person.id for person in people]
+
+    rng = random.Random(42)
+    start = datetime.date(2015, 1, 1)
+    first_id = (db.session.query(db.func.max(models.Bill.id)).scalar() or 0) + 1
+    bill_rows, ower_rows = [], []
+    for bill_id in range(first_id, first_id + bills):
+        bill_rows.append(
+            {
+                "id": bill_id,
+                "payer_id": rng.choice(ids),
+                "amount": round(rng.uniform(1, 200), 2),
+                "date": start + datetime.timedelta(days=rng.randrange(2000)),
+                "creation_date": start,
+                "what": f"bill number {bill_id}",
+                "archive": None,
+                "external_link": "",
+                "original_currency": "EUR",
+                "converted_amount": 0,
+            }
+        )
+        ower_rows.extend(
+            (bill_id, person_id)
+            for person_id in rng.sample(ids, rng.randint(1, members))
+        )
+    db.session.execute(models.Bill.__table__.insert(), bill_rows)
+    db.session.commit()
+    # Go through the DBAPI: the history of association tables is tracked on
+    # every statement sent through SQLAlchemy, and we do not want any history.
+    connection = db.engine.raw_connection()
+    try:
+        connection.cursor().executemany(
+            "INSERT INTO billowers (bill_id, person_id) VALUES (?, ?)", ower_rows
+        )
+        connection.commit()
+    finally:
+        connection.close()
+    return project
+
+
+def bench_export(app, args):
+    project = populate(bills=args.bills)
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session[project.id] = True
+
+    print(f"Exporting {args.bills} bills")
+    print(f"{'format':<12}{'size (kB)':>12}{'time (s)':>10}{'bills/s':>10}{'MB/s':>8}")
+    for file_format in ("json", "ndjson", "csv"):
+        for suffix in ("", ".gz"):
+            url = f"/{project.id}/export/bills.{file_format}{suffix}"
+            start = time.perf_counter()
+            resp = client.get(url, buffered=False)
+            size = sum(len(chunk) for chunk in resp.response)
+            elapsed = time.perf_counter() - start
+            print(
+                f"{file_format + suffix:<12}{size / 1000:>12.0f}{elapsed:>10.2f}"
+                f"{args.bills / elapsed:>10.0f}{size / elapsed / 1e6:>8.1f}"
+            )
+
+
+def bench_import(app, args):
+    source = populate("source", bills=args.bills)
+    bills = source.get_pretty_bills()
+    exports = {
+        "json": b"".join(iter_dicts2json(bills)),
+        "csv": b"".join(iter_dicts2csv(source.iter_pretty_bills("csv"))),
+    }
+
+    print(f"Importing {args.bills} bills, {args.bills // 2} of them already there")
+    print(f"{'format':<8}{'added':>8}{'time (s)':>10}{'bills/s':>10}")
+    for file_format, exported in exports.items():
+        # Half of the bills are already in the target project
+        target = populate(f"target-{file_format}", bills=0)
+        BillImporter(target).run(bills[::2])
+
+        start = time.perf_counter()
+        parser = IMPORT_FORMATS[file_format]
+        report = BillImporter(target).run(parser(io.BytesIO(exported)))
+        elapsed = time.perf_counter() - start
+        print(
+            f"{file_format:<8}{report.added:>8}{elapsed:>10.2f}"
+            f"{report.rows / elapsed:>10.0f}"
+        )
+
+
+def bench_analytics(app, args):
+    bills = args.bills // args.projects
+    project_ids = [f"project-{i}" for i in range(args.projects)]
+    for project_id in project_ids:
+        populate(project_id, members=5, bills=bills)
+    db.session.remove()
+    db.engine.dispose()
+
+    print(f"Analytics of {args.projects} projects of {bills} bills")
+    print(f"{'processes':<10}{'time (s)':>10}{'projects/s':>12}")
+    for processes in range(1, multiprocessing.cpu_count() + 1):
+        start = time.perf_counter()
+        rows = list(iter_project_stats(db.engine, project_ids, processes, 100))
+        elapsed = time.perf_counter() - start
+        print(f"{processes:<10}{elapsed:>10.2f}{len(rows) / elapsed:>12.0f}")
+
+
+def bench_startup(app, args):
+    config = BenchmarkConfig(app.config["SQLALCHEMY_DATABASE_URI"])
+    migrations_path = os.path.join(app.root_path, "migrations")
+
+    def run_upgrade():
+        with create_app(config).app_context():
+            upgrade(migrations_path)
+
+    print(f"Starting the application {args.runs} times, on a migrated database")
+    print(f"{'startup':<16}{'time (ms)':>10}")
+    for name, start_app in (
+        ("create_app", lambda: create_app(config)),
+        ("with upgrade", run_upgrade),
+    ):
+        start = time.perf_counter()
+        for _ in range(args.runs):
+            start_app()
+        elapsed = time.perf_counter() - start
+        print(f"{name:<16}{elapsed / args.runs * 1000:>10.1f}")
+
+
+def add_bills(database_uri, settings, count):
+    """Add bills one transaction at a time, like the users of the web
+    interface, and return the elapsed time
+    """
+    with create_app(BenchmarkConfig(database_uri, **settings)).app_context():
+        members = models.Project.query.get("writes").members
+        start = time.perf_counter()
+        for i in range(count):
+            db.session.add(
+                models.Bill(
+                    what=f"bill number {i}",
+                    amount=10,
+                    converted_amount=10,
+                    payer_id=members[i % len(members)].id,
+                    owers=members,
+                )
+            )
+            db.session.commit()
+        elapsed = time.perf_counter() - start
+        db.engine.dispose()
+    return elapsed
+
+
+def bench_writes(app, args):
+    print(f"Adding {args.bills} bills, one by one, from {args.processes} processes")
+    print(f"{'configuration':<20}{'time (s)':>10}{'bills/s':>10}")
+    for name, settings in WRITE_CONFIGURATIONS.items():
+        with tempfile.TemporaryDirectory() as tmpdir:
+            database_uri = "sqlite:///" + os.path.join(tmpdir, "writes.db")
+            with create_app(BenchmarkConfig(database_uri, **settings)).app_context():
+                populate("writes", members=5, bills=0)
+                db.session.remove()
+                db.engine.dispose()
+            tasks = [(database_uri, settings, args.bills // args.processes)]
+            with multiprocessing.Pool(args.processes) as pool:
+                elapsed = max(pool.starmap(add_bills, tasks * args.processes))
+        bills = args.bills // args.processes * args.processes
+        print(f"{name:<20}{elapsed:>10.2f}{bills / elapsed:>10.0f}")
+
+
+BENCHMARKS = {
+    "export": bench_export,
+    "import": bench_import,
+    "analytics": bench_analytics,
+    "startup": bench_startup,
+    "writes": bench_writes,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--bills", type=int, default=100000)
+    parser.add_argument("--projects", type=int, default=1000)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count())
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        database = os.path.join(tmpdir, "benchmark.db")
+        app = create_app(BenchmarkConfig(f"sqlite:///{database}"))
+        with app.app_context():
+            BENCHMARKS[args.benchmark](app, args)
+
+
+if __name__ == "__main__":
+    main()
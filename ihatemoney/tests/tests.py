@@ -1,24 +1,43 @@
 import base64
 from collections import defaultdict
+from contextlib import contextmanager
+import csv
 import datetime
+import gc
+import gzip
 import io
 import json
 import os
 import re
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
 from time import sleep
 import unittest
 from unittest.mock import MagicMock, patch
 
-from flask import session
+from alembic.script import ScriptDirectory
+from flask import g, session
 from flask_testing import TestCase
-from sqlalchemy import orm
+import sqlalchemy
+from sqlalchemy import event, orm
 from werkzeug.security import check_password_hash, generate_password_hash
 
-from ihatemoney import history, models, utils
+from ihatemoney import analytics, cache, history, models, snapshots, transactions, utils
 from ihatemoney.currency_convertor import CurrencyConverter
-from ihatemoney.manage import DeleteProject, GenerateConfig, GeneratePasswordHash
-from ihatemoney.run import create_app, db, load_configuration
-from ihatemoney.versioning import LoggingMode
+from ihatemoney.manage import (
+    Analytics,
+    Check,
+    DeleteProject,
+    DumpProjects,
+    GenerateConfig,
+    GeneratePasswordHash,
+    RestoreProjects,
+)
+from ihatemoney.run import create_app, db, get_head_revisions, load_configuration
+from ihatemoney.versioning import LoggingMode, deferred_versioning
 
 # Unset configuration file env var if previously set
 os.environ.pop("IHATEMONEY_SETTINGS_FILE_PATH", None)
@@ -89,6 +108,22 @@ class IhatemoneyTestCase(BaseTestCase):
             f"{url} expected {expected}, got {resp.status_code}",
         )
 
+    @contextmanager
+    def record_queries(self, with_parameters=False):
+        """Record the SQL statements sent to the database within the block,
+        along with their parameters if with_parameters is set
+        """
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, *args):
+            statements.append((statement, parameters) if with_parameters else statement)
+
+        event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+
 
 class ConfigurationTestCase(BaseTestCase):
     def test_default_configuration(self):
@@ -128,6 +163,54 @@ class ConfigurationTestCase(BaseTestCase):
         load_configuration(self.app)
         self.assertEqual(self.app.config["SECRET_KEY"], "supersecret")
 
+    def test_database_settings(self):
+        """Test that the pragmas are set on the SQLite connections"""
+        connection = db.session.connection()
+        for pragma, value in (
+            ("journal_mode", "wal"),
+            ("synchronous", 1),
+            ("busy_timeout", 5000),
+        ):
+            self.assertEqual(connection.execute(f"PRAGMA {pragma}").scalar(), value)
+        self.assertIsInstance(db.engine.pool, sqlalchemy.pool.NullPool)
+
+        class Config:
+            SQLALCHEMY_DATABASE_URI = self.app.config["SQLALCHEMY_DATABASE_URI"]
+            DATABASE_POOL_SIZE = 3
+            SQLITE_CACHE_SIZE = -4000
+            SQLITE_SYNCHRONOUS = "FULL"
+
+        app = create_app(Config)
+        engine = db.get_engine(app)
+        self.assertEqual(engine.pool.size(), 3)
+        with engine.connect() as connection:
+            self.assertEqual(connection.execute("PRAGMA cache_size").scalar(), -4000)
+            self.assertEqual(connection.execute("PRAGMA synchronous").scalar(), 2)
+        engine.dispose()
+
+    def test_migrations_fast_path(self):
+        """Test that migrations are only run when the database is not current"""
+        migrations_path = os.path.join(self.app.root_path, "migrations")
+        heads = get_head_revisions(migrations_path)
+        self.assertEqual(heads, set(ScriptDirectory(migrations_path).get_heads()))
+
+        with patch("flask_migrate.upgrade") as upgrade:
+            create_app(self)
+        upgrade.assert_not_called()
+
+        (head,) = heads
+        db.session.execute("UPDATE alembic_version SET version_num = '00cb77188696'")
+        db.session.commit()
+        try:
+            with patch("flask_migrate.upgrade") as upgrade:
+                create_app(self)
+            upgrade.assert_called_once()
+        finally:
+            db.session.execute(
+                "UPDATE alembic_version SET version_num = :head", {"head": head}
+            )
+            db.session.commit()
+
 
 class BudgetTestCase(IhatemoneyTestCase):
     def test_notifications(self):
@@ -868,6 +951,205 @@ class BudgetTestCase(IhatemoneyTestCase):
         resp = self.client.post("/raclette/edit", data=new_data, follow_redirects=True)
         self.assertIn("Invalid email address", resp.data.decode("utf-8"))
 
+    def test_list_bills_queries(self):
+        self.post_project("raclette")
+        for name in ("zorglub", "fred", "tata"):
+            self.client.post("/raclette/members/add", data={"name": name})
+        members = models.Project.query.get("raclette").members
+
+        def add_bills(count):
+            for i in range(count):
+                bill = models.Bill(
+                    what=f"bill {i}",
+                    payer_id=members[i % 3].id,
+                    owers=members[: i % 3 + 1],
+                    amount=10,
+                    converted_amount=10,
+                    original_currency="USD",
+                )
+                db.session.add(bill)
+            db.session.commit()
+
+        def count_queries():
+            with self.record_queries() as statements:
+                resp = self.client.get("/raclette/")
+            self.assertStatus(200, resp)
+            return len(statements)
+
+        add_bills(10)
+        self.assertLessEqual(count_queries(), 6)
+
+        # With several pages, the number of bills does not matter either
+        add_bills(100)
+        queries_count = count_queries()
+        add_bills(200)
+        self.assertEqual(count_queries(), queries_count)
+        self.assertLessEqual(queries_count, 7)
+
+    def test_project_cache(self):
+        self.post_project("raclette")
+        for name in ("zorglub", "fred"):
+            self.client.post("/raclette/members/add", data={"name": name})
+        self.app.project_cache.clear()
+
+        def get_statements():
+            # Render the balance again
+            self.app.caches["fragments"].clear()
+            with self.record_queries() as statements:
+                resp = self.client.get("/raclette/")
+            self.assertStatus(200, resp)
+            return statements, resp.data.decode("utf-8")
+
+        def members_queries(statements):
+            return [s for s in statements if "WHERE ? = person.project_id" in s]
+
+        statements, _ = get_statements()
+        self.assertEqual(len(members_queries(statements)), 1)
+        # The members are not loaded again, the project row tells that they
+        # did not change
+        cached_statements, _ = get_statements()
+        self.assertEqual(members_queries(cached_statements), [])
+        self.assertEqual(len(cached_statements), len(statements) - 1)
+        stats = self.app.project_cache.stats()
+        self.assertEqual((stats["misses"], stats["hits"], stats["stale"]), (1, 1, 0))
+        self.assertEqual(stats["hit_rate"], 0.5)
+
+        # Changing a member or the project makes the copy stale
+        self.client.post(
+            "/raclette/members/1/edit", data={"name": "zorglub2", "weight": 2}
+        )
+        statements, data = get_statements()
+        self.assertIn("zorglub2", data)
+        self.assertEqual(len(members_queries(statements)), 1)
+        revision = models.Project.query.get("raclette").revision
+        db.session.add(models.Person(name="tata", project_id="raclette"))
+        db.session.commit()
+        db.session.expire_all()
+        self.assertNotEqual(models.Project.query.get("raclette").revision, revision)
+        self.assertIn("tata", get_statements()[1])
+        self.assertEqual(self.app.project_cache.stats()["stale"], 2)
+
+        def bumps(statements):
+            return [s for s in statements if s.startswith("UPDATE project SET")]
+
+        # Once per transaction, whatever the number of flushes
+        with self.record_queries() as statements:
+            for name in ("toto", "titi"):
+                db.session.add(models.Person(name=name, project_id="raclette"))
+                db.session.flush()
+            db.session.commit()
+        self.assertEqual(len(bumps(statements)), 1)
+        # Changes which are rolled back are forgotten
+        db.session.add(models.Person(name="tutu", project_id="raclette"))
+        db.session.flush()
+        db.session.rollback()
+        with self.record_queries() as statements:
+            db.session.commit()
+        self.assertEqual(bumps(statements), [])
+        get_statements()
+
+        # Bill changes do not
+        self.client.post(
+            "/raclette/add",
+            data={
+                "date": "2011-08-10",
+                "what": "fromage",
+                "payer": 1,
+                "payed_for": [1, 2],
+                "amount": "10",
+            },
+        )
+        self.assertEqual(members_queries(get_statements()[0]), [])
+
+    def test_fragment_cache(self):
+        self.post_project("raclette")
+        for name in ("zorglub", "fred"):
+            self.client.post("/raclette/members/add", data={"name": name})
+
+        def add_bill(payer, amount):
+            self.client.post(
+                "/raclette/add",
+                data={
+                    "date": "2011-08-10",
+                    "what": "fromage",
+                    "payer": payer,
+                    "payed_for": [1, 2],
+                    "amount": amount,
+                },
+            )
+
+        def get_page(url):
+            with self.record_queries() as statements:
+                resp = self.client.get(url)
+            self.assertStatus(200, resp)
+            bills_queries = [s for s in statements if "FROM bill" in s]
+            return bills_queries, resp.data.decode("utf-8")
+
+        def balance(data):
+            return re.findall(r'balance-value[^"]*">\s*([+-]?[\d.]+)', data)
+
+        add_bill(1, "10")
+        fragments = self.app.caches["fragments"]
+        fragments.clear()
+        _, data = get_page("/raclette/")
+        self.assertEqual(balance(data), ["-5.00", "+5.00"])
+        self.assertEqual(fragments.stats()["misses"], 1)
+        _, cached_data = get_page("/raclette/")
+        self.assertEqual(balance(cached_data), ["-5.00", "+5.00"])
+        self.assertEqual(fragments.stats()["hits"], 1)
+
+        # The statistics are not computed when they are cached
+        bills_queries, data = get_page("/raclette/statistics")
+        self.assertNotEqual(bills_queries, [])
+        bills_queries, cached_data = get_page("/raclette/statistics")
+        self.assertEqual(bills_queries, [])
+        self.assertEqual(cached_data, data)
+
+        # Changing a bill, a member or the language renders them again
+        add_bill(2, "30")
+        self.assertEqual(balance(get_page("/raclette/")[1]), ["+10.00", "-10.00"])
+        self.assertEqual(
+            balance(get_page("/raclette/history")[1]), ["+10.00", "-10.00"]
+        )
+        self.client.post(
+            "/raclette/members/1/edit", data={"name": "zorglub", "weight": 2}
+        )
+        _, data = get_page("/raclette/statistics")
+        self.assertEqual(balance(data), ["+16.67", "-16.67"])
+        self.assertIn("$26.67", data)
+        self.client.get("/lang/fr")
+        self.assertIn("désactiver", get_page("/raclette/")[1])
+
+    def test_fragment_cache_import(self):
+        self.post_project("raclette")
+        for name in ("zorglub", "fred"):
+            self.client.post("/raclette/members/add", data={"name": name})
+        resp = self.client.get("/raclette/")
+        self.assertIn("0.00", resp.data.decode("utf-8"))
+        self.assertNotIn("+100.00", resp.data.decode("utf-8"))
+
+        # Imported bills are inserted in bulk, they still change the balance
+        from ihatemoney.web import import_project
+
+        file = io.StringIO()
+        json.dump(
+            [
+                {
+                    "date": "2017-01-01",
+                    "what": "fromage",
+                    "amount": 200.0,
+                    "payer_name": "zorglub",
+                    "payer_weight": 1.0,
+                    "owers": ["zorglub", "fred"],
+                }
+            ],
+            file,
+        )
+        file.seek(0)
+        import_project(file, models.Project.query.get("raclette"))
+        resp = self.client.get("/raclette/")
+        self.assertIn("+100.00", resp.data.decode("utf-8"))
+
     def test_dashboard(self):
         # test that the dashboard is deactivated by default
         resp = self.client.post(
@@ -890,6 +1172,89 @@ class BudgetTestCase(IhatemoneyTestCase):
             resp.data.decode("utf-8"),
         )
 
+    def test_dashboard_projects(self):
+        self.app.config["ACTIVATE_ADMIN_DASHBOARD"] = True
+        self.app.config["ADMIN_PASSWORD"] = generate_password_hash("adminpass")
+        self.client.post("/admin", data={"admin_password": "adminpass"})
+
+        for project_id in ("raclette", "tartiflette", "fondue"):
+            self.post_project(project_id)
+        for name in ("zorglub", "fred"):
+            self.client.post("/raclette/members/add", data={"name": name})
+        self.client.post("/fondue/members/add", data={"name": "tata"})
+        for date in ("2011-08-10", "2012-01-01", "2011-02-03"):
+            self.client.post(
+                "/raclette/add",
+                data={
+                    "date": date,
+                    "what": "fromage",
+                    "payer": 1,
+                    "payed_for": [1, 2],
+                    "amount": "10",
+                },
+            )
+
+        def get_page(**args):
+            with self.record_queries() as statements:
+                resp = self.client.get("/dashboard/projects.json", query_string=args)
+            self.assertStatus(200, resp)
+            self.assertLessEqual(len(statements), 3)
+            return resp.json
+
+        page = get_page(draw=3)
+        self.assertEqual(page["draw"], 3)
+        self.assertEqual(page["recordsTotal"], 3)
+        self.assertEqual(page["recordsFiltered"], 3)
+        self.assertEqual(
+            page["data"],
+            [
+                {
+                    "id": "fondue",
+                    "name": "fondue",
+                    "members_count": 1,
+                    "bills_count": 0,
+                    "newest_bill": None,
+                    "oldest_bill": None,
+                },
+                {
+                    "id": "raclette",
+                    "name": "raclette",
+                    "members_count": 2,
+                    "bills_count": 3,
+                    "newest_bill": "2012-01-01",
+                    "oldest_bill": "2011-02-03",
+                },
+                {
+                    "id": "tartiflette",
+                    "name": "tartiflette",
+                    "members_count": 0,
+                    "bills_count": 0,
+                    "newest_bill": None,
+                    "oldest_bill": None,
+                },
+            ],
+        )
+
+        # Sorted by number of members, paginated
+        page = get_page(**{"order[0][column]": 1, "order[0][dir]": "desc", "length": 2})
+        self.assertEqual([p["id"] for p in page["data"]], ["raclette", "fondue"])
+        page = get_page(**{"order[0][column]": 1, "start": 2, "length": 2})
+        self.assertEqual([p["id"] for p in page["data"]], ["raclette"])
+
+        page = get_page(**{"search[value]": "ETTE"})
+        self.assertEqual(page["recordsTotal"], 3)
+        self.assertEqual(page["recordsFiltered"], 2)
+        self.assertEqual([p["id"] for p in page["data"]], ["raclette", "tartiflette"])
+        self.assertEqual(get_page(**{"search[value]": "%"})["recordsFiltered"], 0)
+
+        # The first page is rendered with the dashboard
+        resp = self.client.get("/dashboard", query_string={"length": 1})
+        self.assertIn('title="fondue"', resp.data.decode("utf-8"))
+        self.assertNotIn('title="raclette"', resp.data.decode("utf-8"))
+
+        self.app.config["ACTIVATE_ADMIN_DASHBOARD"] = False
+        self.assertStatus(404, self.client.get("/dashboard/projects.json"))
+
     def test_statistics_page(self):
         self.post_project("raclette")
         response = self.client.get("/raclette/statistics")
@@ -1204,6 +1569,88 @@ class BudgetTestCase(IhatemoneyTestCase):
         resp = self.client.get("/raclette/export/transactions.wrong")
         self.assertEqual(resp.status_code, 404)
 
+    def test_export_streaming(self):
+        self.post_project("raclette")
+        for name in ("zorglub", "fred", "tata"):
+            self.client.post("/raclette/members/add", data={"name": name})
+        project = models.Project.query.get("raclette")
+        members = project.members
+        for i in range(250):
+            db.session.add(
+                models.Bill(
+                    what=f"bill {i}",
+                    payer_id=members[i % 3].id,
+                    owers=members[: i % 3 + 1],
+                    amount=10,
+                    converted_amount=10,
+                    date=datetime.date(2020, 1, 1),
+                )
+            )
+        db.session.commit()
+
+        # Owers are fetched once per batch of bills
+        with self.record_queries() as statements:
+            bills = list(project.iter_pretty_bills(batch_size=100))
+        self.assertEqual(len(bills), 250)
+        self.assertEqual(len([s for s in statements if "billowers" in s]), 3)
+        self.assertEqual(bills, project.get_pretty_bills())
+
+        resp = self.client.get("/raclette/export/bills.json", buffered=False)
+        self.assertTrue(resp.is_streamed)
+        self.assertEqual(resp.mimetype, "application/json")
+        self.assertEqual(
+            resp.headers["Content-Disposition"],
+            "attachment; filename=raclette-bills.json",
+        )
+        chunks = list(resp.response)
+        resp.close()
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(json.loads(b"".join(chunks)), bills)
+
+        resp = self.client.get("/raclette/export/bills.csv", buffered=False)
+        self.assertTrue(resp.is_streamed)
+        lines = b"".join(resp.response).decode("utf-8").splitlines()
+        resp.close()
+        self.assertEqual(len(lines), 251)
+        self.assertEqual(lines[0], "what,amount,date,payer_name,payer_weight,owers")
+        self.assertEqual(lines[-1], "bill 0,10.0,2020-01-01,zorglub,1.0,zorglub")
+
+        resp = self.client.get("/raclette/export/bills.ndjson", buffered=False)
+        self.assertTrue(resp.is_streamed)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        lines = b"".join(resp.response).decode("utf-8").splitlines()
+        resp.close()
+        self.assertEqual([json.loads(line) for line in lines], bills)
+
+        # Every format can be gzipped on the fly
+        for format in ("json", "ndjson", "csv"):
+            resp = self.client.get(f"/raclette/export/bills.{format}.gz")
+            self.assertEqual(resp.mimetype, "application/gzip")
+            self.assertEqual(
+                resp.headers["Content-Disposition"],
+                f"attachment; filename=raclette-bills.{format}.gz",
+            )
+            compressed = resp.data
+            plain = self.client.get(f"/raclette/export/bills.{format}").data
+            self.assertEqual(gzip.decompress(compressed), plain)
+
+        compressed = self.client.get("/raclette/export/transactions.ndjson.gz").data
+        plain = self.client.get("/raclette/export/transactions.ndjson").data
+        self.assertEqual(gzip.decompress(compressed), plain)
+        self.assertEqual(self.client.get("/raclette/export/bills.xml").status_code, 404)
+
+        # Owers from another project are left out
+        self.create_project("tartiflette")
+        stranger = models.Person(name="stranger", project_id="tartiflette")
+        db.session.add(stranger)
+        db.session.flush()
+        bill = models.Bill.query.filter_by(what="bill 0").one()
+        db.session.execute(
+            models.billowers.insert().values(bill_id=bill.id, person_id=stranger.id)
+        )
+        db.session.commit()
+        self.assertEqual(project.get_pretty_bills(), bills)
+
     def test_import_new_project(self):
         # Import JSON in an empty project
 
@@ -1360,6 +1807,287 @@ class BudgetTestCase(IhatemoneyTestCase):
 
                     self.assertEqual(list_project, list_json)
 
+    def test_import_duplicates(self):
+        self.post_project("raclette")
+        self.login("raclette")
+        project = models.Project.query.get("raclette")
+
+        self.client.post("/raclette/members/add", data={"name": "zorglub"})
+        self.client.post("/raclette/members/add", data={"name": "fred"})
+        self.client.post(
+            "/raclette/add",
+            data={
+                "date": "2016-12-31",
+                "what": "red wine",
+                "payer": 1,
+                "payed_for": [1, 2],
+                "amount": "200",
+            },
+        )
+
+        json_to_import = [
+            {  # Already there, owers are not in the same order
+                "date": "2016-12-31",
+                "what": "red wine",
+                "amount": 200,
+                "payer_name": "zorglub",
+                "payer_weight": 1.0,
+                "owers": ["fred", "zorglub"],
+            },
+            {
+                "date": "2017-01-01",
+                "what": "refund",
+                "amount": 13.33,
+                "payer_name": "tata",
+                "payer_weight": 1.0,
+                "owers": ["fred"],
+            },
+            {
+                "date": "2017-01-02",
+                "what": "cheese",
+                "amount": 10.0,
+                "payer_name": "tata",
+                "payer_weight": 2.0,
+                "owers": ["fred", "pepe"],
+            },
+        ]
+
+        from ihatemoney.web import import_project
+
+        file = io.StringIO()
+        json.dump(json_to_import, file)
+        file.seek(0)
+        import_project(file, project)
+
+        self.assertEqual(
+            sorted(bill["what"] for bill in project.get_pretty_bills()),
+            ["cheese", "red wine", "refund"],
+        )
+        # Members are only added once, with the first weight found
+        self.assertEqual(
+            [(m.name, m.weight) for m in project.members],
+            [("zorglub", 1), ("fred", 1), ("tata", 1), ("pepe", 1)],
+        )
+
+    def test_import_batches(self):
+        self.post_project("raclette")
+        project = models.Project.query.get("raclette")
+        self.client.post("/raclette/members/add", data={"name": "zorglub"})
+
+        json_to_import = [
+            {
+                "date": f"2017-01-{i + 1:02d}",
+                "what": f"bill {i}",
+                "amount": 10.5 + i,
+                # tata owes before paying, with a weight of 2
+                "payer_name": ["zorglub", "fred"][i % 2] if i < 4 else "tata",
+                "payer_weight": 1.0 if i < 4 else 2.0,
+                "owers": ["zorglub", "tata"] if i % 2 else ["fred"],
+            }
+            for i in range(10)
+        ]
+        data = json.dumps(json_to_import).encode("utf-8")
+        # The file is parsed chunk by chunk
+        self.assertEqual(
+            list(utils.iter_json_array(io.BytesIO(data), chunk_size=7)), json_to_import,
+        )
+        # A malformed item stops the parsing, without reading the whole file
+        for malformed in (b'[{"what": x}, ', b'[{"what": "a\\q"}, ', b"[-Infinitz, "):
+            file = io.BytesIO(malformed + data[1:])
+            with self.assertRaises(ValueError):
+                list(utils.iter_json_array(file, chunk_size=7))
+            self.assertLess(file.tell(), 30)
+
+        from ihatemoney.imports import BillImporter
+
+        progress = []
+        importer = BillImporter(
+            project, batch_size=4, progress=lambda report: progress.append(report.added)
+        )
+        with self.record_queries() as statements:
+            report = importer.run(utils.iter_json_array(io.BytesIO(data)))
+        self.assertEqual(progress, [4, 8, 10])
+        self.assertEqual((report.rows, report.added, report.duplicates), (10, 10, 0))
+        self.assertEqual(report.members_added, 2)
+
+        # Bills and owers are inserted with one statement per batch
+        for table in ("bill", "billowers"):
+            inserts = [s for s in statements if s.startswith(f"INSERT INTO {table} ")]
+            self.assertEqual(len(inserts), 3)
+        self.assertFalse(
+            models.Bill.query.filter(models.Bill.external_link != "").all()
+        )
+
+        self.assertEqual(
+            sorted(project.get_pretty_bills(), key=lambda bill: bill["date"]),
+            json_to_import,
+        )
+        self.assertEqual(
+            [(m.name, m.weight) for m in project.members],
+            [("zorglub", 1), ("fred", 1), ("tata", 2)],
+        )
+
+        # Importing the same file again does nothing
+        report = BillImporter(project).run(utils.iter_json_array(io.BytesIO(data)))
+        self.assertEqual((report.added, report.duplicates), (0, 10))
+
+    def test_import_row_errors(self):
+        self.post_project("raclette")
+        self.login("raclette")
+        project = models.Project.query.get("raclette")
+
+        valid = {
+            "date": "2017-01-01",
+            "what": "refund",
+            "amount": 13.33,
+            "payer_name": "tata",
+            "payer_weight": 1.0,
+            "owers": ["fred"],
+        }
+        json_to_import = [
+            valid,
+            dict(valid, amount="13.33"),
+            dict(valid, date="yesterday"),
+            valid,
+            dict(valid, owers=[]),
+            "not a bill",
+        ]
+
+        from ihatemoney.imports import BillImporter, InvalidImport
+
+        with self.assertRaises(InvalidImport) as cm:
+            BillImporter(project, batch_size=1).run(iter(json_to_import))
+        self.assertEqual([error.row for error in cm.exception.errors], [2, 3, 5, 6])
+        self.assertEqual(cm.exception.errors[0].message, "amount must be a number")
+
+        # Nothing has been imported
+        self.assertEqual(project.get_pretty_bills(), [])
+        self.assertEqual(project.members, [])
+
+        # The errors are displayed when uploading the file
+        resp = self.client.post(
+            "/raclette/edit",
+            data={
+                "file": (io.BytesIO(json.dumps(json_to_import).encode()), "bills.json")
+            },
+            follow_redirects=True,
+        )
+        self.assertIn("Invalid bill #3: invalid date", resp.data.decode("utf-8"))
+
+    def test_import_csv(self):
+        self.post_project("raclette")
+        self.client.post("/raclette/members/add", data={"name": "zorglub", "weight": 2})
+        self.client.post("/raclette/members/add", data={"name": "fred"})
+        self.client.post("/raclette/members/add", data={"name": "pépé"})
+        for what, payer, payed_for, amount in [
+            ("fromage", 1, [1, 2, 3], "10.5"),
+            ("vin, rouge", 3, [2], "24"),
+            ("pain", 2, [1, 3], "3.33"),
+        ]:
+            self.client.post(
+                "/raclette/add",
+                data={
+                    "date": "2017-01-01",
+                    "what": what,
+                    "payer": payer,
+                    "payed_for": payed_for,
+                    "amount": amount,
+                },
+            )
+        exported = self.client.get("/raclette/export/bills.csv").data
+
+        self.post_project("tartiflette")
+        self.client.post("/tartiflette/members/add", data={"name": "fred"})
+        self.client.post(
+            "/tartiflette/add",
+            data={
+                "date": "2017-01-01",
+                "what": "pain",
+                "payer": 4,
+                "payed_for": [4],
+                "amount": "3.33",
+            },
+        )
+        raclette = models.Project.query.get("raclette")
+        tartiflette = models.Project.query.get("tartiflette")
+        [existing_bill] = tartiflette.get_pretty_bills()
+
+        self.client.post(
+            "/tartiflette/edit",
+            data={"file": (io.BytesIO(exported), "raclette-bills.csv")},
+        )
+        # "pain" is not a duplicate, fred does not owe the same people
+        bills = tartiflette.get_pretty_bills()
+        self.assertEqual(len(bills), 4)
+        bills.remove(existing_bill)
+        self.assertEqual(
+            sorted(map(utils.bill_key, raclette.get_pretty_bills())),
+            sorted(map(utils.bill_key, bills)),
+        )
+        self.assertEqual(
+            [(m.name, m.weight) for m in tartiflette.members],
+            [("fred", 1), ("pépé", 1), ("zorglub", 2)],
+        )
+
+        # Importing the same file again adds nothing
+        self.client.post(
+            "/tartiflette/edit",
+            data={"file": (io.BytesIO(exported), "raclette-bills.csv")},
+        )
+        self.assertEqual(len(tartiflette.get_pretty_bills()), 4)
+
+        resp = self.client.post(
+            "/tartiflette/edit",
+            data={"file": (io.BytesIO(b"what,amount\nfoo,12\n"), "bills.csv")},
+            follow_redirects=True,
+        )
+        self.assertIn("Invalid CSV", resp.data.decode("utf-8"))
+
+    def test_import_csv_commas(self):
+        self.post_project("raclette")
+        self.client.post("/raclette/members/add", data={"name": "Dupont, Jean"})
+        self.client.post("/raclette/members/add", data={"name": "fred"})
+        header = "date,what,amount,payer_name,payer_weight,owers\n"
+
+        # Rows with more fields than the header are invalid bills
+        resp = self.client.post(
+            "/raclette/edit",
+            data={
+                "file": (
+                    io.BytesIO(
+                        (header + "2017-01-01,pain,10,fred,1,fred,extra\n").encode()
+                    ),
+                    "bills.csv",
+                )
+            },
+            follow_redirects=True,
+        )
+        self.assertStatus(200, resp)
+        self.assertIn("Invalid bill #1: too many fields", resp.data.decode("utf-8"))
+
+        # Known names are not split on their commas, neither are the payers
+        # of the previous rows
+        rows = (
+            '2017-01-01,pain,10,fred,1,"Dupont, Jean, fred"\n'
+            '2017-01-02,vin,20,"Martin, Paul",1,"fred,Martin, Paul"\n'
+        )
+        resp = self.client.post(
+            "/raclette/edit",
+            data={"file": (io.BytesIO((header + rows).encode()), "bills.csv")},
+        )
+        self.assertStatus(302, resp)
+        project = models.Project.query.get("raclette")
+        self.assertEqual(
+            sorted(
+                (bill["what"], bill["owers"]) for bill in project.get_pretty_bills()
+            ),
+            [("pain", ["Dupont, Jean", "fred"]), ("vin", ["fred", "Martin, Paul"])],
+        )
+        self.assertEqual(
+            sorted(member.name for member in project.members),
+            ["Dupont, Jean", "Martin, Paul", "fred"],
+        )
+
     def test_import_wrong_json(self):
         self.post_project("raclette")
         self.login("raclette")
@@ -1483,6 +2211,49 @@ class APITestCase(IhatemoneyTestCase):
 
                 self.assertStatus(401, getattr(self.client, verb)(url), verb + resource)
 
+    def test_auth_cache(self):
+        self.api_create("raclette")
+        with patch(
+            "ihatemoney.api.common.check_password_hash", wraps=check_password_hash
+        ) as check:
+            for _ in range(3):
+                resp = self.client.get(
+                    "/api/projects/raclette", headers=self.get_auth("raclette")
+                )
+                self.assertStatus(200, resp)
+            # The right password is only hashed once
+            self.assertEqual(check.call_count, 1)
+
+            for _ in range(2):
+                resp = self.client.get(
+                    "/api/projects/raclette", headers=self.get_auth("raclette", "x")
+                )
+                self.assertStatus(401, resp)
+            self.assertEqual(check.call_count, 3)
+
+        # Changing the password forgets the previous one
+        resp = self.client.put(
+            "/api/projects/raclette",
+            data={
+                "contact_email": "yeah@notmyidea.org",
+                "password": "raclette2",
+                "name": "raclette",
+                "default_currency": "USD",
+            },
+            headers=self.get_auth("raclette"),
+        )
+        self.assertStatus(200, resp)
+        resp = self.client.get(
+            "/api/projects/raclette", headers=self.get_auth("raclette")
+        )
+        self.assertStatus(401, resp)
+        resp = self.client.get(
+            "/api/projects/raclette", headers=self.get_auth("raclette", "raclette2")
+        )
+        self.assertStatus(200, resp)
+        stats = self.app.caches["auth"].stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (3, 5))
+
     def test_project(self):
         # wrong email should return an error
         resp = self.client.post(
@@ -2151,6 +2922,123 @@ class APITestCase(IhatemoneyTestCase):
         self.assertEqual(resp.data.decode("utf-8").count("<td> -- </td>"), 2)
         self.assertNotIn("127.0.0.1", resp.data.decode("utf-8"))
 
+    def test_idempotency_key(self):
+        self.api_create("raclette")
+        self.api_add_member("raclette", "zorglub")
+        self.api_add_member("raclette", "fred")
+
+        def post_bill(key, what="fromage"):
+            return self.client.post(
+                "/api/projects/raclette/bills",
+                data={
+                    "date": "2011-08-10",
+                    "what": what,
+                    "payer": "1",
+                    "payed_for": ["1", "2"],
+                    "amount": "25",
+                },
+                headers=dict(self.get_auth("raclette"), **{"Idempotency-Key": key}),
+            )
+
+        req = post_bill("first")
+        self.assertStatus(201, req)
+        self.assertEqual(req.data.decode("utf-8"), "1\n")
+
+        # The response is replayed, without writing anything
+        transactions = models.versioning_manager.transaction_cls.query.count()
+        with self.record_queries() as statements:
+            req = post_bill("first")
+        self.assertStatus(201, req)
+        self.assertEqual(req.data.decode("utf-8"), "1\n")
+        self.assertEqual(models.Bill.query.count(), 1)
+        self.assertEqual(
+            models.versioning_manager.transaction_cls.query.count(), transactions
+        )
+        self.assertFalse([s for s in statements if s.startswith(("INSERT", "UPDATE"))])
+
+        # Another request cannot use the same key
+        self.assertStatus(422, post_bill("first", what="raclette"))
+        # The request is not run again while the first one is running
+        stored = models.IdempotencyKey.query.get(("raclette", "first"))
+        stored.status = None
+        db.session.commit()
+        self.assertStatus(409, post_bill("first"))
+        stored.status = 201
+        db.session.commit()
+
+        # Other keys create new bills, storing keys is not versioned
+        self.assertEqual(post_bill("second").data.decode("utf-8"), "2\n")
+        self.assertEqual(models.Bill.query.count(), 2)
+        self.assertEqual(
+            models.versioning_manager.transaction_cls.query.count(), transactions + 1
+        )
+
+        # Errors are replayed too, and other methods are idempotent as well
+        headers = dict(self.get_auth("raclette"), **{"Idempotency-Key": "third"})
+        for _ in range(2):
+            req = self.client.put(
+                "/api/projects/raclette/members/2",
+                data={"name": "fred", "weight": "-1"},
+                headers=headers,
+            )
+            self.assertStatus(400, req)
+        for _ in range(2):
+            req = self.client.delete("/api/projects/raclette/bills/2", headers=headers)
+            self.assertStatus(422, req)
+        headers["Idempotency-Key"] = "fourth"
+        for _ in range(2):
+            req = self.client.delete("/api/projects/raclette/bills/2", headers=headers)
+            self.assertStatus(200, req)
+
+        # Keys expire
+        models.IdempotencyKey.query.filter_by(key="first").update(
+            {"created_at": datetime.datetime.utcnow() - datetime.timedelta(days=2)}
+        )
+        db.session.commit()
+        self.assertEqual(post_bill("first").data.decode("utf-8"), "3\n")
+        self.assertEqual(models.Bill.query.count(), 2)
+
+        # Keys are scoped to their project
+        self.api_create("tartiflette")
+        req = self.client.post(
+            "/api/projects/tartiflette/members",
+            data={"name": "tata"},
+            headers=dict(self.get_auth("tartiflette"), **{"Idempotency-Key": "first"}),
+        )
+        self.assertStatus(201, req)
+
+        # A request which is still running after its lease is run again
+        models.IdempotencyKey.query.filter_by(key="first").update(
+            {
+                "status": None,
+                "created_at": datetime.datetime.utcnow()
+                - datetime.timedelta(minutes=10),
+            }
+        )
+        db.session.commit()
+        self.assertEqual(post_bill("first").data.decode("utf-8"), "4\n")
+
+        # Project creations are scoped to the requested identifier
+        def create_project(id):
+            return self.client.post(
+                "/api/projects",
+                data={
+                    "name": id,
+                    "id": id,
+                    "password": id,
+                    "contact_email": f"{id}@notmyidea.org",
+                    "default_currency": "USD",
+                },
+                headers={"Idempotency-Key": "first"},
+            )
+
+        for _ in range(2):
+            req = create_project("Fondue")
+            self.assertStatus(201, req)
+            self.assertEqual(req.data.decode("utf-8"), '"fondue"\n')
+        self.assertIsNotNone(models.IdempotencyKey.query.get(("fondue", "first")))
+        self.assertStatus(201, create_project("pizza"))
+
 
 class ServerTestCase(IhatemoneyTestCase):
     def test_homepage(self):
@@ -2200,6 +3088,191 @@ class CommandTestCase(BaseTestCase):
         cmd.run("demo")
 
         self.assertEqual(len(models.Project.query.all()), 0)
+        with patch("sys.stderr", new=io.StringIO()):
+            self.assertEqual(cmd.run("demo"), 1)
+
+    def test_analytics(self):
+        for name in ("raclette", "tartiflette", "fondue"):
+            self.create_project(name)
+        raclette = models.Project.query.get("raclette")
+        zorglub, fred, tata = (
+            models.Person(name=name, weight=weight, project=raclette)
+            for name, weight in (("zorglub", 2), ("fred", 1), ("tata", 1))
+        )
+        tata.activated = False
+        models.db.session.add_all([zorglub, fred, tata])
+        for day, amount, payer, owers in (
+            (1, 10, zorglub, [zorglub, fred]),
+            (2, 20, fred, [zorglub, fred, tata]),
+            (3, 7.5, tata, [fred]),
+        ):
+            models.db.session.add(
+                models.Bill(
+                    what="fromage",
+                    date=datetime.date(2020, 1, day),
+                    creation_date=datetime.date(2020, 1, day),
+                    amount=amount,
+                    converted_amount=amount,
+                    payer=payer,
+                    owers=owers,
+                )
+            )
+        models.db.session.add(
+            models.Person(
+                name="zorglub", project=models.Project.query.get("tartiflette")
+            )
+        )
+        models.db.session.commit()
+        balances = raclette.balance.values()
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            reports = {}
+            for processes in (1, 2):
+                path = os.path.join(tmpdir, f"report-{processes}.json")
+                Analytics().run(path, processes, 2, "bills", 365)
+                with open(path) as report:
+                    reports[processes] = json.load(report)
+            self.assertEqual(reports[1], reports[2])
+
+            path = os.path.join(tmpdir, "report.csv")
+            Analytics().run(path, 1, 2, "members", 365)
+            with open(path) as report:
+                rows = list(csv.DictReader(report))
+            self.assertEqual(
+                [row["project_id"] for row in rows],
+                ["raclette", "tartiflette", "fondue"],
+            )
+
+        raclette_stats, *others = reports[1]
+        self.assertEqual(
+            raclette_stats,
+            {
+                "project_id": "raclette",
+                "members": 3,
+                "active_members": 2,
+                "bills": 3,
+                "total_spent": 37.5,
+                "largest_balance": round(max(abs(b) for b in balances), 2),
+                "first_bill": "2020-01-01",
+                "last_bill": "2020-01-03",
+                "last_activity": "2020-01-03",
+                "dormant": True,
+                "history_rows": raclette_stats["history_rows"],
+            },
+        )
+        self.assertGreater(raclette_stats["history_rows"], 0)
+        self.assertEqual(
+            [(row["project_id"], row["members"], row["bills"]) for row in others],
+            [("fondue", 0, 0), ("tartiflette", 1, 0)],
+        )
+        self.assertEqual(
+            analytics.project_stats(
+                models.db.session.connection(),
+                ["raclette"],
+                today=datetime.date(2020, 6, 1),
+            )[0]["dormant"],
+            False,
+        )
+
+    def test_check(self):
+        self.create_project("raclette")
+        self.create_project("fondue")
+        raclette = models.Project.query.get("raclette")
+        zorglub, fred, tata = (
+            models.Person(name=name, project=raclette)
+            for name in ("zorglub", "fred", "tata")
+        )
+        stranger = models.Person(name="stranger", project_id="fondue")
+        models.db.session.add_all([zorglub, fred, tata, stranger])
+        bills = [
+            models.Bill(
+                what="fromage",
+                amount=10,
+                converted_amount=10,
+                payer=zorglub,
+                owers=owers,
+            )
+            for owers in ([zorglub, fred], [fred], [])
+        ]
+        models.db.session.add_all(bills)
+        models.db.session.commit()
+        zorglub_id, tata_id, stranger_id = zorglub.id, tata.id, stranger.id
+        bill_ids = [bill.id for bill in bills]
+
+        # Corrupt the database behind the back of the ORM
+        connection = db.engine.raw_connection()
+        try:
+            connection.executescript(
+                f"""
+                INSERT INTO billowers VALUES ({bill_ids[0]}, {stranger_id});
+                INSERT INTO billowers VALUES ({bill_ids[1]}, 999);
+                INSERT INTO billowers VALUES (999, {zorglub_id});
+                UPDATE person SET weight = 0 WHERE name = 'tata';
+                INSERT INTO bill (id, payer_id, amount) VALUES (998, 999, 1);
+                INSERT INTO person (id, project_id, name) VALUES (997, 'ghost', 'x');
+                """
+            )
+            connection.commit()
+        finally:
+            connection.close()
+
+        def check(repair):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                path = os.path.join(tmpdir, "report.json")
+                status = Check().run(repair, path, 2, 1)
+                with open(path) as report:
+                    report = json.load(report)
+            self.assertEqual(report["projects"], 2)
+            problems = {
+                (p["check"],) + tuple(v for k, v in sorted(p.items()) if k != "check")
+                for p in report["problems"]
+            }
+            return status, problems, report["repaired"]
+
+        unrepairable = {
+            ("bills_without_owers", bill_ids[2], "raclette"),
+            ("orphan_members", 997),
+        }
+        status, problems, repaired = check(repair=False)
+        self.assertEqual(status, 1)
+        self.assertEqual(
+            problems,
+            unrepairable
+            | {
+                ("foreign_owers", bill_ids[0], stranger_id, "raclette"),
+                ("foreign_owers", bill_ids[1], 999, "raclette"),
+                ("invalid_weights", tata_id, "raclette", 0),
+                ("orphan_owers", 999, zorglub_id),
+                ("orphan_bills", 998),
+            },
+        )
+        self.assertEqual(repaired, {})
+
+        status, _, repaired = check(repair=True)
+        self.assertEqual(status, 1)
+        self.assertEqual(
+            repaired,
+            {
+                "foreign_owers": 2,
+                "invalid_weights": 1,
+                "orphan_owers": 1,
+                "orphan_bills": 1,
+            },
+        )
+        self.assertEqual(check(repair=False)[1], unrepairable)
+        raclette = models.Project.query.get("raclette")
+        self.assertEqual(models.Person.query.get(tata_id, raclette).weight, 1)
+        self.assertEqual(
+            [ower.name for ower in models.Bill.query.get(raclette, bill_ids[0]).owers],
+            ["zorglub", "fred"],
+        )
+        # Repairs are not recorded in the history
+        self.assertEqual(
+            models.db.session.execute(
+                "SELECT COUNT(*) FROM billowers_version WHERE operation_type = 2"
+            ).scalar(),
+            0,
+        )
 
 
 class ModelsTestCase(IhatemoneyTestCase):
@@ -2264,6 +3337,222 @@ class ModelsTestCase(IhatemoneyTestCase):
                 pay_each_expected = 10 / 3
                 self.assertEqual(bill.pay_each(), pay_each_expected)
 
+    def query_plans(self, func):
+        """Return the SQLite query plan of every SELECT issued by func()"""
+        with self.record_queries(with_parameters=True) as queries:
+            func()
+        queries = [query for query in queries if query[0].startswith("SELECT")]
+        self.assertTrue(queries)
+        return [
+            row[-1]
+            for statement, parameters in queries
+            for row in db.engine.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)
+        ]
+
+    def test_queries_use_indexes(self):
+        project = models.Project(
+            id="raclette", name="raclette", password="raclette", contact_email="a@b.c"
+        )
+        zorglub = models.Person(name="zorglub", project=project)
+        fred = models.Person(name="fred", project=project)
+        bill = models.Bill(
+            what="fromage", payer=zorglub, owers=[zorglub, fred], amount=10
+        )
+        bill.converted_amount = 10
+        db.session.add_all([project, zorglub, fred, bill])
+        db.session.commit()
+
+        expected_indexes = {
+            "get_bills": ["ix_person_project_id", "ix_bill_payer_id"],
+            "balance": ["ix_person_project_id", "ix_bill_payer_id"],
+            "history": ["ix_person_version_project_id", "ix_bill_version_payer_id"],
+            "get": [],
+            "owers": [],
+        }
+        plans = {
+            "get_bills": self.query_plans(lambda: project.get_bills().all()),
+            "balance": self.query_plans(lambda: project.balance),
+            "history": self.query_plans(
+                lambda: [q.all() for q in history.get_history_queries(project)]
+            ),
+            "get": self.query_plans(
+                lambda: models.Person.query.get(zorglub.id, project)
+            ),
+            "owers": self.query_plans(
+                lambda: db.session.query(models.billowers)
+                .filter_by(bill_id=bill.id)
+                .all()
+            ),
+        }
+        for name, plan in plans.items():
+            for step in plan:
+                # "SCAN" means a full table scan
+                self.assertFalse(step.startswith("SCAN"), f"{name}: {step}")
+            for index in expected_indexes[name]:
+                self.assertTrue(any(index in step for step in plan), f"{name}: {index}")
+
+    def test_project_scoped_queries(self):
+        for name in ("raclette", "tartiflette"):
+            self.create_project(name)
+        raclette = models.Project.query.get("raclette")
+        tartiflette = models.Project.query.get("tartiflette")
+        zorglub = models.Person(name="zorglub", project=raclette)
+        fred = models.Person(name="fred", project=tartiflette)
+        bill = models.Bill(what="fromage", payer=zorglub, owers=[zorglub], amount=10)
+        db.session.add_all([zorglub, fred, bill])
+        db.session.commit()
+
+        with self.record_queries() as statements:
+            self.assertEqual(models.Person.query.get(zorglub.id, raclette), zorglub)
+            self.assertEqual(
+                models.Person.query.get_by_name("zorglub", raclette), zorglub
+            )
+            self.assertEqual(models.Bill.query.get(raclette, bill.id), bill)
+            self.assertEqual(raclette.get_bills().all(), [bill])
+            self.assertEqual(raclette.get_member_bills(zorglub.id).all(), [bill])
+
+        # Each table is either joined or filtered on, never cross joined
+        self.assertTrue(statements)
+        for statement in statements:
+            self.assertNotRegex(statement, r"FROM \w+(?: AS \w+)?, ")
+
+        # Members and bills of other projects are not reachable
+        with self.assertRaises(orm.exc.NoResultFound):
+            models.Person.query.get(fred.id, raclette)
+        with self.assertRaises(orm.exc.NoResultFound):
+            models.Person.query.get_by_name("fred", raclette)
+        self.assertIsNone(models.Bill.query.get(tartiflette, bill.id))
+        self.assertEqual(tartiflette.get_bills().all(), [])
+
+    def test_get_members_by_ids(self):
+        for name in ("raclette", "tartiflette"):
+            self.create_project(name)
+        raclette = models.Project.query.get("raclette")
+        tartiflette = models.Project.query.get("tartiflette")
+        members = [models.Person(name=f"m{i}", project=raclette) for i in range(30)]
+        fred = models.Person(name="fred", project=tartiflette)
+        db.session.add_all(members + [fred])
+        db.session.commit()
+
+        ids = [member.id for member in reversed(members)]
+        db.session.refresh(raclette)
+        with self.record_queries() as statements:
+            owers = models.Person.query.get_by_ids(ids + ids[:2], raclette)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(owers, list(reversed(members)))
+        self.assertEqual(models.Person.query.get_by_ids([], raclette), [])
+
+        with self.assertRaises(orm.exc.NoResultFound):
+            models.Person.query.get_by_ids(ids + [fred.id], raclette)
+
+    def populate_project(self, name, bills=2):
+        """Create a project with members, bills and a deleted member"""
+        self.create_project(name)
+        project = models.Project.query.get(name)
+        zorglub, fred, tata = (
+            models.Person(name=member, project=project)
+            for member in ("zorglub", "fred", "tata")
+        )
+        db.session.add_all([zorglub, fred, tata])
+        db.session.add_all(
+            models.Bill(
+                what="fromage",
+                date=datetime.date(2020, 1, 1),
+                amount=10,
+                converted_amount=10,
+                payer=zorglub,
+                owers=[zorglub, fred],
+            )
+            for _ in range(bills)
+        )
+        db.session.add(models.Archive(project_id=name, name="2019"))
+        db.session.commit()
+        db.session.delete(tata)
+        db.session.commit()
+
+    def count_rows(self):
+        return {
+            name: db.session.query(table).count()
+            for name, table in db.metadata.tables.items()
+        }
+
+    def test_remove_project(self):
+        self.populate_project("raclette", bills=20)
+        before = self.count_rows()
+        self.populate_project("tartiflette")
+        with self.record_queries() as statements:
+            models.Project.query.get("tartiflette").remove_project()
+        # One statement by table, whatever the size of the project
+        self.assertEqual(
+            len([statement for statement in statements if "DELETE" in statement]), 5
+        )
+
+        after = self.count_rows()
+        for table in ("project", "person", "bill", "billowers", "archive"):
+            self.assertEqual(after[table], before[table])
+        # The history is kept, and the deletion itself is not recorded
+        self.assertGreater(after["project_version"], before["project_version"])
+        self.assertEqual(models.Project.query.get("raclette").get_bills().count(), 20)
+
+        self.populate_project("tartiflette")
+        models.Project.query.get("tartiflette").remove_project(purge_history=True)
+        # Both generations of tartiflette have been purged
+        self.assertEqual(self.count_rows(), before)
+
+    def test_remove_project_in_background(self):
+        self.populate_project("raclette", bills=3)
+        project = models.Project.query.get("raclette")
+        self.assertFalse(project.should_remove_in_background())
+        self.app.config["BACKGROUND_DELETION_THRESHOLD"] = 3
+        self.assertTrue(project.should_remove_in_background())
+
+        with patch.object(
+            models.Project, "remove_project", side_effect=RuntimeError("boom")
+        ):
+            with patch.object(self.app.logger, "exception") as log_exception:
+                project.remove_project_in_background().join()
+        log_exception.assert_called_once_with("Could not remove project %s", "raclette")
+
+        thread = project.remove_project_in_background(purge_history=True)
+        self.assertTrue(thread.daemon)
+        thread.join()
+        db.session.remove()
+        self.assertEqual(models.Project.query.count(), 0)
+        self.assertEqual(models.Bill.query.count(), 0)
+
+        self.post_project("tartiflette")
+        self.login("tartiflette")
+        self.app.config["BACKGROUND_DELETION_THRESHOLD"] = 0
+        self.client.get("/tartiflette/delete")
+        self.assertEqual(models.Project.query.count(), 0)
+
+    def test_restore_project(self):
+        def restore(name, bills):
+            self.populate_project(name, bills=bills)
+            lines = list(snapshots.iter_snapshot([name]))
+            with self.record_queries() as statements:
+                restorer = snapshots.SnapshotRestorer({name: f"{name}-restored"})
+                restorer.run(lines)
+            return statements
+
+        small = restore("raclette", bills=2)
+        large = restore("tartiflette", bills=20)
+        # Bulk inserts, whatever the size of the project
+        self.assertEqual(len(large), len(small))
+
+        restored = models.Project.query.get("tartiflette-restored")
+        self.assertEqual(
+            restored.get_pretty_bills(),
+            models.Project.query.get("tartiflette").get_pretty_bills(),
+        )
+        self.assertEqual(
+            [member.name for member in restored.members], ["zorglub", "fred"]
+        )
+        # The rows reserving the ids of the deleted member are removed
+        self.assertEqual(
+            models.Person.query.filter_by(project_id="tartiflette-restored").count(), 2,
+        )
+
 
 def em_surround(string, regex_escape=False):
     if regex_escape:
@@ -2872,6 +4161,196 @@ class HistoryTestCase(IhatemoneyTestCase):
                 self.assertNotIn("owers", entry["prop_changed"])
         self.assertEqual(len(history_list), 6)
 
+    def test_deferred_versioning(self):
+        u1 = models.Person(project_id="demo", name="User 1")
+        u2 = models.Person(project_id="demo", name="User 2")
+        models.db.session.add_all([u1, u2])
+        models.db.session.commit()
+
+        with self.record_queries() as statements:
+            with deferred_versioning(models.db.session):
+                for i in range(10):
+                    models.db.session.add(
+                        models.Bill(
+                            what=f"Bill {i}", payer_id=u1.id, owers=[u1, u2], amount=i
+                        )
+                    )
+                    models.db.session.flush()
+                u2.name = "User 2 renamed"
+                models.db.session.commit()
+
+        # One INSERT statement per version table
+        for table in ("bill_version", "billowers_version", "person_version"):
+            inserts = [s for s in statements if s.startswith(f"INSERT INTO {table}")]
+            self.assertEqual(len(inserts), 1, table)
+
+        history_list = history.get_history(models.Project.query.get("demo"))
+        bill_entries = [e for e in history_list if e["object_type"] == "Bill"]
+        self.assertEqual(len(bill_entries), 10)
+        renames = [e for e in history_list if e.get("prop_changed") == "name"]
+        self.assertEqual(renames[0]["val_before"], "User 2")
+        self.assertEqual(renames[0]["val_after"], "User 2 renamed")
+
+        # The previous version of the member has been closed
+        person_versions = models.PersonVersion.query.filter_by(id=u2.id).all()
+        self.assertEqual(len(person_versions), 2)
+        self.assertEqual(
+            [v.end_transaction_id is None for v in person_versions], [False, True]
+        )
+
+        # Versioning is back to normal after the block
+        models.db.session.add(
+            models.Bill(what="Bill 11", payer_id=u1.id, owers=[u1], amount=11)
+        )
+        models.db.session.commit()
+        history_list = history.get_history(models.Project.query.get("demo"))
+        self.assertEqual(
+            len([e for e in history_list if e["object_type"] == "Bill"]), 11
+        )
+
+    def test_bulk_import_history(self):
+        from ihatemoney.imports import BillImporter
+
+        bills = [
+            {
+                "date": "2017-01-01",
+                "what": f"Bill {i}",
+                "amount": i + 1.0,
+                "payer_name": "User 1",
+                "payer_weight": 1.0,
+                "owers": ["User 1", "User 2"],
+            }
+            for i in range(5)
+        ]
+        with deferred_versioning(models.db.session):
+            BillImporter(models.Project.query.get("demo"), batch_size=2).run(bills)
+
+        history_list = history.get_history(models.Project.query.get("demo"))
+        bill_entries = [e for e in history_list if e["object_type"] == "Bill"]
+        self.assertEqual(len(bill_entries), 5)
+        self.assertEqual(
+            {e["object_desc"] for e in bill_entries}, {f"Bill {i}" for i in range(5)}
+        )
+        person_entries = [e for e in history_list if e["object_type"] == "Participant"]
+        self.assertEqual(len(person_entries), 2)
+
+        # Everything belongs to the same transaction
+        transactions = {
+            version.transaction_id for version in models.BillVersion.query.all()
+        } | {version.transaction_id for version in models.PersonVersion.query.all()}
+        self.assertEqual(len(transactions), 1)
+        owers = models.db.session.execute(
+            "SELECT bill_id, transaction_id FROM billowers_version"
+        ).fetchall()
+        self.assertEqual(len(owers), 10)
+        self.assertEqual({row[1] for row in owers}, transactions)
+
+    def test_snapshot_dump_restore(self):
+        self.client.post("/demo/members/add", data={"name": "zorglub", "weight": 2})
+        self.client.post("/demo/members/add", data={"name": "fred"})
+        self.client.post("/demo/members/add", data={"name": "tata"})
+        for what in ("fromage", "pain"):
+            self.client.post(
+                "/demo/add",
+                data={
+                    "date": "2011-08-10",
+                    "what": what,
+                    "payer": 1,
+                    "payed_for": [1, 2],
+                    "amount": "25",
+                },
+            )
+        self.client.post(
+            "/demo/edit/1",
+            data={
+                "date": "2011-08-10",
+                "what": "fromage à raclette",
+                "payer": 1,
+                "payed_for": [1, 2],
+                "amount": "10",
+            },
+        )
+        self.client.get("/demo/delete/2")
+        # Only remains in the history
+        self.client.post("/demo/members/3/delete")
+
+        count_owers = "SELECT COUNT(*) FROM billowers_version"
+        owers_versions = models.db.session.execute(count_owers).scalar()
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "snapshot.ndjson.gz")
+            DumpProjects().run(path, ["demo"])
+            RestoreProjects().run(path, ["demo:restored"])
+            with self.assertRaises(ValueError):
+                RestoreProjects().run(path, [])
+
+        demo = models.Project.query.get("demo")
+        restored = models.Project.query.get("restored")
+        self.assertEqual(restored.name, demo.name)
+        self.assertEqual(restored.password, demo.password)
+        self.assertEqual(restored.logging_preference, demo.logging_preference)
+        self.assertEqual(
+            [(m.name, m.weight, m.activated) for m in restored.members],
+            [(m.name, m.weight, m.activated) for m in demo.members],
+        )
+        self.assertEqual(restored.get_pretty_bills(), demo.get_pretty_bills())
+        self.assertNotEqual(
+            {m.id for m in restored.members}, {m.id for m in demo.members}
+        )
+
+        def strip_ids(entries):
+            return [
+                {key: value for key, value in entry.items() if key != "object_id"}
+                for entry in entries
+            ]
+
+        self.assertEqual(
+            strip_ids(history.get_history(restored)),
+            strip_ids(history.get_history(demo)),
+        )
+        # Nothing has been versioned while restoring
+        self.assertEqual(
+            models.PersonVersion.query.filter_by(project_id="restored").count(),
+            models.PersonVersion.query.filter_by(project_id="demo").count(),
+        )
+        self.assertEqual(
+            models.db.session.execute(count_owers).scalar(), 2 * owers_versions
+        )
+
+    def test_tracking_predicate_once_per_transaction(self):
+        u1 = models.Person(project_id="demo", name="User 1")
+        models.db.session.add(u1)
+        models.db.session.commit()
+
+        predicate = MagicMock(wraps=models.versioning_manager.tracking_predicate)
+        with patch.object(models.versioning_manager, "tracking_predicate", predicate):
+            for i in range(5):
+                models.db.session.add(
+                    models.Bill(what=f"Bill {i}", payer_id=u1.id, owers=[u1], amount=1)
+                )
+                models.db.session.flush()
+            models.db.session.commit()
+        self.assertEqual(predicate.call_count, 1)
+
+    def test_tracking_predicate_logging_change(self):
+        """Test that enabling the logging after a flush records the whole
+        transaction
+        """
+        project = models.Project.query.get("demo")
+        project.logging_preference = LoggingMode.DISABLED
+        db.session.commit()
+
+        with self.app.test_request_context():
+            g.project = project
+            db.session.add(models.Person(project_id="demo", name="before"))
+            db.session.flush()
+            project.logging_preference = LoggingMode.ENABLED
+            db.session.add(models.Person(project_id="demo", name="after"))
+            db.session.commit()
+
+        names = [version.name for version in models.PersonVersion.query]
+        self.assertEqual(sorted(names), ["after", "before"])
+
 
 class TestCurrencyConverter(unittest.TestCase):
     converter = CurrencyConverter()
@@ -2890,6 +4369,392 @@ class TestCurrencyConverter(unittest.TestCase):
         result = self.converter.exchange_currency(100, "USD", "EUR")
         self.assertEqual(result, 81.15)
 
+    def test_get_rates_without_app_context(self):
+        self.converter.fallback_cache.clear()
+        self.addCleanup(self.converter.fallback_cache.clear)
+        with patch.object(
+            CurrencyConverter, "fetch_rates", return_value=self.mock_data
+        ) as fetch:
+            rates = CurrencyConverter.get_rates(self.converter)
+            self.assertEqual(rates, self.mock_data)
+            self.assertEqual(CurrencyConverter.get_rates(self.converter), rates)
+        fetch.assert_called_once()
+
+
+class TransactionRetryTestCase(IhatemoneyTestCase):
+    SQLALCHEMY_DATABASE_URI = "sqlite:///" + os.path.join(
+        tempfile.gettempdir(), "ihatemoney-retries.db"
+    )
+    # Fail as soon as the database is locked, to exercise the retries
+    SQLITE_BUSY_TIMEOUT = 0
+    TRANSACTION_RETRIES = 50
+    TRANSACTION_RETRY_DELAY = 0.001
+
+    def setUp(self):
+        super().setUp()
+        transactions.retry_metrics.reset()
+
+    @staticmethod
+    def locked_error():
+        return sqlalchemy.exc.OperationalError(
+            "COMMIT", {}, sqlite3.OperationalError("database is locked")
+        )
+
+    def test_is_retryable(self):
+        self.assertTrue(transactions.is_retryable(self.locked_error()))
+
+        serialization_failure = Exception("could not serialize access")
+        serialization_failure.pgcode = "40001"
+        self.assertTrue(
+            transactions.is_retryable(
+                sqlalchemy.exc.OperationalError("COMMIT", {}, serialization_failure)
+            )
+        )
+        for error in (
+            sqlalchemy.exc.OperationalError(
+                "SELECT", {}, sqlite3.OperationalError("no such table: bill")
+            ),
+            sqlalchemy.exc.IntegrityError(
+                "INSERT", {}, sqlite3.IntegrityError("UNIQUE constraint failed")
+            ),
+            ValueError("database is locked"),
+        ):
+            self.assertFalse(transactions.is_retryable(error))
+
+    def test_run_transaction(self):
+        attempts = []
+
+        def fail_twice():
+            attempts.append(1)
+            if len(attempts) <= 2:
+                raise self.locked_error()
+            return "done"
+
+        with self.app.test_request_context():
+            self.assertEqual(transactions.run_transaction(fail_twice), "done")
+        self.assertEqual(len(attempts), 3)
+        self.assertEqual(
+            transactions.retry_metrics.as_dict(),
+            {"retries": 2, "recovered": 1, "failures": 0},
+        )
+
+        # Give up after the last retry
+        self.app.config["TRANSACTION_RETRIES"] = 1
+        attempts.clear()
+        with self.app.test_request_context():
+            with self.assertRaises(sqlalchemy.exc.OperationalError):
+                transactions.run_transaction(fail_twice)
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(
+            transactions.retry_metrics.as_dict(),
+            {"retries": 3, "recovered": 1, "failures": 1},
+        )
+
+        # Other errors are not retried
+        def fail():
+            attempts.append(1)
+            raise sqlalchemy.exc.IntegrityError("INSERT", {}, Exception())
+
+        attempts.clear()
+        with self.app.test_request_context():
+            with self.assertRaises(sqlalchemy.exc.IntegrityError):
+                transactions.run_transaction(fail)
+        self.assertEqual(len(attempts), 1)
+
+        # The counters can be read on the admin dashboard
+        self.app.config["ACTIVATE_ADMIN_DASHBOARD"] = True
+        with self.client.session_transaction() as session:
+            session["is_admin"] = True
+        resp = self.client.get("/dashboard/metrics.json")
+        self.assertEqual(
+            json.loads(resp.data.decode("utf-8"))["transaction_retries"],
+            transactions.retry_metrics.as_dict(),
+        )
+
+    def test_concurrent_bills(self):
+        """Test that bills added from many threads at once are all saved, the
+        transactions which found the database locked being retried
+        """
+        self.create_project("raclette")
+        project = models.Project.query.get("raclette")
+        db.session.add_all(
+            models.Person(name=name, project=project) for name in ("zorglub", "fred")
+        )
+        db.session.commit()
+        member_ids = [member.id for member in project.members]
+        db.session.remove()
+
+        statuses = []
+        auth = base64.b64encode(b"raclette:raclette").decode("utf-8")
+
+        def post_bills():
+            client = self.app.test_client()
+            for i in range(5):
+                resp = client.post(
+                    "/api/projects/raclette/bills",
+                    data={
+                        "date": "2011-08-10",
+                        "what": "fromage",
+                        "payer": member_ids[0],
+                        "payed_for": member_ids,
+                        "amount": "25",
+                    },
+                    headers={"Authorization": f"Basic {auth}"},
+                )
+                statuses.append(resp.status_code)
+
+        threads = [threading.Thread(target=post_bills) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(statuses, [201] * 50)
+        self.assertEqual(models.Bill.query.count(), 50)
+        self.assertEqual(transactions.retry_metrics.as_dict()["failures"], 0)
+
+
+class CacheTestCase(IhatemoneyTestCase):
+    CACHE_NAMESPACES = {"projects": {"size": 0}, "rates": {"size": 2, "ttl": 60}}
+
+    def setUp(self):
+        super().setUp()
+        self.cache_path = os.path.join(tempfile.mkdtemp(), "cache.db")
+
+    def sqlite_cache(self, namespace="test", size=3, ttl=None, secret=b"secret"):
+        return cache.Cache(
+            namespace,
+            cache.SQLiteBackend(namespace, size, self.cache_path),
+            ttl,
+            secret=secret,
+        )
+
+    def check_cache(self, make_cache):
+        values = make_cache(size=3)
+        self.assertIsNone(values.get("a"))
+        self.assertEqual(values.get("a", 0), 0)
+        values.set("a", {"value": 1})
+        self.assertEqual(values.get("a"), {"value": 1})
+        # Each get returns its own copy
+        values.get("a")["value"] = 2
+        self.assertEqual(values.get("a"), {"value": 1})
+        values.delete("a")
+        self.assertIsNone(values.get("a"))
+        self.assertEqual(values.get_or_set("b", lambda: 2), 2)
+        self.assertEqual(values.get_or_set("b", lambda: 3), 2)
+
+        # Expired values are misses
+        values.set("c", 3, ttl=0.01)
+        sleep(0.02)
+        self.assertIsNone(values.get("c"))
+        values.set("d", 4)
+        values.clear()
+        self.assertIsNone(values.get("d"))
+        self.assertEqual(values.stats(), {"hits": 0, "misses": 1, "hit_rate": 0.0})
+
+    def test_memory_backend(self):
+        self.check_cache(
+            lambda size: cache.Cache("test", cache.MemoryBackend("test", size))
+        )
+
+        # The least recently used values are dropped first
+        values = cache.Cache("test", cache.MemoryBackend("test", 2))
+        values.set("a", 1)
+        values.set("b", 2)
+        values.get("a")
+        values.set("c", 3)
+        self.assertEqual([values.get(key) for key in "abc"], [1, None, 3])
+
+    def test_sqlite_backend(self):
+        self.check_cache(self.sqlite_cache)
+
+        # Values are shared by the backends using the same file, by namespace
+        first, second = self.sqlite_cache(), self.sqlite_cache()
+        first.set("a", 1)
+        self.assertEqual(second.get("a"), 1)
+        self.assertIsNone(self.sqlite_cache("other").get("a"))
+        second.set("a", 2, ttl=60)
+        self.assertEqual(first.get("a"), 2)
+
+        # Prunes drop the values stored first, over the size
+        for key in "bcde":
+            first.set(key, key)
+            sleep(0.001)
+        first.backend.prune()
+        self.assertEqual(
+            [second.get(key) for key in "abcde"], [None, None] + list("cde")
+        )
+
+        # Other threads use their own connection
+        results = []
+        thread = threading.Thread(target=lambda: results.append(first.get("e")))
+        thread.start()
+        thread.join()
+        self.assertEqual(results, ["e"])
+
+    def test_signatures(self):
+        values = self.sqlite_cache()
+        values.set("a", 1)
+        values.set("b", 2)
+        self.assertEqual(os.stat(self.cache_path).st_mode & 0o777, 0o600)
+
+        # Values written with another secret, or under another key, are
+        # never unpickled
+        self.assertIsNone(self.sqlite_cache(secret=b"other").get("a"))
+        connection = sqlite3.connect(self.cache_path)
+        with connection:
+            connection.execute(
+                "UPDATE cache SET value = (SELECT value FROM cache WHERE key = 'b') "
+                "WHERE key = 'a'"
+            )
+        connection.close()
+        with patch("pickle.loads") as loads:
+            self.assertIsNone(values.get("a"))
+        loads.assert_not_called()
+        self.assertEqual(values.get("b"), 2)
+
+        with self.assertRaises(ValueError):
+            cache.SQLiteBackend("test", 3)
+
+    def test_backend_errors(self):
+        backend = MagicMock()
+        backend.get.side_effect = backend.set.side_effect = OSError("unreachable")
+        logger = MagicMock()
+        values = cache.Cache("test", backend, logger=logger)
+        values.set("a", 1)
+        # Errors are misses
+        self.assertEqual(values.get_or_set("a", lambda: 2), 2)
+        self.assertEqual(logger.warning.call_count, 3)
+
+    def test_namespaces(self):
+        caches = self.app.caches
+        self.assertEqual(
+            set(caches),
+            {
+                "projects",
+                "exchange_rates",
+                "auth",
+                "login_attempts",
+                "fragments",
+                "rates",
+            },
+        )
+        self.assertEqual(caches["auth"].ttl, 300)
+        self.assertEqual(caches["rates"].ttl, 60)
+        self.assertEqual(caches["rates"].backend.items.size, 2)
+
+        # The projects are not cached
+        self.create_project("raclette")
+        self.login("raclette")
+        self.app.project_cache.clear()
+        self.client.get("/raclette/")
+        self.client.get("/raclette/")
+        self.assertEqual(self.app.project_cache.stats()["misses"], 2)
+
+        self.app.config["CACHE_BACKEND"] = "sqlite"
+        self.app.config["CACHE_URL"] = self.cache_path
+        self.app.config["CACHE_NAMESPACES"] = {"auth": {"backend": "memory"}}
+        caches = cache.create_caches(self.app)
+        self.assertIsInstance(caches["projects"].backend, cache.SQLiteBackend)
+        self.assertIsInstance(caches["auth"].backend, cache.MemoryBackend)
+        self.assertEqual(caches["projects"].backend.size, 256)
+
+    def test_exchange_rates(self):
+        with patch.object(
+            CurrencyConverter, "fetch_rates", return_value={"USD": 1.0}
+        ) as fetch:
+            converter = CurrencyConverter()
+            rates = CurrencyConverter.get_rates(converter)
+            self.assertEqual(rates, {"USD": 1.0})
+            self.assertEqual(CurrencyConverter.get_rates(converter), rates)
+        fetch.assert_called_once()
+        self.assertEqual(self.app.caches["exchange_rates"].stats()["hits"], 1)
+
+
+class PreloadTestCase(unittest.TestCase):
+    # Load the application, fork a worker which queries the database and
+    # renders a template, and print the memory of the worker, in kB
+    script = """
+import gc, json, os, sys
+from ihatemoney.run import after_fork, create_app, prepare_fork
+
+class Config:
+    SQLALCHEMY_DATABASE_URI = sys.argv[1]
+    SECRET_KEY = "PRELOAD"
+
+app = create_app(Config)
+prepare_fork(app)
+if os.fork() == 0:
+    after_fork(app)
+    from ihatemoney.models import Project
+    with app.test_request_context():
+        Project.query.count()
+        app.jinja_env.get_template("layout.html")
+    gc.collect()
+    with open("/proc/self/smaps_rollup") as smaps:
+        memory = dict(line.split()[:2] for line in smaps if line.endswith("kB\\n"))
+    sys.stdout.write(json.dumps(memory))
+    sys.stdout.flush()
+    os._exit(0)
+os.wait()
+"""
+
+    @unittest.skipUnless(
+        hasattr(gc, "freeze") and os.path.exists("/proc/self/smaps_rollup"),
+        "needs gc.freeze and Linux",
+    )
+    def test_worker_memory(self):
+        """Test that a worker shares most of its memory with the preloaded
+        application it was forked from
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            database = "sqlite:///" + os.path.join(tmpdir, "preload.db")
+            process = subprocess.run(
+                [sys.executable, "-c", self.script, database],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                universal_newlines=True,
+                check=True,
+            )
+        memory = {key: int(value) for key, value in json.loads(process.stdout).items()}
+        shared = memory["Shared_Clean:"] + memory["Shared_Dirty:"]
+        private = memory["Private_Clean:"] + memory["Private_Dirty:"]
+        self.assertGreater(shared, private)
+
+
+class LazyImportsTestCase(unittest.TestCase):
+    # Only needed by a few commands and pages, and slow to import
+    lazy_modules = (
+        "alembic",
+        "flask_migrate",
+        "requests",
+        "email_validator",
+        "flask_mail",
+    )
+
+    def loaded_modules(self, module):
+        """Import the module in a new interpreter, and return the names of
+        the loaded modules
+        """
+        process = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                f"import json, sys, {module}; print(json.dumps(list(sys.modules)))",
+            ],
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+            check=True,
+        )
+        return set(json.loads(process.stdout.splitlines()[-1]))
+
+    def test_lazy_imports(self):
+        for module in ("ihatemoney.run", "ihatemoney.manage"):
+            modules = self.loaded_modules(module)
+            self.assertIn(module, modules)
+            for lazy_module in self.lazy_modules:
+                self.assertNotIn(lazy_module, modules)
+
 
 if __name__ == "__main__":
     unittest.main()
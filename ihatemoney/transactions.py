@@ -0,0 +1,104 @@
+"""Write transactions of the web views and the API.
+
+Retries
+-------
+
+Some errors go away when the whole transaction is run again: "database is
+locked" with SQLite, serialization failures and deadlocks with Postgres and
+MySQL. run_transaction() rolls back and runs the transaction again after a
+random delay, which doubles after each attempt, up to TRANSACTION_RETRIES
+times. The retries of each process are counted in retry_metrics.
+"""
+import random
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy.exc import DBAPIError
+
+from ihatemoney.models import db
+
+# SQLSTATE of the Postgres serialization failures and deadlocks
+RETRYABLE_SQLSTATES = ("40001", "40P01")
+# Codes of the MySQL lock wait timeouts and deadlocks
+RETRYABLE_MYSQL_ERRORS = (1205, 1213)
+# Messages of the SQLite busy errors
+RETRYABLE_SQLITE_ERRORS = ("database is locked", "database table is locked")
+
+
+def is_retryable(error):
+    """Tell if the transaction which raised error may succeed when retried"""
+    if not isinstance(error, DBAPIError):
+        return False
+    if getattr(error.orig, "pgcode", None) in RETRYABLE_SQLSTATES:
+        return True
+    args = getattr(error.orig, "args", ())
+    return bool(args) and (
+        args[0] in RETRYABLE_MYSQL_ERRORS or str(args[0]) in RETRYABLE_SQLITE_ERRORS
+    )
+
+
+class RetryMetrics:
+    """Counters of the retried transactions of the process:
+
+    - retries: attempts which failed and were run again
+    - recovered: transactions which succeeded after at least one retry
+    - failures: transactions which still failed after the last retry
+    """
+
+    names = ("retries", "recovered", "failures")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = dict.fromkeys(self.names, 0)
+
+    def increment(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def as_dict(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+retry_metrics = RetryMetrics()
+
+
+def run_transaction(func):
+    """Run func, which writes with db.session and commits, and return its
+    result. Run it again when it fails with an error which may go away.
+
+    func must be safe to run several times: the session is rolled back
+    before each retry.
+    """
+    app = current_app._get_current_object()
+    retries = app.config["TRANSACTION_RETRIES"]
+    delay = app.config["TRANSACTION_RETRY_DELAY"]
+    for attempt in range(retries + 1):
+        try:
+            result = func()
+        except DBAPIError as error:
+            if not is_retryable(error):
+                raise
+            db.session.rollback()
+            if attempt == retries:
+                retry_metrics.increment("failures")
+                raise
+            retry_metrics.increment("retries")
+            app.logger.warning(
+                "Retrying a transaction (attempt %d/%d): %s",
+                attempt + 1,
+                retries,
+                error.orig,
+            )
+            # Full jitter, so that the transactions which collided do not
+            # collide again
+            time.sleep(random.uniform(0, delay * 2 ** attempt))
+        else:
+            if attempt:
+                retry_metrics.increment("recovered")
+            return result
@@ -1,19 +1,30 @@
 import ast
+import codecs
 import csv
 from datetime import datetime, timedelta
 from enum import Enum
-from io import BytesIO, StringIO
-from json import JSONEncoder, dumps
+from io import StringIO
+from json import JSONDecodeError, JSONDecoder, JSONEncoder, dumps
 import operator
 import os
 import re
+import unicodedata
+import zlib
 
 from babel import Locale
 from babel.numbers import get_currency_name, get_currency_symbol
 from flask import current_app, redirect, render_template
 from flask_babel import get_locale, lazy_gettext as _
 import jinja2
+from werkzeug.datastructures import Headers
 from werkzeug.routing import HTTPException, RoutingException
+from werkzeug.urls import url_quote
+
+# Whitespaces allowed between json tokens
+JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+# Length of the longest json token reported as invalid when truncated, such as
+# -Infinity or an \uXXXX escape
+JSON_LONGEST_TOKEN = 9
 
 
 def slugify(value):
@@ -21,8 +32,6 @@ def slugify(value):
     and converts spaces to hyphens.
     """
     if isinstance(value, str):
-        import unicodedata
-
         value = unicodedata.normalize("NFKD", value)
     value = str(re.sub(r"[^\w\s-]", "", value).strip().lower())
     return re.sub(r"[-\s]+", "-", value)
@@ -79,6 +88,33 @@ class PrefixedWSGI(object):
         return self.wsgi_app(environ, start_response)
 
 
+class LazyMail:
+    """The flask_mail.Mail of an application, which imports Flask-Mail and
+    sets it up when it is first used: most processes never send emails.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.mail = None
+
+    def get_mail(self):
+        if self.mail is None:
+            from flask_mail import Mail
+
+            self.mail = Mail(self.app)
+        return self.mail
+
+    def __getattr__(self, name):
+        return getattr(self.get_mail(), name)
+
+    def message(self, *args, **kwargs):
+        """Build a flask_mail.Message, which needs Flask-Mail to be set up"""
+        self.get_mail()
+        from flask_mail import Message
+
+        return Message(*args, **kwargs)
+
+
 def minimal_round(*args, **kw):
     """ Jinja2 filter: rounds, but display only non-zero decimals
 
@@ -102,72 +138,218 @@ def locale_from_iso(iso_code):
     return Locale.parse(iso_code)
 
 
-def list_of_dicts2json(dict_to_convert):
-    """Take a list of dictionnaries and turns it into
-    a json in-memory file
+def buffered(chunks, size=16384):
+    """Group small text chunks into utf-8 encoded blocks of about `size` bytes"""
+    buffer = StringIO()
+    for chunk in chunks:
+        buffer.write(chunk)
+        if buffer.tell() >= size:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+def chunked(iterable, size):
+    """Split an iterable into lists of at most `size` items"""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_dicts2json(dicts):
+    """Take an iterable of dictionnaries and encode it as a json list,
+    block by block
     """
-    return BytesIO(dumps(dict_to_convert).encode("utf-8"))
 
+    def chunks():
+        yield "["
+        for index, dic in enumerate(dicts):
+            if index:
+                yield ", "
+            yield dumps(dic)
+        yield "]"
+
+    return buffered(chunks())
 
-def list_of_dicts2csv(dict_to_convert):
-    """Take a list of dictionnaries and turns it into
-    a csv in-memory file, assume all dict have the same keys
+
+def iter_dicts2csv(dicts):
+    """Take an iterable of dictionnaries and encode it as csv, block by
+    block. Assume all dict have the same keys
     """
-    # CSV writer has a different behavior in PY2 and PY3
-    # http://stackoverflow.com/a/37974772
+
+    def chunks():
+        line = StringIO()
+        writer = csv.writer(line)
+        keys = None
+        for dic in dicts:
+            if keys is None:
+                keys = list(dic.keys())
+                writer.writerow(keys)
+            writer.writerow([dic[key] for key in keys])
+            yield line.getvalue()
+            line.seek(0)
+            line.truncate()
+        # Header only
+        yield line.getvalue()
+
+    return buffered(chunks())
+
+
+def iter_dicts2ndjson(dicts):
+    """Take an iterable of dictionnaries and encode it as newline delimited
+    json (one json object per line), block by block
+    """
+    return buffered(f"{dumps(dic)}\n" for dic in dicts)
+
+
+def gzipped(blocks, compresslevel=6):
+    """Compress an iterable of bytes blocks into a gzip stream, on the fly"""
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for block in blocks:
+        data = compressor.compress(block)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def iter_json_array(file, chunk_size=65536):
+    """Parse a json array from a file object and yield its items one by one,
+    without loading the whole file in memory.
+
+    The file can be opened in text or binary mode, bytes are decoded as
+    utf-8. Raise ValueError if the file is not a valid json array.
+    """
+    decoder = JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer, pos, eof = "", 0, False
+
+    def read():
+        nonlocal buffer, pos, eof
+        chunk = file.read(chunk_size)
+        eof = not chunk
+        if isinstance(chunk, bytes):
+            chunk = text_decoder.decode(chunk, final=eof)
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+    def next_char():
+        """Skip whitespaces, return the next character or None at the end"""
+        nonlocal pos
+        while True:
+            match = JSON_WHITESPACE.match(buffer, pos)
+            pos = match.end()
+            if pos < len(buffer):
+                return buffer[pos]
+            if eof:
+                return None
+            read()
+
+    read()
+    if next_char() != "[":
+        raise ValueError("Expected a json array")
+    pos += 1
+    if next_char() == "]":
+        pos += 1
+    else:
+        while True:
+            next_char()
+            # Read until the item is complete: a truncated number still
+            # decodes, so the item must be followed by a delimiter
+            while True:
+                try:
+                    item, end = decoder.raw_decode(buffer, pos)
+                except JSONDecodeError as error:
+                    # Only read more when the error may come from the end of
+                    # the buffer, otherwise the item is invalid anyway
+                    near_end = error.pos >= len(buffer) - JSON_LONGEST_TOKEN
+                    unterminated = error.msg.startswith("Unterminated string")
+                    if eof or not (near_end or unterminated):
+                        raise
+                    end = None
+                if end is not None and (
+                    eof or (end < len(buffer) and buffer[end] in ",] \t\n\r")
+                ):
+                    break
+                read()
+            pos = end
+            yield item
+
+            char = next_char()
+            pos += 1
+            if char == "]":
+                break
+            if char != ",":
+                raise ValueError("Expected ',' or ']' in json array")
+    if next_char() is not None:
+        raise ValueError("Extra data after json array")
+
+
+def attachment_headers(filename):
+    """Return the Content-Disposition header of a file download, supporting
+    non latin-1 filenames like flask.send_file() does
+    """
+    headers = Headers()
     try:
-        csv_file = StringIO()
-        # using list() for py3.4 compat. Otherwise, writerows() fails
-        # (expecting a sequence getting a view)
-        csv_data = [list(dict_to_convert[0].keys())]
-        for dic in dict_to_convert:
-            csv_data.append([dic[h] for h in dict_to_convert[0].keys()])
-    except (KeyError, IndexError):
-        csv_data = []
-    writer = csv.writer(csv_file)
-    writer.writerows(csv_data)
-    csv_file.seek(0)
-    csv_file = BytesIO(csv_file.getvalue().encode("utf-8"))
-    return csv_file
+        filename.encode("latin-1")
+        options = {"filename": filename}
+    except UnicodeEncodeError:
+        options = {
+            "filename": unicodedata.normalize("NFKD", filename).encode(
+                "latin-1", "ignore"
+            ),
+            "filename*": f"UTF-8''{url_quote(filename, safe=b'')}",
+        }
+    headers.add("Content-Disposition", "attachment", **options)
+    return headers
 
 
 class LoginThrottler:
     """Simple login throttler used to limit authentication attempts based on client's ip address.
-    When using multiple workers, remaining number of attempts can get inconsistent
-    but will still be limited to num_workers * max_attempts.
+    The attempts are kept in the "login_attempts" cache, so the workers share
+    them when it is not kept in memory. Attempts counted at the same time by
+    several workers may be lost, but the attempts are still limited to
+    num_workers * max_attempts.
     """
 
     def __init__(self, max_attempts=3, delay=1):
         self._max_attempts = max_attempts
         # Delay in minutes before resetting the attempts counter
         self._delay = delay
-        self._attempts = {}
+
+    @property
+    def _attempts(self):
+        return current_app.caches["login_attempts"]
 
     def get_remaining_attempts(self, ip):
         return self._max_attempts - self._attempts.get(ip, [datetime.now(), 0])[1]
 
     def increment_attempts_counter(self, ip):
-        # Reset all attempt counters when they get hungry for memory
-        if len(self._attempts) > 10000:
-            self.__init__()
-        if self._attempts.get(ip) is None:
-            # Store first attempt date and number of attempts since
-            self._attempts[ip] = [datetime.now(), 0]
-        self._attempts.get(ip)[1] += 1
+        # Store first attempt date and number of attempts since
+        attempts = self._attempts.get(ip, [datetime.now(), 0])
+        attempts[1] += 1
+        self._attempts.set(ip, attempts)
 
     def is_login_allowed(self, ip):
-        if self._attempts.get(ip) is None:
+        attempts = self._attempts.get(ip)
+        if attempts is None:
             return True
         # When the delay is expired, reset the counter
-        if datetime.now() - self._attempts.get(ip)[0] > timedelta(minutes=self._delay):
+        if datetime.now() - attempts[0] > timedelta(minutes=self._delay):
             self.reset(ip)
             return True
-        if self._attempts.get(ip)[1] >= self._max_attempts:
+        if attempts[1] >= self._max_attempts:
             return False
         return True
 
     def reset(self, ip):
-        self._attempts.pop(ip, None)
+        self._attempts.delete(ip)
 
 
 def create_jinja_env(folder, strict_rendering=False):
@@ -238,25 +420,21 @@ def eval_arithmetic_expression(expr):
     return result
 
 
-def get_members(file):
-    members_list = list()
-    for item in file:
-        if (item["payer_name"], item["payer_weight"]) not in members_list:
-            members_list.append((item["payer_name"], item["payer_weight"]))
-    for item in file:
-        for ower in item["owers"]:
-            if ower not in [i[0] for i in members_list]:
-                members_list.append((ower, 1))
-
-    return members_list
+def bill_key(bill):
+    """Return a hashable representation of a bill, as exported by
+    Project.iter_pretty_bills(), so that duplicates can be found with a set
+    or a dict rather than by comparing bills two by two.
 
-
-def same_bill(bill1, bill2):
-    attr = ["what", "payer_name", "payer_weight", "amount", "date", "owers"]
-    for a in attr:
-        if bill1[a] != bill2[a]:
-            return False
-    return True
+    The order of the owers does not matter.
+    """
+    return (
+        bill["what"],
+        bill["payer_name"],
+        bill["payer_weight"],
+        bill["amount"],
+        bill["date"],
+        tuple(sorted(bill["owers"])),
+    )
 
 
 class FormEnum(Enum):
@@ -1,10 +1,27 @@
-from flask import g
+from contextlib import contextmanager
+
+from flask import g, has_app_context
+import sqlalchemy as sa
 from sqlalchemy.orm.attributes import get_history
-from sqlalchemy_continuum import VersioningManager
+from sqlalchemy_continuum import UnitOfWork, VersioningManager, version_class
+from sqlalchemy_continuum.operation import Operation
 from sqlalchemy_continuum.plugins.flask import fetch_remote_addr
+from sqlalchemy_continuum.utils import versioned_column_properties
 
 from ihatemoney.utils import FormEnum
 
+# Key of the session.info flag enabling deferred versioning, see
+# deferred_versioning()
+DEFERRED_VERSIONING = "ihatemoney_deferred_versioning"
+
+# Key of the session.info flag disabling versioning, see
+# ConditionalVersioningManager.versioning_disabled()
+VERSIONING_DISABLED = "ihatemoney_versioning_disabled"
+
+# Maximum number of ids used in a single "IN" clause, to stay under the
+# SQLite bound parameters limit.
+VERSION_VALIDITY_CHUNK_SIZE = 500
+
 
 class LoggingMode(FormEnum):
     """Represents a project's history preferences."""
@@ -18,31 +35,243 @@ class LoggingMode(FormEnum):
         return cls.ENABLED
 
 
+class BatchedUnitOfWork(UnitOfWork):
+    """Unit of work which is able to defer the creation of version records.
+
+    By default, version records are written after each flush, like
+    SQLAlchemy-Continuum does. When deferred versioning is enabled on the
+    session, operations are only collected during the flushes and all the
+    version records of the transaction are written right before the commit,
+    using one bulk INSERT statement per version table.
+    """
+
+    def reset(self, session=None):
+        super().reset(session)
+        # Result of the tracking predicate, evaluated once per transaction
+        self.tracking_enabled = None
+        self.deferred = False
+
+    def process_after_flush(self, session):
+        if session.info.get(DEFERRED_VERSIONING):
+            self.deferred = True
+        if self.deferred:
+            # Operations and association statements are kept until
+            # write_deferred_versions() is called
+            return
+        super().process_after_flush(session)
+
+    def create_association_versions(self, session):
+        """Write pending association versions, one statement per table."""
+        tx_column = self.manager.options["transaction_column_name"]
+        rows_by_table = {}
+        for stmt in self.pending_statements:
+            # Values given to the statement, compiling it is much slower
+            params = dict(stmt.parameters)
+            params[tx_column] = self.current_transaction.id
+            rows_by_table.setdefault(stmt.table, []).append(params)
+        for table, rows in rows_by_table.items():
+            session.execute(table.insert(), rows)
+        self.pending_statements = []
+
+    def write_deferred_versions(self, session):
+        """Write all the version records collected during this transaction."""
+        if not self.deferred or not self.current_transaction:
+            return
+        if not self.manager.options["versioning"]:
+            return
+
+        if self.pending_statements:
+            self.create_association_versions(session)
+
+        if not self.operations:
+            return
+
+        self.manager.plugins.before_create_version_objects(self, session)
+        tx_column = self.manager.options["transaction_column_name"]
+        end_tx_column = self.manager.options["end_transaction_column_name"]
+        operation_column = self.manager.options["operation_type_column_name"]
+
+        rows_by_class = {}
+        for key, operation in self.operations.items():
+            if operation.processed:
+                continue
+            target = operation.target
+            row = {}
+            for prop in versioned_column_properties(target):
+                try:
+                    value = getattr(target, prop.key)
+                except sa.orm.exc.ObjectDeletedError:
+                    value = None
+                row[prop.columns[0].name] = value
+            row[tx_column] = self.current_transaction.id
+            row[end_tx_column] = None
+            row[operation_column] = operation.type
+            rows_by_class.setdefault(version_class(target.__class__), []).append(row)
+            operation.processed = True
+
+        for cls, rows in rows_by_class.items():
+            table = cls.__table__
+            (pk,) = [column for column in table.primary_key if column.name != tx_column]
+            # Close the validity range of the previous versions
+            ids = [row[pk.name] for row in rows]
+            for index in range(0, len(ids), VERSION_VALIDITY_CHUNK_SIZE):
+                session.execute(
+                    table.update()
+                    .where(pk.in_(ids[index : index + VERSION_VALIDITY_CHUNK_SIZE]))
+                    .where(table.c[tx_column] < self.current_transaction.id)
+                    .where(table.c[end_tx_column].is_(None))
+                    .values({end_tx_column: self.current_transaction.id})
+                )
+            session.execute(table.insert(), rows)
+
+        self.manager.plugins.after_create_version_objects(self, session)
+
+    def create_bulk_versions(self, session, cls, mappings):
+        """Write the version records of objects inserted in bulk, without the
+        flush events
+        """
+        if not self.current_transaction:
+            self.create_transaction(session)
+        tx_column = self.manager.options["transaction_column_name"]
+        end_tx_column = self.manager.options["end_transaction_column_name"]
+        operation_column = self.manager.options["operation_type_column_name"]
+
+        properties = list(versioned_column_properties(cls))
+        rows = []
+        for mapping in mappings:
+            row = {prop.columns[0].name: mapping.get(prop.key) for prop in properties}
+            row[tx_column] = self.current_transaction.id
+            row[end_tx_column] = None
+            row[operation_column] = Operation.INSERT
+            rows.append(row)
+        session.execute(version_class(cls).__table__.insert(), rows)
+
+
 class ConditionalVersioningManager(VersioningManager):
     """Conditionally enable version tracking based on the given predicate."""
 
     def __init__(self, tracking_predicate, *args, **kwargs):
         """Create version entry iff tracking_predicate() returns True."""
+        kwargs.setdefault("unit_of_work_cls", BatchedUnitOfWork)
         super().__init__(*args, **kwargs)
         self.tracking_predicate = tracking_predicate
 
+    def reset(self):
+        super().reset()
+        self.session_listeners["before_commit"] = self.before_commit
+
+    def is_tracking(self, session):
+        """Evaluate the tracking predicate once per transaction, and again
+        when the logging preference of the project is about to change.
+
+        This also makes sure at least one call to unit_of_work() is made
+        against the session object, to prevent a KeyError later.
+        """
+        uow = self.unit_of_work(session)
+        if session.info.get(VERSIONING_DISABLED):
+            return False
+        if uow.tracking_enabled is None or logging_preference_changed():
+            uow.tracking_enabled = self.tracking_predicate()
+        return uow.tracking_enabled
+
+    @contextmanager
+    def versioning_disabled(self, session):
+        """Do not write any version record inside this block.
+
+        This is meant for bulk loads which write the version tables
+        themselves, such as snapshot restores.
+        """
+        previous = session.info.get(VERSIONING_DISABLED, False)
+        session.info[VERSIONING_DISABLED] = True
+        # Bind the session to its connection, so that the statements on the
+        # association tables are recognized as not versioned
+        self.unit_of_work(session)
+        try:
+            yield session
+        finally:
+            session.info[VERSIONING_DISABLED] = previous
+
+    def track_association_operations(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        """Do not collect association operations which will not be versioned"""
+        for session, connection in self.session_connection_map.items():
+            if connection is conn and session.info.get(VERSIONING_DISABLED):
+                return
+        uow = self.units_of_work.get(conn)
+        if uow is not None and uow.tracking_enabled is False:
+            return
+        return super().track_association_operations(
+            conn, cursor, statement, parameters, context, executemany
+        )
+
     def before_flush(self, session, flush_context, instances):
-        if self.tracking_predicate():
+        if self.is_tracking(session):
             return super().before_flush(session, flush_context, instances)
-        else:
-            # At least one call to unit_of_work() needs to be made against the
-            # session object to prevent a KeyError later. This doesn't create
-            # a version or transaction entry
-            self.unit_of_work(session)
 
     def after_flush(self, session, flush_context):
-        if self.tracking_predicate():
+        if self.is_tracking(session):
             return super().after_flush(session, flush_context)
-        else:
-            # At least one call to unit_of_work() needs to be made against the
-            # session object to prevent a KeyError later. This doesn't create
-            # a version or transaction entry
-            self.unit_of_work(session)
+
+    def bulk_insert_versions(self, session, cls, mappings):
+        """Write the version records of new objects inserted in bulk, with one
+        statement per table. The mappings must hold their primary keys.
+        """
+        if self.is_tracking(session) and self.options["versioning"]:
+            self.unit_of_work(session).create_bulk_versions(session, cls, mappings)
+
+    def bulk_insert_associations(self, session, table, rows):
+        """Insert rows into an association table and write their version
+        records, with one statement per table.
+        """
+        # The unit of work must exist before the insert, association tables
+        # being tracked at the statement level
+        tracking = self.is_tracking(session)
+        session.execute(table.insert(), rows)
+        if tracking and self.options["versioning"]:
+            uow = self.unit_of_work(session)
+            if not uow.current_transaction:
+                uow.create_transaction(session)
+            uow.create_association_versions(session)
+
+    def before_commit(self, session):
+        """Write the deferred version records before the transaction ends."""
+        if session.transaction.nested:
+            return
+        conn = self.session_connection_map.get(session)
+        uow = self.units_of_work.get(conn)
+        if uow is None or not uow.deferred:
+            return
+        # The final flush happens after the before_commit event, do it now so
+        # that no operation is missed
+        session.flush()
+        uow.write_deferred_versions(session)
+
+
+@contextmanager
+def deferred_versioning(session):
+    """Write the version records of the current transaction in bulk.
+
+    Inside this block, the version records are not written at each flush but
+    collected and inserted in one statement per table when the transaction is
+    committed. This is meant for bulk operations, such as imports.
+    """
+    previous = session.info.get(DEFERRED_VERSIONING, False)
+    session.info[DEFERRED_VERSIONING] = True
+    try:
+        yield session
+    finally:
+        session.info[DEFERRED_VERSIONING] = previous
+
+
+def logging_preference_changed():
+    """Tell if the logging preference of the current project has changes which
+    are not flushed yet
+    """
+    project = g.get("project") if has_app_context() else None
+    if project is None:
+        return False
+    return get_history(project, "logging_preference").has_changes()
 
 
 def version_privacy_predicate():
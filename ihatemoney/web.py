@@ -10,28 +10,28 @@ and `add_project_id` for a quick overview)
 """
 from datetime import datetime
 from functools import wraps
-import json
 import os
 from smtplib import SMTPRecipientsRefused
 
-from dateutil.parser import parse
 from dateutil.relativedelta import relativedelta
 from flask import (
     Blueprint,
+    Response,
     abort,
     current_app,
     flash,
     g,
+    jsonify,
     redirect,
     render_template,
     request,
-    send_file,
     send_from_directory,
     session,
+    stream_with_context,
     url_for,
 )
 from flask_babel import gettext as _
-from flask_mail import Message
+import sqlalchemy
 from sqlalchemy import orm
 from sqlalchemy_continuum import Operation
 from werkzeug.exceptions import NotFound
@@ -51,21 +51,51 @@ from ihatemoney.forms import (
     get_billform_for,
 )
 from ihatemoney.history import get_history, get_history_queries
+from ihatemoney.imports import (
+    IMPORT_FORMATS,
+    BillImporter,
+    InvalidImport,
+    iter_csv_bills,
+)
 from ihatemoney.models import Bill, LoggingMode, Person, Project, db
+from ihatemoney.transactions import retry_metrics, run_transaction
 from ihatemoney.utils import (
     LoginThrottler,
     Redirect303,
-    get_members,
-    list_of_dicts2csv,
-    list_of_dicts2json,
+    attachment_headers,
+    gzipped,
+    iter_dicts2csv,
+    iter_dicts2json,
+    iter_dicts2ndjson,
     render_localized_template,
-    same_bill,
 )
+from ihatemoney.versioning import deferred_versioning
 
 main = Blueprint("main", __name__)
 
 login_throttler = LoginThrottler(max_attempts=3, delay=1)
 
+# Number of invalid bills displayed when an import fails
+MAX_FLASHED_IMPORT_ERRORS = 5
+
+# Sortable columns of the dashboard, in the order of the table
+DASHBOARD_COLUMNS = (
+    "name",
+    "members_count",
+    "bills_count",
+    "newest_bill",
+    "oldest_bill",
+)
+DASHBOARD_PAGE_SIZE = 50
+DASHBOARD_MAX_PAGE_SIZE = 500
+
+# Encoder and mimetype of each export format
+EXPORT_FORMATS = {
+    "json": (iter_dicts2json, "application/json"),
+    "ndjson": (iter_dicts2ndjson, "application/x-ndjson"),
+    "csv": (iter_dicts2csv, "text/csv"),
+}
+
 
 def requires_admin(bypass=None):
     """Require admin permissions for @requires_admin decorated endpoints.
@@ -135,7 +165,7 @@ def pull_project(endpoint, values):
         values = {}
     project_id = values.pop("project_id", None)
     if project_id:
-        project = Project.query.get(project_id)
+        project = current_app.project_cache.get(project_id)
         if not project:
             raise Redirect303(url_for(".create_project", project_id=project_id))
 
@@ -305,7 +335,7 @@ def create_project():
 
             message_body = render_localized_template("reminder_mail")
 
-            msg = Message(
+            msg = current_app.mail.message(
                 message_title, body=message_body, recipients=[project.contact_email]
             )
             try:
@@ -329,7 +359,7 @@ def remind_password():
             project = Project.query.get(form.id.data)
             # send a link to reset the password
             current_app.mail.send(
-                Message(
+                current_app.mail.message(
                     "password recovery",
                     body=render_localized_template(
                         "password_reminder", project=project
@@ -381,31 +411,49 @@ def edit_project():
     import_form = UploadForm()
     # Import form
     if import_form.validate_on_submit():
+        upload = import_form.file.data
+        file_format = "csv" if upload.filename.lower().endswith(".csv") else "json"
         try:
-            import_project(import_form.file.data.stream, g.project)
+            with deferred_versioning(db.session):
+                import_project(upload.stream, g.project, file_format)
             flash(_("Project successfully uploaded"))
 
             return redirect(url_for("main.list_bills"))
+        except InvalidImport as e:
+            for error in e.errors[:MAX_FLASHED_IMPORT_ERRORS]:
+                flash(
+                    _(
+                        "Invalid bill #%(row)d: %(message)s",
+                        row=error.row,
+                        message=error.message,
+                    ),
+                    category="danger",
+                )
         except ValueError:
-            flash(_("Invalid JSON"), category="danger")
+            if file_format == "csv":
+                flash(_("Invalid CSV"), category="danger")
+            else:
+                flash(_("Invalid JSON"), category="danger")
 
     # Edit form
     if edit_form.validate_on_submit():
-        project = edit_form.update(g.project)
-        # Update converted currency
-        if project.default_currency != CurrencyConverter.no_currency:
-            for bill in project.get_bills():
+        # Changing the currency updates every bill of the project
+        with deferred_versioning(db.session):
+            project = edit_form.update(g.project)
+            # Update converted currency
+            if project.default_currency != CurrencyConverter.no_currency:
+                for bill in project.get_bills():
 
-                if bill.original_currency == CurrencyConverter.no_currency:
-                    bill.original_currency = project.default_currency
+                    if bill.original_currency == CurrencyConverter.no_currency:
+                        bill.original_currency = project.default_currency
 
-                bill.converted_amount = CurrencyConverter().exchange_currency(
-                    bill.amount, bill.original_currency, project.default_currency
-                )
-                db.session.add(bill)
+                    bill.converted_amount = CurrencyConverter().exchange_currency(
+                        bill.amount, bill.original_currency, project.default_currency
+                    )
+                    db.session.add(bill)
 
-        db.session.add(project)
-        db.session.commit()
+            db.session.add(project)
+            db.session.commit()
 
         return redirect(url_for("main.list_bills"))
     else:
@@ -427,107 +475,60 @@ def edit_project():
     )
 
 
-def import_project(file, project):
-    json_file = json.load(file)
-
-    # Check if JSON is correct
-    attr = ["what", "payer_name", "payer_weight", "amount", "date", "owers"]
-    attr.sort()
-    for e in json_file:
-        if len(e) != len(attr):
-            raise ValueError
-        list_attr = []
-        for i in e:
-            list_attr.append(i)
-        list_attr.sort()
-        if list_attr != attr:
-            raise ValueError
-
-    # From json : export list of members
-    members_json = get_members(json_file)
-    members = project.members
-    members_already_here = list()
-    for m in members:
-        members_already_here.append(str(m))
-
-    # List all members not in the project and weight associated
-    # List of tuples (name,weight)
-    members_to_add = list()
-    for i in members_json:
-        if str(i[0]) not in members_already_here:
-            members_to_add.append(i)
-
-    # List bills not in the project
-    # Same format than JSON element
-    project_bills = project.get_pretty_bills()
-    bill_to_add = list()
-    for j in json_file:
-        same = False
-        for p in project_bills:
-            if same_bill(p, j):
-                same = True
-                break
-        if not same:
-            bill_to_add.append(j)
-
-    # Add users to DB
-    for m in members_to_add:
-        Person(name=m[0], project=project, weight=m[1])
-    db.session.commit()
-
-    id_dict = {}
-    for i in project.members:
-        id_dict[i.name] = i.id
-
-    # Create bills
-    for b in bill_to_add:
-        owers_id = list()
-        for ower in b["owers"]:
-            owers_id.append(id_dict[ower])
-
-        bill = Bill()
-        form = get_billform_for(project)
-        form.what = b["what"]
-        form.amount = b["amount"]
-        form.date = parse(b["date"])
-        form.payer = id_dict[b["payer_name"]]
-        form.payed_for = owers_id
-        form.original_currency = b.get("original_currency")
-
-        db.session.add(form.fake_form(bill, project))
-
-    # Add bills to DB
-    db.session.commit()
+def import_project(file, project, file_format="json"):
+    """Import the bills of a json or csv file, as exported, into the project"""
+    if file_format == "csv":
+        bills = iter_csv_bills(file, [member.name for member in project.members])
+    else:
+        bills = IMPORT_FORMATS[file_format](file)
+    return BillImporter(project).run(bills)
 
 
 @main.route("/<project_id>/delete")
 def delete_project():
-    g.project.remove_project()
-    flash(_("Project successfully deleted"))
+    if g.project.should_remove_in_background():
+        g.project.remove_project_in_background()
+        flash(_("Project is being deleted"))
+    else:
+        g.project.remove_project()
+        flash(_("Project successfully deleted"))
 
     return redirect(request.headers.get("Referer") or url_for(".home"))
 
 
 @main.route("/<project_id>/export/<string:file>.<string:format>")
-def export_project(file, format):
+@main.route(
+    "/<project_id>/export/<string:file>.<string:format>.gz",
+    defaults={"compress": True},
+)
+def export_project(file, format, compress=False):
+    if format not in EXPORT_FORMATS:
+        abort(404, "No such export format")
+    encoder, mimetype = EXPORT_FORMATS[format]
+
     if file == "transactions":
         export = g.project.get_transactions_to_settle_bill(pretty_output=True)
     elif file == "bills":
-        export = g.project.get_pretty_bills(export_format=format)
+        export = g.project.iter_pretty_bills(
+            export_format="csv" if format == "csv" else "json"
+        )
     else:
         abort(404, "No such export type")
 
-    if format == "json":
-        file2export = list_of_dicts2json(export)
-    elif format == "csv":
-        file2export = list_of_dicts2csv(export)
-    else:
-        abort(404, "No such export format")
-
-    return send_file(
-        file2export,
-        attachment_filename=f"{g.project.id}-{file}.{format}",
-        as_attachment=True,
+    file2export = encoder(export)
+    filename = f"{g.project.id}-{file}.{format}"
+    if compress:
+        file2export = gzipped(
+            file2export, current_app.config["EXPORT_COMPRESSION_LEVEL"]
+        )
+        filename = f"{filename}.gz"
+        mimetype = "application/gzip"
+
+    # The export is encoded while it is sent, keep the request context around
+    return Response(
+        stream_with_context(file2export),
+        mimetype=mimetype,
+        headers=attachment_headers(filename),
     )
 
 
@@ -580,7 +581,7 @@ def invite():
                 "You have been invited to share your " "expenses for %(project)s",
                 project=g.project.name,
             )
-            msg = Message(
+            msg = current_app.mail.message(
                 message_title,
                 body=message_body,
                 recipients=[email.strip() for email in form.emails.data.split(",")],
@@ -598,10 +599,11 @@ def list_bills():
     # set the last selected payer as default choice if exists
     if "last_selected_payer" in session:
         bill_form.payer.data = session["last_selected_payer"]
-    # Preload the "owers" relationship for all bills
+    # Preload the "payer" and "owers" relationships for all bills, so that
+    # the per-share amounts are computed without any further query
     bills = (
         g.project.get_bills()
-        .options(orm.subqueryload(Bill.owers))
+        .options(orm.contains_eager(Bill.payer), orm.subqueryload(Bill.owers))
         .paginate(per_page=100, error_out=True)
     )
 
@@ -621,9 +623,13 @@ def add_member():
     form = MemberForm(g.project)
     if request.method == "POST":
         if form.validate():
-            member = form.save(g.project, Person())
-            db.session.commit()
-            flash(_("%(member)s has been added", member=member.name))
+
+            def save_member():
+                member = form.save(g.project, Person())
+                db.session.commit()
+                return member.name
+
+            flash(_("%(member)s has been added", member=run_transaction(save_member)))
             return redirect(url_for(".list_bills"))
 
     return render_template("add_member.html", form=form)
@@ -631,21 +637,24 @@ def add_member():
 
 @main.route("/<project_id>/members/<member_id>/reactivate", methods=["POST"])
 def reactivate(member_id):
-    person = (
-        Person.query.filter(Person.id == member_id)
-        .filter(Project.id == g.project.id)
-        .all()
-    )
+    def activate_member():
+        person = (
+            Person.query.for_project(g.project).filter(Person.id == member_id).all()
+        )
+        if person:
+            person[0].activated = True
+            db.session.commit()
+        return person
+
+    person = run_transaction(activate_member)
     if person:
-        person[0].activated = True
-        db.session.commit()
         flash(_("%(name)s is part of this project again", name=person[0].name))
     return redirect(url_for(".list_bills"))
 
 
 @main.route("/<project_id>/members/<member_id>/delete", methods=["POST"])
 def remove_member(member_id):
-    member = g.project.remove_member(member_id)
+    member = run_transaction(lambda: g.project.remove_member(member_id))
     if member:
         if not member.activated:
             flash(
@@ -669,8 +678,12 @@ def edit_member(member_id):
     form = MemberForm(g.project, edit=True)
 
     if request.method == "POST" and form.validate():
-        form.save(g.project, member)
-        db.session.commit()
+
+        def save_member():
+            form.save(g.project, member)
+            db.session.commit()
+
+        run_transaction(save_member)
         flash(_("User '%(name)s' has been edited", name=member.name))
         return redirect(url_for(".list_bills"))
 
@@ -687,9 +700,11 @@ def add_bill():
             session["last_selected_payer"] = form.payer.data
             session.update()
 
-            bill = Bill()
-            db.session.add(form.save(bill, g.project))
-            db.session.commit()
+            def save_bill():
+                db.session.add(form.save(Bill(), g.project))
+                db.session.commit()
+
+            run_transaction(save_bill)
 
             flash(_("The bill has been added"))
 
@@ -709,8 +724,11 @@ def delete_bill(bill_id):
     if not bill:
         return redirect(url_for(".list_bills"))
 
-    db.session.delete(bill)
-    db.session.commit()
+    def delete():
+        db.session.delete(bill)
+        db.session.commit()
+
+    run_transaction(delete)
     flash(_("The bill has been deleted"))
 
     return redirect(url_for(".list_bills"))
@@ -726,8 +744,12 @@ def edit_bill(bill_id):
     form = get_billform_for(g.project, set_default=False)
 
     if request.method == "POST" and form.validate():
-        form.save(bill, g.project)
-        db.session.commit()
+
+        def save_bill():
+            form.save(bill, g.project)
+            db.session.commit()
+
+        run_transaction(save_bill)
 
         flash(_("The bill has been modified"))
         return redirect(url_for(".list_bills"))
@@ -796,26 +818,119 @@ def strip_ip_addresses():
 def statistics():
     """Compute what each member has paid and spent and display it"""
     today = datetime.now()
+    # The statistics are computed by the template, within the fragments
+    # which are not cached
     return render_template(
         "statistics.html",
-        members_stats=g.project.members_stats,
-        monthly_stats=g.project.monthly_stats,
         months=[today - relativedelta(months=i) for i in range(12)],
         current_view="statistics",
     )
 
 
+def get_dashboard_page(args):
+    """Return a page of the projects of the dashboard with their statistics,
+    along with the total number of projects and the number of projects
+    matching the search.
+
+    The arguments are the ones of the DataTables server-side processing:
+    start, length, search[value], order[0][column] and order[0][dir].
+    """
+    start = max(args.get("start", 0, type=int), 0)
+    length = args.get("length", DASHBOARD_PAGE_SIZE, type=int)
+    if not 0 < length <= DASHBOARD_MAX_PAGE_SIZE:
+        length = DASHBOARD_PAGE_SIZE
+
+    projects = Project.query
+    total = projects.count()
+    search = args.get("search[value]", "").strip().lower()
+    if search:
+        projects = projects.filter(
+            sqlalchemy.or_(
+                sqlalchemy.func.lower(Project.name).contains(search, autoescape=True),
+                sqlalchemy.func.lower(Project.id).contains(search, autoescape=True),
+            )
+        )
+        filtered = projects.count()
+    else:
+        filtered = total
+
+    projects = projects.with_stats()
+    columns = {desc["name"]: desc["expr"] for desc in projects.column_descriptions}
+    column = args.get("order[0][column]", 0, type=int)
+    if not 0 <= column < len(DASHBOARD_COLUMNS):
+        column = 0
+    order = columns[DASHBOARD_COLUMNS[column]]
+    if args.get("order[0][dir]") == "desc":
+        order = order.desc()
+    projects = projects.order_by(order, Project.id).offset(start).limit(length)
+    return projects.all(), total, filtered
+
+
 @main.route("/dashboard")
 @requires_admin()
 def dashboard():
     is_admin_dashboard_activated = current_app.config["ACTIVATE_ADMIN_DASHBOARD"]
+    projects, total, filtered = [], 0, 0
+    if is_admin_dashboard_activated:
+        projects, total, filtered = get_dashboard_page(request.args)
     return render_template(
         "dashboard.html",
-        projects=Project.query.all(),
+        projects=projects,
+        total=total,
+        filtered=filtered,
+        page_size=DASHBOARD_PAGE_SIZE,
         is_admin_dashboard_activated=is_admin_dashboard_activated,
     )
 
 
+@main.route("/dashboard/projects.json")
+@requires_admin()
+def dashboard_projects():
+    """Pages of the dashboard, for DataTables server-side processing"""
+    if not current_app.config["ACTIVATE_ADMIN_DASHBOARD"]:
+        abort(404)
+    projects, total, filtered = get_dashboard_page(request.args)
+    return jsonify(
+        {
+            "draw": request.args.get("draw", 0, type=int),
+            "recordsTotal": total,
+            "recordsFiltered": filtered,
+            "data": [
+                {
+                    "id": project.id,
+                    "name": project.name,
+                    "members_count": project.members_count,
+                    "bills_count": project.bills_count,
+                    "newest_bill": project.newest_bill
+                    and project.newest_bill.isoformat(),
+                    "oldest_bill": project.oldest_bill
+                    and project.oldest_bill.isoformat(),
+                }
+                for project in projects
+            ],
+        }
+    )
+
+
+@main.route("/dashboard/metrics.json")
+@requires_admin()
+def dashboard_metrics():
+    """Counters of the retried transactions and of the caches of the process
+    serving the request
+    """
+    if not current_app.config["ACTIVATE_ADMIN_DASHBOARD"]:
+        abort(404)
+    return jsonify(
+        {
+            "transaction_retries": retry_metrics.as_dict(),
+            "project_cache": current_app.project_cache.stats(),
+            "caches": {
+                name: cache.stats() for name, cache in current_app.caches.items()
+            },
+        }
+    )
+
+
 @main.route("/favicon.ico")
 def favicon():
     return send_from_directory(